@@ -0,0 +1,81 @@
+"""A minimal IRC server stand-in for running the headless bots locally.
+
+It welcomes every nick, answers JOINs with a small nicklist and keeps track of which connection
+joined which channel, so benchmarks can push chat lines to the bots with send_channel() and read
+what the bots said from lines."""
+import socket
+import threading
+from collections import deque
+
+
+class FakeIRCd(object):
+    """Serve IRC on a free port of 127.0.0.1, every connection in its own thread."""
+
+    def __init__(self, names='@modguy pleb'):
+        self.names = names
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(50)
+        self.port = self.sock.getsockname()[1]
+        self.lines = deque(maxlen=10000)
+        self.received = 0
+        self.reads = 0
+        self.connections = []
+        self.joined = {}
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            connection, _ = self.sock.accept()
+            self.connections.append(connection)
+            thread = threading.Thread(target=self.serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, connection):
+        buf = ''
+        while True:
+            try:
+                data = connection.recv(65536)
+            except socket.error:
+                data = ''
+            if not data:
+                with self.lock:
+                    for channel in [c for c, other in self.joined.items() if other is connection]:
+                        del self.joined[channel]
+                return
+
+            self.reads += 1
+            buf += data
+            while '\r\n' in buf:
+                line, buf = buf.split('\r\n', 1)
+                self.received += 1
+                self.lines.append(line)
+                self.handle(connection, line)
+
+    def handle(self, connection, line):
+        command, _, params = line.partition(' ')
+        if command == 'NICK':
+            self.send(connection, ':tmi 001 {} :Welcome'.format(params))
+        elif command == 'PING':
+            self.send(connection, 'PONG {}'.format(params))
+        elif command == 'JOIN':
+            for channel in params.split(','):
+                with self.lock:
+                    self.joined[channel] = connection
+                self.send(connection, ':tmi 353 bot = {} :{}'.format(channel, self.names))
+                self.send(connection, ':tmi 366 bot {} :End of /NAMES list'.format(channel))
+        elif command == 'PART':
+            with self.lock:
+                self.joined.pop(params, None)
+
+    def send(self, connection, *lines):
+        connection.sendall(''.join(line + '\r\n' for line in lines))
+
+    def send_channel(self, channel, *lines):
+        """Send lines to the connection that joined a channel."""
+        self.send(self.joined[channel], *lines)
@@ -0,0 +1,61 @@
+"""A Twitch API (kraken) stand-in for running the bots without the real API.
+
+It answers /kraken/streams?channel=a,b,... and /kraken/channels/<name>, optionally after a delay
+to play a slow API, and counts the requests by path."""
+import json
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import Counter
+from SocketServer import ThreadingMixIn
+
+
+class FakeKraken(ThreadingMixIn, HTTPServer):
+    """Serve the API on a free port of 127.0.0.1. Channels in live are streaming."""
+
+    daemon_threads = True
+
+    def __init__(self, live=(), delay=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), KrakenHandler)
+        self.live = set(live)
+        self.delay = delay
+        self.requests = Counter()
+        self.url = 'http://127.0.0.1:{}/kraken'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def channel(self, name):
+        return {'name': name, 'display_name': name, 'status': 'Benchmarking', 'game': 'Bench'}
+
+    def stream(self, name):
+        return {'channel': self.channel(name), 'viewers': 42, 'created_at': '2015-01-01T12:00:00Z'}
+
+
+class KrakenHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.server.requests[url.path] += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        if url.path == '/kraken/streams':
+            names = urlparse.parse_qs(url.query).get('channel', [''])[0].split(',')
+            content = {'streams': [self.server.stream(name) for name in names if name in self.server.live]}
+        elif url.path.startswith('/kraken/channels/'):
+            content = self.server.channel(url.path.split('/')[3])
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps(content)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
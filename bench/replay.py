@@ -0,0 +1,556 @@
+"""Replay chat through the bot at full speed, without WeeChat.
+
+usage: python bench/replay.py [scenario ...] [--messages N] [--repeat R] [--log FILE]
+                              [--save FILE] [--compare FILE] [--tolerance 0.1]
+
+Messages are fed to WeechatBot.callback (or to a headless bot over a local IRC server stand-in),
+with the weechat module replaced by bench/weechat.py. Every scenario runs in a process of its own
+with fresh bots and state files in a temporary directory. For each scenario this prints messages
+per second, the p50/p99 latency of a single message, the objects still alive after the run (a
+proxy for leaks and growing caches) and the peak memory of the process. With --repeat, every
+scenario runs R times and the fastest run counts, which evens out noise (e.g. for comparing
+command_flood with instrumented, the same flood with INSTRUMENTATION on, or with profiled).
+
+--save writes the results to a baseline file, --compare prints the change against a baseline and
+exits with status 1 if a scenario got slower (messages per second) by more than the tolerance.
+--log replays a WeeChat log file (date, nick and message separated by tabs) as scenario "log".
+"""
+import gc
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from timeit import default_timer as clock
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [BENCH, os.path.dirname(BENCH)]
+
+import weechat  # noqa: E402 (the stand-in)
+import twitchbot  # noqa: E402
+
+OWNER = twitchbot.User(prefix='', nick=weechat.OWN_NICK)
+COMMANDS = ['uptime', 'game', 'viewers', 'amiop', 'amiregular', 'commands', 'help uptime', 'chatters', 'luck']
+
+
+# Helpers
+# --------------------------------
+def make_bot(channel='bench', nicks=()):
+    """Return a WeeChat bot for a channel with the given (prefix, nick) pairs in its nicklist.
+
+    The channel is offline as far as the stream poller knows, so no command asks the Twitch API."""
+    buffer = weechat.get_buffer('twitch', '#' + channel)
+    for prefix, nick in nicks:
+        weechat.add_nick(buffer, nick, prefix)
+    twitchbot.stream_poller.publish([channel], {'streams': []})
+    return twitchbot.Bot(name='twitch_' + channel, network='twitch', channel=channel)
+
+
+def replay(bot, lines):
+    """Feed (prefix + nick, message) lines to the bot's print callback and measure every call."""
+    callback, buffer = bot.callback, bot.buffer
+    latencies = []
+    gc.collect()
+    objects = len(gc.get_objects())
+
+    start = clock()
+    for nick, message in lines:
+        t = clock()
+        callback('', buffer, 0, '', 1, 0, nick, message)
+        latencies.append(clock() - t)
+    elapsed = clock() - start
+
+    gc.collect()
+    return result(len(lines), elapsed, latencies, len(gc.get_objects()) - objects)
+
+
+def result(messages, elapsed, latencies, objects):
+    latencies.sort()
+    return OrderedDict([
+        ('messages', messages),
+        ('msgs_per_sec', round(messages / elapsed, 1)),
+        ('p50_us', round(latencies[len(latencies) // 2] * 1e6, 2)),
+        ('p99_us', round(latencies[int(len(latencies) * 0.99)] * 1e6, 2)),
+        ('max_us', round(latencies[-1] * 1e6, 2)),
+        ('objects', objects),
+        ('max_rss_kb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        ('sent', weechat.sent_count),
+    ])
+
+
+def wrapped_methods():
+    """Return how many methods of the bot class and the API clients instrumentation wrapped."""
+    return sum(1 for cls in (twitchbot.Bot, twitchbot.TwitchAPI, twitchbot.TwitterTimeline)
+               for name in dir(cls) if hasattr(getattr(cls, name), 'operation'))
+
+
+def wait_until(condition, timeout=30):
+    """Run the headless loop until condition() is true."""
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        twitchbot.loop.run_once(0.01)
+
+
+def users(count, prefix='user'):
+    return ['{}{}'.format(prefix, i) for i in range(count)]
+
+
+# Scenarios
+# --------------------------------
+def scenario_chat(n):
+    """Mostly chatter from 2000 users, one in ten lines is a command."""
+    bot = make_bot()
+    nicks = users(2000)
+    lines = []
+    for _ in range(n):
+        if random.random() < 0.1:
+            lines.append((random.choice(nicks), '+' + random.choice(COMMANDS)))
+        else:
+            lines.append((random.choice(nicks), 'Kappa this is just chatting along'))
+    return replay(bot, lines)
+
+
+def scenario_command_flood(n):
+    """Commands only, from 5000 users: mostly cooldowns and the outgoing queue at work.
+
+    wrapped counts the methods wrapped for instrumentation, 0 unless it is on."""
+    bot = make_bot()
+    nicks = users(5000)
+    stats = replay(bot, [(random.choice(nicks), '+' + random.choice(COMMANDS)) for _ in range(n)])
+    stats['wrapped'] = wrapped_methods()
+    return stats
+
+
+def scenario_instrumented(n):
+    """The command flood with INSTRUMENTATION on, compare with command_flood for its overhead."""
+    twitchbot.INSTRUMENTATION = True
+    twitchbot.start_instrumentation([twitchbot.Bot])
+    return scenario_command_flood(n)
+
+
+def scenario_profiled(n):
+    """The command flood while +profile samples the main thread, compare with command_flood for
+    the overhead of profiling."""
+    twitchbot.profiler.start([twitchbot.Bot], twitchbot.PROFILE_MAX_WINDOW)
+    stats = scenario_command_flood(n)
+    twitchbot.profiler.stop()
+    stats['samples'] = twitchbot.profiler.samples
+    return stats
+
+
+def scenario_counter_spam(n):
+    """20 counters, counted up by 1000 users."""
+    bot = make_bot()
+    for i in range(20):
+        bot.dispatch(OWNER, 'counter new count{} Counted {{}} times.'.format(i))
+    nicks = users(1000)
+    return replay(bot, [(random.choice(nicks), '+count{}'.format(random.randrange(20))) for _ in range(n)])
+
+
+def scenario_large_nicklist(n):
+    """10000 nicks in chat (one in ten an op), nicks joining and leaving between the messages."""
+    nicks = users(10000)
+    buffer = weechat.get_buffer('twitch', '#bench')
+    for i, nick in enumerate(nicks):
+        weechat.add_nick(buffer, nick, '@' if i % 10 == 0 else '')
+    start = clock()
+    bot = make_bot()
+    setup_ms = round((clock() - start) * 1000, 2)
+
+    lines = [(random.choice(nicks), '+' + random.choice(['chatters', 'luck', 'amiop', 'ops'])) for _ in range(n)]
+    signals = []
+    for i in range(n):
+        nick = 'joiner{}'.format(i)
+        weechat.add_nick(buffer, nick)
+        signals.append(('nicklist_nick_added', '{},{}'.format(buffer, nick)))
+        signals.append(('nicklist_nick_removing', '{},{}'.format(buffer, nick)))
+    start = clock()
+    for signal, data in signals:
+        weechat.call('nicklist_callback', '', signal, data)
+    signal_us = (clock() - start) / len(signals) * 1e6
+
+    stats = replay(bot, lines)
+    stats['setup_ms'] = setup_ms
+    stats['signal_us'] = round(signal_us, 2)
+    return stats
+
+
+def scenario_large_replies(n):
+    """5000 custom replies, used by 2000 users in between chatter."""
+    bot = make_bot()
+    start = clock()
+    for i in range(5000):
+        bot.dispatch(OWNER, 'set reply{0} This is reply number {0}.'.format(i))
+    setup_ms = round((clock() - start) * 1000, 2)
+    nicks = users(2000)
+    lines = []
+    for _ in range(n):
+        if random.random() < 0.5:
+            lines.append((random.choice(nicks), '+reply{}'.format(random.randrange(5000))))
+        else:
+            lines.append((random.choice(nicks), 'no command here'))
+    stats = replay(bot, lines)
+    stats['setup_ms'] = setup_ms
+    return stats
+
+
+def scenario_regulars(n):
+    """10000 regulars and ops, half of the users asking about their role are one of them."""
+    bot = make_bot()
+    bot.regulars = set(users(10000, 'regular'))
+    bot.ops = set(users(1000, 'op'))
+    nicks = users(5000, 'regular') + users(500, 'op') + users(5500)
+    return replay(bot, [(random.choice(nicks), random.choice(['+amiregular', '+amiop'])) for _ in range(n)])
+
+
+def scenario_timers(n):
+    """300 timers with 40 splits each, as on marathon channels, split again by an op: the pickled
+    size of the timers and how long writing the whole state takes."""
+    twitchbot.COOLDOWN_OP_RATE = n
+    bot = make_bot(nicks=[('@', 'runner')])
+    for i in range(300):
+        timer = bot.timers['run{}'.format(i)] = twitchbot.Timer(name='run{}'.format(i))
+        timer.start()
+        for j in range(40):
+            timer.split('split{}'.format(j))
+    bot.active_timer = 'run0'
+
+    start = clock()
+    bot.save()
+    bot.flush()
+    write_ms = round((clock() - start) * 1000, 2)
+    lines = [('@runner', '+timer resplit split{} run{}'.format(random.randrange(40), random.randrange(300)))
+             for _ in range(n)]
+    stats = replay(bot, lines)
+    stats['timers_kb'] = round(len(twitchbot.pickle.dumps(bot.timers, 2)) / 1024.0, 1)
+    stats['write_ms'] = write_ms
+    return stats
+
+
+def archive_runs(bot, attempts):
+    """Archive attempts runs of a 40 split timer (a third of them reset early), writing the state
+    after each one. Return the time per run."""
+    bot.dispatch(OWNER, 'timer new marathon')
+    timer = bot.timers['marathon']
+    start = clock()
+    for attempt in range(attempts):
+        timer.restart()
+        seconds = 0.0
+        for i in range(40 if attempt % 3 else random.randrange(1, 40)):
+            seconds += random.uniform(50, 70)
+            timer.add_split('split{}'.format(i), seconds)
+        bot.archive_run('marathon', seconds + 60 if len(timer.index) == 40 else None)
+        bot.flush()
+    return (clock() - start) / attempts
+
+
+def scenario_run_history(n):
+    """5000 attempts of a 40 split run archived into the journal and SQLite stores, then pb, sob and
+    delta asked by 2000 users. The history is loaded again from both stores, to check that it is
+    the one in memory."""
+    twitchbot.COOLDOWN_RATE = twitchbot.COOLDOWN_USER_RATE = n
+    archived = OrderedDict()
+    for backend in ('journal', 'sqlite'):
+        twitchbot.STATE_BACKEND = backend
+        bot = make_bot(backend)
+        archived[backend] = archive_runs(bot, 5000)
+        history = bot.run_history['marathon']
+        loaded = make_bot(backend).run_history['marathon']
+        assert (loaded.attempts, loaded.pb, loaded.sum_of_best, loaded.route) == \
+            (history.attempts, history.pb, history.sum_of_best, history.route)
+    timer = bot.timers['marathon']
+    timer.restart()
+    timer.add_split('split20', 1200.0)
+
+    nicks = users(2000)
+    stats = replay(bot, [(random.choice(nicks), random.choice(['+timer pb', '+timer sob', '+timer delta']))
+                         for _ in range(n)])
+    for backend, seconds in archived.items():
+        stats['archive_{}_us'.format(backend)] = round(seconds * 1e6, 2)
+    stats['history_kb'] = round(len(twitchbot.pickle.dumps(bot.run_history, 2)) / 1024.0, 1)
+    return stats
+
+
+def scenario_journal_crash(n):
+    """Journal state after a crash: the journal is cut short by 1 to 40 bytes, the bot is loaded
+    and sets a counter and adds an op. Both changes have to be there on the next load."""
+    twitchbot.STATE_BACKEND = 'journal'
+    lost = 0
+    loading = 0.0
+    for cut in range(1, 41):
+        channel = 'crash{}'.format(cut)
+        bot = make_bot(channel)
+        bot.dispatch(OWNER, 'counter new deaths')
+        bot.flush()
+        for i in range(n // 1000):
+            bot.dispatch(OWNER, 'counter set deaths {}'.format(i))
+            bot.flush()
+        with open(bot.store.journal_path, 'r+b') as journal:
+            journal.truncate(os.path.getsize(bot.store.journal_path) - cut)
+
+        start = clock()
+        bot = make_bot(channel)
+        loading += clock() - start
+        bot.dispatch(OWNER, 'counter set deaths 10')
+        bot.flush()
+        bot.dispatch(OWNER, 'op bob')
+        bot.flush()
+
+        bot = make_bot(channel)
+        lost += bot.counters['deaths']['value'] != 10 or 'bob' not in bot.ops
+    return OrderedDict([
+        ('crashes', 40),
+        ('lost', lost),
+        ('load_ms', round(loading / 40 * 1000, 2)),
+    ])
+
+
+def scenario_log(n, path):
+    """Replay a WeeChat log: date, prefix and nick, message separated by tabs."""
+    lines = []
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2 and fields[-2] and not fields[-2].startswith(('-', '<', '>')):
+                lines.append((fields[-2], fields[-1]))
+    if not lines:
+        raise SystemExit('No messages in {}.'.format(path))
+    lines = (lines * (n // len(lines) + 1))[:n]
+    return replay(make_bot(), lines)
+
+
+def scenario_headless(n):
+    """Chat lines for 20 channels over one connection to a local IRC server stand-in, end to end."""
+    from ircd import FakeIRCd
+    server = FakeIRCd()
+    twitchbot.HEADLESS_SERVERS = {'twitch': {'host': '127.0.0.1', 'port': server.port, 'nick': weechat.OWN_NICK}}
+    twitchbot.loop = twitchbot.HeadlessLoop()
+    channels = ['bench{}'.format(i) for i in range(20)]
+    bots = []
+    for channel in channels:
+        twitchbot.stream_poller.publish([channel], {'streams': []})
+        bots.append(twitchbot.HeadlessBot(name='twitch_' + channel, network='twitch', channel=channel))
+    wait_until(lambda: len(server.joined) == len(channels))
+
+    latencies = []
+    for bot in bots:
+        def measured(nick, message, tags=None, received=bot.message_received):
+            t = clock()
+            received(nick, message, tags)
+            latencies.append(clock() - t)
+        bot.message_received = measured
+
+    nicks = users(2000)
+    gc.collect()
+    objects = len(gc.get_objects())
+    start = clock()
+    for i in range(0, n, 500):
+        for channel in channels:
+            server.send_channel('#' + channel, *[
+                '@badges=;mod=0 :{0}!{0}@tmi PRIVMSG #{1} :{2}'.format(
+                    random.choice(nicks), channel, random.choice(['+amiop', 'hello there', '+uptime']))
+                for _ in range(500 // len(channels))])
+        wait_until(lambda: len(latencies) >= min(n, i + 500))
+    elapsed = clock() - start
+    gc.collect()
+    stats = result(len(latencies), elapsed, latencies, len(gc.get_objects()) - objects)
+    stats['sent'] = server.received
+    return stats
+
+
+def scenario_stream_poll(n):
+    """The stream status of 250 channels from a local Twitch API stand-in: requests and time taken."""
+    from kraken import FakeKraken
+    channels = ['bench{}'.format(i) for i in range(250)]
+    api = FakeKraken(live=channels[::5])
+    twitchbot.loop = twitchbot.HeadlessLoop()
+    twitchbot.twitch_api.api_url = api.url
+    for channel in channels:
+        twitchbot.stream_poller.add(channel)
+
+    start = clock()
+    twitchbot.stream_poller.poll()
+    wait_until(lambda: len(twitchbot.stream_poller.updated) == len(channels))
+    return OrderedDict([
+        ('channels', len(channels)),
+        ('requests', sum(api.requests.values())),
+        ('poll_ms', round((clock() - start) * 1000, 2)),
+        ('live', sum(1 for stream in twitchbot.stream_poller.streams.values() if stream)),
+    ])
+
+
+def scenario_slow_api(n):
+    """+title in 20 offline channels while every API request takes 200 ms: dispatch must not wait,
+    the answers take as long as WORKER_THREADS threads need for the requests. Then +title again
+    from someone else in every channel, answered from the cache."""
+    from kraken import FakeKraken
+    api = FakeKraken(delay=0.2)
+    twitchbot.loop = twitchbot.HeadlessLoop()
+    twitchbot.twitch_api.api_url = api.url
+    bots = [make_bot('bench{}'.format(i)) for i in range(20)]
+
+    latencies = []
+    start = clock()
+    for bot in bots:
+        t = clock()
+        bot.callback('', bot.buffer, 0, '', 1, 0, 'viewer', '+title')
+        latencies.append(clock() - t)
+    dispatched = clock() - start
+    wait_until(lambda: weechat.sent_count >= len(bots))
+    stats = result(len(bots), dispatched, latencies, 0)
+    stats['answered_ms'] = round((clock() - start) * 1000, 2)
+
+    for bot in bots:
+        bot.callback('', bot.buffer, 0, '', 1, 0, 'other', '+title')
+    wait_until(lambda: weechat.sent_count >= 2 * len(bots))
+    api = twitchbot.twitch_api
+    stats['cache_hits'] = api.cache_hits
+    stats['cache_misses'] = api.cache_misses
+    stats['coalesced'] = api.coalesced
+    return stats
+
+
+def scenario_scheduler(n):
+    """n jobs due within a second, a third of them cancelled and a third moved: what scheduling
+    costs per job and how late the jobs ran."""
+    twitchbot.loop = twitchbot.HeadlessLoop()
+
+    def tick():
+        pass
+
+    start = clock()
+    jobs = [twitchbot.call_later(0.5, tick, jitter=0.5) for _ in range(n)]
+    scheduled = clock() - start
+
+    start = clock()
+    for job in jobs[::3]:
+        twitchbot.cancel(job)
+    for job in jobs[1::3]:
+        twitchbot.reschedule(job, 0.25)
+    changed = clock() - start
+    wait_until(lambda: not twitchbot.scheduler.jobs, timeout=5)
+
+    runs, _, total, worst = twitchbot.scheduler.lags['tick']
+    return OrderedDict([
+        ('jobs', n),
+        ('ran', runs),
+        ('schedule_us', round(scheduled / n * 1e6, 2)),
+        ('change_us', round(changed / (len(jobs[::3]) + len(jobs[1::3])) * 1e6, 2)),
+        ('avg_lag_ms', round(total / runs * 1000, 2)),
+        ('max_lag_ms', round(worst * 1000, 2)),
+    ])
+
+
+SCENARIOS = OrderedDict([
+    ('chat', scenario_chat),
+    ('command_flood', scenario_command_flood),
+    ('instrumented', scenario_instrumented),
+    ('profiled', scenario_profiled),
+    ('counter_spam', scenario_counter_spam),
+    ('large_nicklist', scenario_large_nicklist),
+    ('large_replies', scenario_large_replies),
+    ('regulars', scenario_regulars),
+    ('timers', scenario_timers),
+    ('run_history', scenario_run_history),
+    ('headless', scenario_headless),
+    ('stream_poll', scenario_stream_poll),
+    ('slow_api', scenario_slow_api),
+    ('scheduler', scenario_scheduler),
+    ('journal_crash', scenario_journal_crash),
+])
+
+
+# Running and comparing
+# --------------------------------
+def run_scenario(name, messages, log=None):
+    """Run a scenario in this process, in a temporary directory for the state files."""
+    random.seed(1)
+    directory = tempfile.mkdtemp(prefix='twitchbot-bench-')
+    os.chdir(directory)
+    try:
+        if name == 'log':
+            return scenario_log(messages, log)
+        return SCENARIOS[name](messages)
+    finally:
+        threads = list(twitchbot.worker.threads)
+        twitchbot.worker.stop()
+        for thread in threads:
+            thread.join(1)
+        os.chdir(BENCH)
+        shutil.rmtree(directory)
+
+
+def run_isolated(name, messages, log=None):
+    """Run a scenario in a process of its own and return its results."""
+    command = [sys.executable, os.path.abspath(__file__), '--run', name, '--messages', str(messages)]
+    if log:
+        command.extend(['--log', os.path.abspath(log)])
+    output = subprocess.check_output(command)
+    return json.loads(output.splitlines()[-1], object_pairs_hook=OrderedDict)
+
+
+def compare(results, baseline, tolerance):
+    """Print the change of every scenario against the baseline, return whether none regressed."""
+    ok = True
+    for name, stats in results.items():
+        if name not in baseline or 'msgs_per_sec' not in stats:
+            continue
+        before, after = baseline[name]['msgs_per_sec'], stats['msgs_per_sec']
+        change = (after - before) / before
+        regressed = change < -tolerance
+        ok = ok and not regressed
+        print('{:<16} {:>12.1f} -> {:>12.1f} msgs/s ({:+.1%}), p99 {} -> {} us{}'.format(
+            name, before, after, change, baseline[name]['p99_us'], stats['p99_us'],
+            '  REGRESSION' if regressed else ''))
+    return ok
+
+
+def main(args):
+    option = lambda name, default=None: args[args.index(name) + 1] if name in args else default
+    messages = int(option('--messages', 20000))
+    log = option('--log')
+
+    if '--run' in args:
+        stats = run_scenario(option('--run'), messages, log)
+        print(json.dumps(stats))
+        return 0
+
+    repeat = int(option('--repeat', 1))
+    values = set(option(name) for name in ('--messages', '--repeat', '--log', '--save', '--compare', '--tolerance'))
+    names = [arg for arg in args if not arg.startswith('--') and arg not in values] or list(SCENARIOS)
+    if log and 'log' not in names:
+        names.append('log')
+
+    results = OrderedDict()
+    for name in names:
+        runs = [run_isolated(name, messages, log) for _ in range(repeat)]
+        results[name] = max(runs, key=lambda stats: stats.get('msgs_per_sec', 0))
+        print('{:<16} {}'.format(name, ', '.join('{}={}'.format(key, value) for key, value in results[name].items())))
+
+    if 'instrumented' in results and 'command_flood' in results:
+        print('instrumentation overhead: {:+.1%} msgs/s, {} methods wrapped when on, {} when off'.format(
+            results['instrumented']['msgs_per_sec'] / results['command_flood']['msgs_per_sec'] - 1,
+            results['instrumented']['wrapped'],
+            results['command_flood']['wrapped'],
+        ))
+    if 'profiled' in results and 'command_flood' in results:
+        print('profiling overhead: {:+.1%} msgs/s'.format(
+            results['profiled']['msgs_per_sec'] / results['command_flood']['msgs_per_sec'] - 1))
+    if option('--save'):
+        with open(option('--save'), 'w') as f:
+            json.dump(results, f, indent=2)
+    if option('--compare'):
+        with open(option('--compare')) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, float(option('--tolerance', 0.1))):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,94 @@
+"""Measure how long loading the script takes with many configured channels, and its memory.
+
+usage: python bench/startup.py [--channels 500] [--open 20]
+
+Loads the script (with bench/weechat.py as the weechat module) in fresh processes: once with the
+buffers of --open channels open at load time, their bots start right away and the others once
+their buffers open, and once with the buffers of all channels open. Reported are the time to
+import and start the script, the growth of the process' memory, how many bots were started and
+which of the lazily imported modules the script imported.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+from timeit import default_timer as clock
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+LAZY_MODULES = ['requests', 'oauth2', 'json', 'pickle', 'HTMLParser', 'sqlite3', 'multiprocessing', 'Queue',
+                'ast', 'asynchat', 'asyncore', 'hashlib', 'socket', 'threading']
+
+
+def rss_kb():
+    """Return the current resident memory of this process."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def load(channels, open_channels):
+    sys.path[:0] = [BENCH, os.path.dirname(BENCH)]
+    preloaded = set(sys.modules)
+    before = rss_kb()
+    start = clock()
+    import weechat
+    import twitchbot
+    imported = clock()
+
+    names = ['channel{}'.format(i) for i in range(channels)]
+    twitchbot.CHANNELS = {'twitch': names}
+    for name in names[:open_channels]:
+        weechat.get_buffer('twitch', '#' + name)
+    twitchbot.run_weechat()
+    started = clock()
+
+    stats = OrderedDict([
+        ('channels', channels),
+        ('open', open_channels),
+        ('import_ms', round((imported - start) * 1000, 2)),
+        ('load_ms', round((started - start) * 1000, 2)),
+        ('rss_kb', rss_kb() - before),
+        ('bots', len(twitchbot.bots)),
+        ('imported', [name for name in LAZY_MODULES if name in sys.modules and name not in preloaded]),
+    ])
+
+    # the other buffers open later, e.g. while WeeChat joins the channels.
+    start = clock()
+    for name in names[open_channels:]:
+        weechat.send_signal('irc_channel_opened', weechat.get_buffer('twitch', '#' + name))
+    if channels > open_channels:
+        stats['bot_start_ms'] = round((clock() - start) * 1000 / (channels - open_channels), 3)
+    stats['bots_later'] = len(twitchbot.bots)
+    return stats
+
+
+def run_isolated(channels, open_channels):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run',
+                                      '--channels', str(channels), '--open', str(open_channels)])
+    return json.loads(output.splitlines()[-1], object_pairs_hook=OrderedDict)
+
+
+def main(args):
+    option = lambda name, default: int(args[args.index(name) + 1]) if name in args else default
+    channels = option('--channels', 500)
+    open_channels = option('--open', 20)
+
+    if '--run' in args:
+        directory = tempfile.mkdtemp(prefix='twitchbot-bench-')
+        os.chdir(directory)
+        try:
+            print(json.dumps(load(channels, open_channels)))
+        finally:
+            shutil.rmtree(directory)
+        return 0
+
+    for opened in (open_channels, channels):
+        stats = run_isolated(channels, opened)
+        print(', '.join('{}={}'.format(key, value) for key, value in stats.items()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,181 @@
+"""A stand-in for WeeChat's python API, just enough to load twitchbot.py and feed it messages
+without WeeChat.
+
+Buffers, their local variables and nicklists live in this module, benchmarks set them up with
+get_buffer() and add_nick() and fire hooks with call() or send_signal(). Commands sent to buffers
+are counted, the latest are kept in sent."""
+import sys
+from collections import OrderedDict, deque
+
+WEECHAT_RC_OK = 0
+WEECHAT_RC_ERROR = -1
+WEECHAT_HOOK_SIGNAL_STRING = 'string'
+
+OWN_NICK = 'benchbot'
+
+buffers = {}
+hooks = []
+sent = deque(maxlen=1000)
+sent_count = 0
+
+
+def call(name, *args):
+    """Call a callback given by name, as WeeChat does: from __main__ or from the script."""
+    func = getattr(sys.modules['__main__'], name, None) or getattr(sys.modules['twitchbot'], name)
+    return func(*args)
+
+
+def send_signal(signal, signal_data):
+    """Call the callbacks hooked to a signal."""
+    for hook in list(hooks):
+        if hook[0] == 'signal' and hook[1] == signal:
+            call(hook[2], hook[3], signal, signal_data)
+
+
+def get_buffer(server, channel):
+    """Return the pointer of the buffer of a channel, creating the buffer the first time."""
+    pointer = '0x{}{}'.format(server, channel.lstrip('#'))
+    if pointer not in buffers:
+        buffers[pointer] = {
+            'localvars': {'server': server, 'channel': channel, 'nick': OWN_NICK},
+            'nicklist': OrderedDict(),
+        }
+    return pointer
+
+
+def add_nick(buffer, nick, prefix=''):
+    """Put a nick into the nicklist of a buffer, without signals (for setting up before the bot)."""
+    buffers[buffer]['nicklist'][nick] = prefix
+
+
+# Script, output and infos
+# --------------------------------
+def register(*args):
+    return 1
+
+
+def prnt(buffer, text):
+    pass
+
+
+def info_get(name, arguments):
+    if name == 'irc_buffer':
+        server, _, channel = arguments.partition(',')
+        pointer = '0x{}{}'.format(server, channel.lstrip('#'))
+        return pointer if pointer in buffers else ''
+    if name == 'irc_is_nick':
+        return '1' if arguments and ' ' not in arguments else '0'
+    return ''
+
+
+def info_get_hashtable(name, hashtable):
+    return {}
+
+
+def config_get_plugin(option):
+    return ''
+
+
+# Hooks
+# --------------------------------
+def _hook(kind, *args):
+    hooks.append((kind,) + args)
+    return '0xhook{}'.format(len(hooks))
+
+
+def hook_print(*args):
+    return _hook('print', *args)
+
+
+def hook_timer(*args):
+    return _hook('timer', *args)
+
+
+def hook_fd(*args):
+    return _hook('fd', *args)
+
+
+def hook_signal(*args):
+    return _hook('signal', *args)
+
+
+def hook_modifier(*args):
+    return _hook('modifier', *args)
+
+
+def hook_info(*args):
+    return _hook('info', *args)
+
+
+def hook_command(*args):
+    return _hook('command', *args)
+
+
+def unhook(pointer):
+    pass
+
+
+def command(buffer, text):
+    global sent_count
+    sent_count += 1
+    sent.append((buffer, text))
+    return WEECHAT_RC_OK
+
+
+# Buffers and nicklists
+# --------------------------------
+def buffer_search(plugin, name):
+    return ''
+
+
+def buffer_get_string(buffer, name):
+    if name.startswith('localvar_'):
+        return buffers[buffer]['localvars'].get(name[len('localvar_'):], '')
+    return ''
+
+
+def buffer_get_integer(buffer, name):
+    if name == 'nicklist_nicks_count':
+        return len(buffers[buffer]['nicklist'])
+    return 0
+
+
+def buffer_set(buffer, name, value):
+    if name.startswith('localvar_set_'):
+        buffers[buffer]['localvars'][name[len('localvar_set_'):]] = value
+
+
+def nicklist_search_nick(buffer, group, nick):
+    return nick if nick in buffers[buffer]['nicklist'] else ''
+
+
+def nicklist_nick_get_string(buffer, nick, name):
+    if name == 'prefix':
+        return buffers[buffer]['nicklist'].get(nick, '')
+    return ''
+
+
+# Infolists: only irc_nick, with the arguments "server,#channel,"
+# --------------------------------
+def infolist_get(name, pointer, arguments):
+    server, channel = arguments.split(',')[:2]
+    nicklist = buffers[get_buffer(server, channel)]['nicklist']
+    return {'items': iter(nicklist.items()), 'current': None}
+
+
+def infolist_next(infolist):
+    infolist['current'] = next(infolist['items'], None)
+    return 1 if infolist['current'] is not None else 0
+
+
+def infolist_string(infolist, name):
+    nick, prefix = infolist['current']
+    return {'name': nick, 'prefixes': prefix}.get(name, '')
+
+
+def infolist_pointer(infolist, name):
+    return ''
+
+
+def infolist_free(infolist):
+    pass
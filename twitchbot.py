@@ -1,20 +1,86 @@
 # -*- coding: utf-8 -*-# -*- coding: utf-8 -*-
-import json
-import oauth2
-import pickle
+import bisect
+import heapq
+import os
+import random
 import re
-import requests
-from collections import namedtuple, OrderedDict
+import select
+import signal
+import sys
+import thread
+import time
+import traceback
+from array import array
+from collections import defaultdict, deque, namedtuple, OrderedDict
 from datetime import datetime, timedelta
-from functools import wraps
-from HTMLParser import HTMLParser
+from functools import partial, wraps
+from itertools import count
+
+
+class LazyModule(object):
+    """Stand-in for a module that is imported when one of its attributes is used the first time.
+
+    The module then replaces the stand-in in the globals of the script, later uses go straight to it."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        module = __import__(self.name)
+        globals()[self.name] = module
+        return getattr(module, attribute)
+
+
+class LazyClass(object):
+    """Stand-in for a class whose base class is in a module imported on first use.
+
+    The class is created from the namespace of the decorated class and the base class the first
+    time an instance is made, see lazy_base()."""
+
+    def __init__(self, cls, module, base):
+        self.namespace = dict((name, value) for name, value in vars(cls).items()
+                              if name not in ('__dict__', '__weakref__'))
+        self.name = cls.__name__
+        self.module = module
+        self.base = base
+        self.cls = None
+
+    def __call__(self, *args, **kwargs):
+        if self.cls is None:
+            base = getattr(__import__(self.module), self.base)
+            # the metaclass of the base, asyncore's classes are classic classes.
+            self.cls = type(base)(self.name, (base,), self.namespace)
+        return self.cls(*args, **kwargs)
+
+
+def lazy_base(module, base):
+    """Decorate a class to derive it from the base class of a module when it is first used, e.g.
+    @lazy_base('asynchat', 'async_chat') for a subclass of asynchat.async_chat."""
+    return lambda cls: LazyClass(cls, module, base)
+
+
+# slow to import or not needed by every setup, imported on first use. Locks come from the built-in
+# thread module (threading.Lock is thread.allocate_lock), threading is imported to start threads.
+HTMLParser = LazyModule('HTMLParser')
+Queue = LazyModule('Queue')
+ast = LazyModule('ast')
+asynchat = LazyModule('asynchat')
+asyncore = LazyModule('asyncore')
+hashlib = LazyModule('hashlib')
+json = LazyModule('json')
+multiprocessing = LazyModule('multiprocessing')
+oauth2 = LazyModule('oauth2')
+pickle = LazyModule('pickle')
+requests = LazyModule('requests')
+socket = LazyModule('socket')
+sqlite3 = LazyModule('sqlite3')
+threading = LazyModule('threading')
 
 import_ok = True
 try:
     import weechat
 except ImportError:
-    print('This script must be run under WeeChat.')
-    print('Get WeeChat now at: http://www.weechat.org/')
+    weechat = None
     import_ok = False
 
 SCRIPT_NAME = "twitchbot"
@@ -24,6 +90,12 @@ SCRIPT_LICENSE = "GPL3"
 SCRIPT_DESCRIPTION = "This is an extensible bot for twitch chats."
 
 User = namedtuple('User', ['prefix', 'nick'])
+
+# Roles of users, higher roles include the permissions of lower ones.
+ROLE_NONE = 0
+ROLE_REGULAR = 1
+ROLE_OP = 2
+ROLE_OWNER = 3
 # =====================================
 # CONFIG
 # =====================================
@@ -35,12 +107,151 @@ CHANNELS = {
 }
 COMMAND_SYMBOL = '+'
 
+# State changes are written to disk at most every SAVE_DELAY seconds, or as soon as
+# SAVE_MAX_CHANGES changes are pending. Set SAVE_DELAY to 0 to write on every change.
+SAVE_DELAY = 5
+SAVE_MAX_CHANGES = 50
+
+# How state is stored: 'pickle' rewrites the whole state on every write, 'journal' appends
+# each change to a journal that is compacted into the state file once it grows beyond
+# JOURNAL_MAX_SIZE bytes, 'sqlite' keeps the state of all bots in the SQLITE_DATABASE file.
+# Bots without state in the database import their pickle (or journal) files on first load.
+STATE_BACKEND = 'pickle'
+JOURNAL_MAX_SIZE = 64 * 1024
+SQLITE_DATABASE = 'twitchbot.db'
+
+# Requests to external APIs are made by WORKER_THREADS background threads, so WeeChat never
+# waits for them. All bots share keep-alive connections, HTTP_POOL_SIZE per host. Requests
+# are given up after TWITCH_API_TIMEOUT or TWITTER_API_TIMEOUT seconds.
+WORKER_THREADS = 2
+HTTP_POOL_SIZE = 4
+TWITCH_API_TIMEOUT = 5
+TWITTER_API_TIMEOUT = 10
+
+# Seconds that answers of the Twitch API are reused, by endpoint. Endpoints that are not listed
+# are not cached, but concurrent requests for the same URL are still made only once.
+TWITCH_API_CACHE_TTL = {
+    'streams': 30,
+    'channels': 60,
+}
+
+# The stream status of all channels is polled every STREAM_POLL_INTERVAL seconds, with up to
+# STREAM_BATCH_SIZE channels per request (the maximum of the streams endpoint is 100).
+STREAM_POLL_INTERVAL = 60
+STREAM_BATCH_SIZE = 100
+
+# Twitter handles are polled every TWITTER_POLL_MIN seconds after a tweet, backing off up to
+# TWITTER_POLL_MAX seconds while a handle is quiet. Intervals are stretched further when the
+# rate limit reported by twitter would run out before it resets.
+TWITTER_POLL_MIN = 60
+TWITTER_POLL_MAX = 15 * 60
+TWITTER_POLL_BACKOFF = 1.5
+
+# Messages are sent at most SAY_RATE times per SAY_PERIOD seconds per account, or SAY_RATE_MOD
+# times to channels where the bot is a moderator. Messages that had to wait for more than
+# SAY_MAX_AGE seconds are dropped and no channel has more than SAY_MAX_QUEUE messages waiting.
+SAY_RATE = 20
+SAY_RATE_MOD = 100
+SAY_PERIOD = 30
+SAY_MAX_AGE = 30
+SAY_MAX_QUEUE = 10
+
+# Priorities of outgoing messages, lower values are sent first.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# A command can be used COOLDOWN_RATE times per COOLDOWN_PERIOD seconds in a channel and
+# COOLDOWN_USER_RATE times by the same user. Ops share a separate budget of COOLDOWN_OP_RATE.
+# COOLDOWNS overrides the (channel, user) rates of single commands. Each channel keeps track of
+# at most COOLDOWN_MAX_USERS users, forgetting the least recently active first. Commands a user
+# may not use are ignored before they count against any of these.
+COOLDOWN_PERIOD = 30
+COOLDOWN_RATE = 20
+COOLDOWN_USER_RATE = 5
+COOLDOWN_OP_RATE = 60
+COOLDOWN_MAX_USERS = 10000
+COOLDOWNS = {
+    'uptime': (3, 1),
+    'game': (3, 1),
+    'viewers': (3, 1),
+    'title': (3, 1),
+}
+
+# Everything that runs later runs from one scheduler. Polls are spread over up to SCHEDULE_JITTER
+# of their interval, so they don't all fire in the same second. Periodic jobs that fall behind by
+# a whole interval (a stalled loop) skip the runs they missed instead of running them back to back.
+SCHEDULE_JITTER = 0.1
+
+# Roles of up to ROLE_CACHE_SIZE nicks per channel are remembered until the role lists change.
+ROLE_CACHE_SIZE = 50000
+
+# Without WeeChat (python twitchbot.py --headless) the bots connect to the servers of their
+# networks themselves, all channels of a network share one connection. Channels are joined
+# HEADLESS_JOIN_RATE at a time every HEADLESS_JOIN_PERIOD seconds, lost connections are
+# retried after HEADLESS_RECONNECT_DELAY seconds.
+HEADLESS_SERVERS = {
+    'twitch': {
+        'host': 'irc.chat.twitch.tv',
+        'port': 6667,
+        'nick': '',
+        'password': '',  # oauth:...
+    },
+}
+HEADLESS_JOIN_RATE = 20
+HEADLESS_JOIN_PERIOD = 10
+HEADLESS_RECONNECT_DELAY = 10
+
+# Headless bots can be split over HEADLESS_SHARDS worker processes (or --shards N), channels are
+# assigned to workers by consistent hashing with SHARD_REPLICAS points per worker on the ring.
+# Workers that die are restarted after SHARD_RESTART_DELAY seconds. The supervisor starts another
+# worker on SIGUSR1, stops one on SIGUSR2 and on SIGHUP reads CHANNELS from this file again, moves
+# channels accordingly and makes all workers reload their state.
+HEADLESS_SHARDS = 1
+SHARD_REPLICAS = 64
+SHARD_RESTART_DELAY = 5
+
+# With INSTRUMENTATION on, dispatch, commands, state writes (flush), messages sent to the channel
+# (irc_say) and the API clients are counted and timed per channel, latencies in histogram buckets
+# with the upper bounds of STATS_BUCKETS (seconds). The stats are shown by +stats, by the
+# twitchbot_stats info and written to STATS_FILE in the Prometheus text format every
+# STATS_INTERVAL seconds. Without it nothing is wrapped or timed.
+INSTRUMENTATION = False
+STATS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATS_FILE = 'twitchbot.prom'
+STATS_INTERVAL = 60
+
+# +profile start [seconds] samples the stack of the main loop every PROFILE_INTERVAL seconds, for
+# PROFILE_WINDOW seconds by default and at most PROFILE_MAX_WINDOW, and keeps the PROFILE_TOP
+# slowest dispatches. +profile dump writes the sampled stacks to PROFILE_FILE in the folded format
+# (one line per stack with its count, for flamegraph.pl, speedscope, ...).
+PROFILE_WINDOW = 60
+PROFILE_MAX_WINDOW = 600
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 10
+PROFILE_FILE = 'twitchbot.folded'
+
+# Stopped and restarted runs of every timer are archived for +timer pb, sob and delta. The split
+# times of the latest RUN_HISTORY_SIZE runs are kept, the personal best and best segments of all
+# runs (of the splits that the kept runs still have). Archived runs are written one at a time, the
+# whole history of a timer only every RUN_HISTORY_CHECKPOINT runs.
+RUN_HISTORY_SIZE = 1000
+RUN_HISTORY_CHECKPOINT = 100
+
 DEBUG = False
 
 
+def prnt(text):
+    """Print a line to WeeChat's core buffer, or to stdout when running headless."""
+    if import_ok:
+        weechat.prnt("", str(text))
+    else:
+        print(str(text))
+
+
 def debug(text):
     if DEBUG:
-        weechat.prnt("", str(text))
+        prnt(text)
 
 
 class NotImplemented(Exception):
@@ -102,15 +313,831 @@ class BufferNicklist(object):
             name = weechat.infolist_string(self.nicklist, 'name').strip()
             prefix = weechat.infolist_string(self.nicklist, 'prefixes').strip()
             return User(prefix=prefix, nick=name)
+        weechat.infolist_free(self.nicklist)
         raise StopIteration
 
 
+def monotonic():
+    """Return seconds from a clock that never jumps, unlike time.time() when the system time is set.
+
+    This is clock_gettime(CLOCK_MONOTONIC) through ctypes on Linux, time.time() elsewhere. The
+    first call replaces this function with the clock it found."""
+    global monotonic
+    try:
+        if not sys.platform.startswith('linux'):
+            raise OSError('CLOCK_MONOTONIC is only known on Linux')
+        import ctypes
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        clock_gettime = ctypes.CDLL(None, use_errno=True).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+
+        def monotonic():
+            timespec = Timespec()
+            if clock_gettime(1, ctypes.byref(timespec)) != 0:  # 1 is CLOCK_MONOTONIC
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+        monotonic()
+    except (ImportError, AttributeError, OSError):
+        monotonic = time.time
+    return monotonic()
+
+
+class Job(object):
+    """A call scheduled by the Scheduler, due at due and every period seconds if period is set."""
+
+    __slots__ = ('id', 'due', 'func', 'period', 'name')
+
+    def __init__(self, job_id, due, func, period, name):
+        self.id = job_id
+        self.due = due
+        self.func = func
+        self.period = period
+        self.name = name
+
+
+def job_name(func):
+    """Return the name lag is reported under for the jobs calling func, e.g. StreamPoller.poll."""
+    func = getattr(func, 'func', func)
+    name = getattr(func, '__name__', 'job')
+    owner = getattr(func, 'im_self', None)
+    if owner is not None:
+        return '{}.{}'.format(type(owner).__name__, name)
+    return name
+
+
+class Scheduler(object):
+    """All calls that run later, in a heap ordered by when they are due.
+
+    Cancelled and rescheduled jobs leave their old heap entries behind, those are skipped when
+    they come up (or when the heap is rebuilt), so cancel() and reschedule() are O(log n) at most.
+    Due times are on the monotonic() clock, setting the system time doesn't hold jobs back. The lag
+    of every run, how late it ran, is kept per job name."""
+
+    def __init__(self):
+        self.heap = []
+        self.jobs = {}
+        self.ids = count()
+        self.lags = {}
+
+    def schedule(self, seconds, func, jitter=0, period=None):
+        """Call func after seconds plus up to jitter seconds, then every period seconds if given."""
+        if jitter:
+            seconds += random.uniform(0, jitter)
+        job = Job(next(self.ids), monotonic() + seconds, func, period, job_name(func))
+        self.jobs[job.id] = job
+        heapq.heappush(self.heap, (job.due, job.id))
+        return job
+
+    def cancel(self, job):
+        """Forget a job, whether or not it was still scheduled."""
+        if self.jobs.pop(job.id, None) is not None and len(self.heap) > 2 * len(self.jobs) + 64:
+            self.compact()
+
+    def reschedule(self, job, seconds):
+        """Move a job to seconds from now, scheduling it again if it already ran or was cancelled."""
+        job.due = monotonic() + seconds
+        self.jobs[job.id] = job
+        heapq.heappush(self.heap, (job.due, job.id))
+
+    def compact(self):
+        """Rebuild the heap without the entries of cancelled and rescheduled jobs."""
+        self.heap = [(job.due, job.id) for job in self.jobs.itervalues()]
+        heapq.heapify(self.heap)
+
+    def next_due(self):
+        """Return when the next job is due, or None if there is none."""
+        while self.heap:
+            due, job_id = self.heap[0]
+            job = self.jobs.get(job_id)
+            if job is not None and job.due == due:
+                return due
+            heapq.heappop(self.heap)
+        return None
+
+    def run_due(self):
+        """Run the jobs that are due. Periodic jobs that missed whole periods skip those runs."""
+        now = monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            due, job_id = heapq.heappop(self.heap)
+            job = self.jobs.get(job_id)
+            if job is None or job.due != due:
+                continue
+
+            lag = now - due
+            stats = self.lags.get(job.name)
+            if stats is None:
+                stats = self.lags[job.name] = [0, 0, 0.0, 0.0]
+            stats[0] += 1
+            stats[2] += lag
+            stats[3] = max(stats[3], lag)
+
+            if job.period:
+                missed = int(lag // job.period)
+                stats[1] += missed
+                job.due = due + (missed + 1) * job.period
+                heapq.heappush(self.heap, (job.due, job.id))
+            else:
+                del self.jobs[job_id]
+
+            try:
+                job.func()
+            except Exception:
+                traceback.print_exc()
+
+    def summary(self, limit=5):
+        """Return a line about the jobs that ran latest on average."""
+        lags = sorted(self.lags.items(), key=lambda item: -item[1][2] / item[1][0])
+        if not lags:
+            return 'Nothing ran yet.'
+        return '{} jobs scheduled | '.format(len(self.jobs)) + ' | '.join(
+            '{}: {} runs, {} skipped, avg lag {:.1f} ms, max {:.1f} ms'.format(
+                name, runs, skipped, total / runs * 1000, worst * 1000,
+            ) for name, (runs, skipped, total, worst) in lags[:limit])
+
+
+scheduler = Scheduler()
+
+
+class WeechatLoop(object):
+    """Run the scheduler and watch file descriptors with WeeChat's main loop.
+
+    A single timer hook is armed for the next due job and re-armed only when an earlier job
+    is scheduled, so the number of hooks doesn't grow with channels or features."""
+
+    def __init__(self):
+        self.timer = None
+        self.timer_due = None
+
+    def wake(self, due):
+        """Make sure the scheduler runs by the time due."""
+        if self.timer is not None:
+            if self.timer_due <= due:
+                return
+            weechat.unhook(self.timer)
+        self.timer_due = due
+        self.timer = weechat.hook_timer(max(1, int((due - monotonic()) * 1000)), 0, 1, 'scheduler_callback', '')
+
+    def watch_fd(self, fd, func):
+        _fd_watchers[str(fd)] = func
+        return weechat.hook_fd(fd, 1, 0, 0, 'fd_watcher_callback', str(fd))
+
+    def unwatch_fd(self, pointer):
+        weechat.unhook(pointer)
+
+
+# the main loop everything is scheduled on, run_headless() replaces it.
+loop = WeechatLoop()
+
+
+def call_later(seconds, func, jitter=0):
+    """Call func once from the main loop, after the given number of seconds plus up to jitter
+    seconds. Return the job, for cancel() and reschedule()."""
+    job = scheduler.schedule(seconds, func, jitter)
+    loop.wake(job.due)
+    return job
+
+
+def call_every(seconds, func, jitter=0, first=None):
+    """Call func every given number of seconds from the main loop, the first time after first
+    seconds (or one interval) plus up to jitter seconds. Return the job, for cancel()."""
+    job = scheduler.schedule(seconds if first is None else first, func, jitter, period=seconds)
+    loop.wake(job.due)
+    return job
+
+
+def cancel(job):
+    """Don't run a job scheduled by call_later() or call_every() (anymore)."""
+    scheduler.cancel(job)
+
+
+def reschedule(job, seconds):
+    """Run a job seconds from now instead of when it was due."""
+    scheduler.reschedule(job, seconds)
+    loop.wake(job.due)
+
+
+def scheduler_callback(data, remaining_calls):
+    """Run the due jobs and arm the timer for the next one."""
+    loop.timer = None
+    scheduler.run_due()
+    due = scheduler.next_due()
+    if due is not None:
+        loop.wake(due)
+    return weechat.WEECHAT_RC_OK
+
+
+_fd_watchers = {}
+
+
+def watch_fd(fd, func):
+    """Call func from the main loop whenever the file descriptor is readable."""
+    return loop.watch_fd(fd, func)
+
+
+def unwatch_fd(pointer):
+    """Stop watching a file descriptor, given what watch_fd() returned."""
+    loop.unwatch_fd(pointer)
+
+
+def fd_watcher_callback(data, fd):
+    """Run a function registered by watch_fd()."""
+    func = _fd_watchers.get(data)
+    if func is not None:
+        func()
+    return weechat.WEECHAT_RC_OK
+
+
+_nicklist_watchers = {}
+
+
+def watch_nicklist(buffer, func):
+    """Call func(nick, present) from WeeChat's main loop whenever a nick in the buffer's nicklist is
+    added or changed (present is True) or removed (present is False)."""
+    if not _nicklist_watchers:
+        for signal in ('nicklist_nick_added', 'nicklist_nick_changed', 'nicklist_nick_removing'):
+            weechat.hook_signal(signal, 'nicklist_callback', '')
+    _nicklist_watchers[buffer] = func
+
+
+def nicklist_callback(data, signal, signal_data):
+    """Pass a nicklist signal on to the function watching the buffer."""
+    buffer, _, nick = signal_data.partition(',')
+    func = _nicklist_watchers.get(buffer)
+    if func is not None:
+        func(nick, signal != 'nicklist_nick_removing')
+    return weechat.WEECHAT_RC_OK
+
+
+_capabilities = {}
+
+
+def request_capabilities(server, capabilities):
+    """Ask the IRC server for capabilities, now and whenever WeeChat (re)connects to it."""
+    if not _capabilities:
+        weechat.hook_signal('irc_server_connected', 'server_connected_callback', '')
+
+    requested = _capabilities.setdefault(server, set())
+    capabilities = set(capabilities) - requested
+    if capabilities:
+        requested.update(capabilities)
+        send_capabilities(server, capabilities)
+
+
+def send_capabilities(server, capabilities):
+    """Send a capability request to a connected server."""
+    if weechat.info_get('irc_server_isconnected', server) != '1':
+        return
+    buffer = weechat.buffer_search('irc', 'server.{}'.format(server))
+    weechat.command(buffer, '/quote CAP REQ :{}'.format(' '.join(sorted(capabilities))))
+
+
+def server_connected_callback(data, signal, signal_data):
+    """Request the capabilities again after connecting to a server."""
+    if signal_data in _capabilities:
+        send_capabilities(signal_data, _capabilities[signal_data])
+    return weechat.WEECHAT_RC_OK
+
+
+_tag_watchers = {}
+
+
+def watch_message_tags(server, channel, func):
+    """Call func(nick, tags) with the IRCv3 tags of every message to the channel, before it is printed."""
+    if not _tag_watchers:
+        weechat.hook_modifier('irc_in2_privmsg', 'message_tags_modifier', '')
+    _tag_watchers[(server, channel.lower())] = func
+
+
+def message_tags_modifier(data, modifier, modifier_data, string):
+    """Pass the tags of a message on to the function watching the channel, leave the message as it is."""
+    # @tags :nick!user@host PRIVMSG #channel :text
+    if not string.startswith('@'):
+        return string
+
+    tags, _, message = string[1:].partition(' ')
+    source, _, message = message.partition(' ')
+    _, _, message = message.partition(' ')
+    channel = message.partition(' ')[0]
+    func = _tag_watchers.get((modifier_data, channel.lower()))
+    if func is not None:
+        func(source[1:].partition('!')[0], parse_tags(tags))
+    return string
+
+
+def parse_tags(tags):
+    """Turn the tags of a message (key=value;key=value) into a dict."""
+    return dict(tag.partition('=')[::2] for tag in tags.split(';'))
+
+
 def is_valid_nick(nick=None):
     """Return True if the given nick looks like a valid irc nick, False otherwise."""
     if not nick:
         return False
 
-    return weechat.info_get('irc_is_nick', nick) == '1'
+    if import_ok:
+        return weechat.info_get('irc_is_nick', nick) == '1'
+    return re.match(r'[\w\[\]\\^{}|`][\w\[\]\\^{}|`-]*$', nick) is not None
+
+
+# =====================================
+# Headless mode
+# =====================================
+class HeadlessLoop(object):
+    """Run the scheduler and watch file descriptors and IRC connections without WeeChat, using asyncore."""
+
+    def __init__(self):
+        self.sockets = {}
+        self.running = False
+
+    def wake(self, due):
+        """Nothing to do, run_once() never waits past the next due job."""
+
+    def watch_fd(self, fd, func):
+        return FdWatcher(fd, func, self.sockets)
+
+    def unwatch_fd(self, watcher):
+        watcher.close()
+
+    def run(self):
+        """Run until stop() is called."""
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def run_once(self, timeout=1.0):
+        """Wait for the sockets until the next job is due (or timeout seconds), then run due jobs."""
+        due = scheduler.next_due()
+        if due is not None:
+            timeout = max(0, min(timeout, due - monotonic()))
+        if self.sockets:
+            asyncore.loop(timeout, map=self.sockets, count=1)
+        else:
+            time.sleep(timeout)
+        scheduler.run_due()
+
+    def stop(self):
+        self.running = False
+
+
+@lazy_base('asyncore', 'file_dispatcher')
+class FdWatcher(object):
+    """Call a function whenever a file descriptor is readable."""
+
+    def __init__(self, fd, func, sockets):
+        # unlike file_dispatcher.__init__, leave the file descriptor blocking: func reads from it.
+        asyncore.dispatcher.__init__(self, None, sockets)
+        self.connected = True
+        self.set_file(fd)
+        self.func = func
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.func()
+
+
+@lazy_base('asynchat', 'async_chat')
+class IRCConnection(object):
+    """A connection to an IRC server, shared by the bots of all channels on a network.
+
+    Lines are not written one by one, everything sent during a loop iteration goes out in one write."""
+
+    ac_out_buffer_size = 16 * 1024
+
+    def __init__(self, network, host, port, nick, password='', sockets=None):
+        asynchat.async_chat.__init__(self, map=sockets)
+        self.network = network
+        self.address = (host, port)
+        self.nick = nick
+        self.password = password
+        self.sockets = sockets
+        self.bots = {}
+        self.capabilities = set()
+        self.registered = False
+        self.joining = []
+        self.join_pointer = None
+        self.incoming = []
+        self.outgoing = []
+        self.set_terminator('\n')
+        self.connect_server()
+
+    def connect_server(self):
+        """Open the socket and connect, registering happens once the connection is made."""
+        self.discard_buffers()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(self.address)
+
+    def add_bot(self, channel, bot):
+        """Deliver the messages of a channel to a bot and join the channel."""
+        self.bots[channel.lower()] = bot
+        self.request_capabilities(bot.capabilities)
+        if self.registered:
+            self.join(channel)
+
+    def remove_bot(self, channel):
+        """Stop delivering the messages of a channel and leave it."""
+        channel = channel.lower()
+        self.bots.pop(channel, None)
+        if channel in self.joining:
+            self.joining.remove(channel)
+        elif self.registered:
+            self.send_line('PART {}'.format(channel))
+
+    def request_capabilities(self, capabilities):
+        """Ask the server for capabilities, now and whenever the connection is made again."""
+        capabilities = set(capabilities) - self.capabilities
+        self.capabilities.update(capabilities)
+        if capabilities and self.registered:
+            self.send_line('CAP REQ :{}'.format(' '.join(sorted(capabilities))))
+
+    def join(self, channel):
+        """Join a channel, JOINs are paced to HEADLESS_JOIN_RATE channels per HEADLESS_JOIN_PERIOD."""
+        self.joining.append(channel)
+        if self.join_pointer is None:
+            self.join_pointer = call_later(0, self.join_next)
+
+    def join_next(self):
+        """Join the next channels waiting, with as few JOINs as the line length allows."""
+        self.join_pointer = None
+        if not self.registered or not self.joining:
+            return
+
+        channels, self.joining = self.joining[:HEADLESS_JOIN_RATE], self.joining[HEADLESS_JOIN_RATE:]
+        line = []
+        for channel in channels:
+            if line and len(line) + sum(len(c) for c in line) + len(channel) > 400:
+                self.send_line('JOIN {}'.format(','.join(line)))
+                line = []
+            line.append(channel)
+        self.send_line('JOIN {}'.format(','.join(line)))
+        if self.joining:
+            self.join_pointer = call_later(HEADLESS_JOIN_PERIOD, self.join_next)
+
+    def send_line(self, line):
+        """Send a line to the server with the next write."""
+        self.outgoing.append(line + '\r\n')
+
+    def writable(self):
+        return bool(self.outgoing) or asynchat.async_chat.writable(self)
+
+    def handle_write(self):
+        if self.outgoing:
+            data, self.outgoing = ''.join(self.outgoing), []
+            self.push(data)
+        else:
+            asynchat.async_chat.handle_write(self)
+
+    def handle_connect(self):
+        if self.password:
+            self.send_line('PASS {}'.format(self.password))
+        self.send_line('NICK {}'.format(self.nick))
+        self.send_line('USER {0} 0 * :{0}'.format(self.nick))
+
+    def handle_close(self):
+        """Forget who is in the channels and connect again after a while."""
+        debug('Lost connection to {}, reconnecting in {} seconds.'.format(self.network, HEADLESS_RECONNECT_DELAY))
+        self.close()
+        self.registered = False
+        self.joining = []
+        self.outgoing = []
+        for bot in self.bots.values():
+            bot.index_nicklist([])
+        call_later(HEADLESS_RECONNECT_DELAY, self.connect_server)
+
+    def handle_error(self):
+        """Print the traceback but keep the connection, a failing command must not disconnect all bots."""
+        traceback.print_exc()
+        if not self.connected:
+            self.handle_close()
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        """Parse a line (@tags :source COMMAND params :trailing) and hand it to the irc_* method of the command."""
+        line, self.incoming = ''.join(self.incoming).rstrip('\r'), []
+        tags = source = None
+        if line.startswith('@'):
+            tags, _, line = line[1:].partition(' ')
+        if line.startswith(':'):
+            source, _, line = line[1:].partition(' ')
+        line, trailing_sep, trailing = line.partition(' :')
+        params = line.split()
+        if not params:
+            return
+        if trailing_sep:
+            params.append(trailing)
+        handler = getattr(self, 'irc_{}'.format(params[0].lower()), None)
+        if handler is not None:
+            nick = source.partition('!')[0] if source else ''
+            handler(nick, params[1:], tags)
+
+    def irc_ping(self, nick, params, tags):
+        self.send_line('PONG :{}'.format(params[-1] if params else ''))
+
+    def irc_001(self, nick, params, tags):
+        """Registered: request the capabilities and join the channels."""
+        self.nick = params[0]
+        self.registered = True
+        if self.capabilities:
+            self.send_line('CAP REQ :{}'.format(' '.join(sorted(self.capabilities))))
+        for channel in sorted(self.bots):
+            self.join(channel)
+
+    def irc_privmsg(self, nick, params, tags):
+        bot = self.bots.get(params[0].lower())
+        if bot is not None and len(params) > 1:
+            bot.message_received(nick, params[1], tags)
+
+    def irc_353(self, nick, params, tags):
+        """A part of the nicklist of a channel: params are own nick, channel type, channel and nicks."""
+        bot = self.bots.get(params[2].lower())
+        if bot is not None:
+            for name in params[3].split():
+                nick = name.lstrip('~&@%+')
+                bot.nick_changed(nick, name[:len(name) - len(nick)])
+
+    def irc_join(self, nick, params, tags):
+        bot = self.bots.get(params[0].lower())
+        if bot is not None and nick not in bot.nicks:
+            bot.nick_changed(nick, '')
+
+    def irc_part(self, nick, params, tags):
+        bot = self.bots.get(params[0].lower())
+        if bot is not None:
+            bot.nick_changed(nick, None)
+
+    def irc_quit(self, nick, params, tags):
+        for bot in self.bots.values():
+            if nick in bot.nicks:
+                bot.nick_changed(nick, None)
+
+    def irc_mode(self, nick, params, tags):
+        """Keep track of ops, which is what Twitch sends modes for."""
+        bot = self.bots.get(params[0].lower())
+        if bot is None or len(params) < 3 or params[1] not in ('+o', '-o'):
+            return
+        prefix = bot.nicks.get(params[2], '').replace('@', '')
+        bot.nick_changed(params[2], '@' + prefix if params[1] == '+o' else prefix)
+
+
+_connections = {}
+
+
+def get_connection(network):
+    """Return the connection to the server of a network, connecting to it the first time."""
+    if network not in _connections:
+        server = HEADLESS_SERVERS[network]
+        _connections[network] = IRCConnection(
+            network,
+            server['host'],
+            server['port'],
+            server['nick'],
+            server.get('password', ''),
+            loop.sockets,
+        )
+    return _connections[network]
+
+
+# =====================================
+# Background work
+# =====================================
+class BackgroundWorker(object):
+    """Run blocking calls (e.g. HTTP requests) in threads and hand the results back to the main loop.
+
+    Finished jobs are queued and signalled through a pipe watched by WeeChat, so the callbacks of
+    submit() always run on WeeChat's main thread and may use the WeeChat API."""
+
+    def __init__(self, threads=WORKER_THREADS):
+        self.size = threads
+        self.threads = []
+        self.jobs = None
+        self.results = None
+        self.read_fd = self.write_fd = None
+        self.fd_pointer = None
+
+    def start(self):
+        """Start the threads and watch the pipe."""
+        if self.jobs is None:
+            self.jobs = Queue.Queue()
+            self.results = Queue.Queue()
+        self.read_fd, self.write_fd = os.pipe()
+        self.fd_pointer = watch_fd(self.read_fd, self.deliver)
+        for _ in range(self.size):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Stop the threads once they are done with their current job."""
+        if not self.threads:
+            return
+        for _ in self.threads:
+            self.jobs.put(None)
+        unwatch_fd(self.fd_pointer)
+        self.threads = []
+
+    def submit(self, func, args, callback):
+        """Call func(*args) in a thread and later callback(result) on the main thread.
+
+        The result is None if func raised an exception."""
+        if not self.threads:
+            self.start()
+        self.jobs.put((func, args, callback))
+
+    def work(self):
+        """Main function of the threads: run jobs until stopped."""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            func, args, callback = job
+            try:
+                result, error = func(*args), None
+            except Exception as e:
+                result, error = None, e
+            self.results.put((callback, result, error))
+            os.write(self.write_fd, '.')
+
+    def deliver(self):
+        """Call the callbacks of all finished jobs."""
+        os.read(self.read_fd, 4096)
+        while True:
+            try:
+                callback, result, error = self.results.get_nowait()
+            except Queue.Empty:
+                return
+            if error is not None:
+                debug('Background job failed: {!r}'.format(error))
+            callback(result)
+
+
+worker = BackgroundWorker()
+
+
+# =====================================
+# Outgoing messages
+# =====================================
+class TokenBucket(object):
+    """Allow rate events per period seconds, in bursts of up to rate events.
+
+    Refills are measured with monotonic(), setting the system time back doesn't take tokens away."""
+
+    def __init__(self, rate, period):
+        self.capacity = float(rate)
+        self.tokens = float(rate)
+        self.fill_rate = rate / float(period)
+        self.updated = monotonic()
+
+    def wait_time(self, now):
+        """Return the seconds until the next event is allowed."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.fill_rate
+
+    def take(self):
+        """Use up one event."""
+        self.tokens -= 1
+
+
+class OutboundQueue(object):
+    """Pace the messages of all bots, so that no account exceeds the message limits of Twitch.
+
+    Every account (network and nick of a bot) has two token buckets: one for channels where the
+    bot is a moderator and a stricter one for all others. Messages wait in a queue per priority
+    for each of the two (rate classes), so that messages for channels waiting on the stricter
+    limit don't hold up those for the others. Identical messages that are already waiting are not
+    queued again."""
+
+    rates = ('mod', 'normal')
+
+    def __init__(self):
+        self.accounts = {}
+        self.sent = 0
+        self.dropped = 0
+        self.collapsed = 0
+        self.waited = 0.0
+
+    def get_account(self, key):
+        """Return the queues and buckets of an account, create them on first use."""
+        if key not in self.accounts:
+            self.accounts[key] = {
+                'lanes': dict((rate, [deque(), deque(), deque()]) for rate in self.rates),
+                'waiting': set(),
+                'depth': defaultdict(int),
+                'mod': TokenBucket(SAY_RATE_MOD, SAY_PERIOD),
+                'normal': TokenBucket(SAY_RATE, SAY_PERIOD),
+                'pointer': None,
+                'blocked': set(),  # rate classes waiting for their limit
+            }
+        return self.accounts[key]
+
+    def put(self, bot, text, priority=PRIORITY_NORMAL):
+        """Queue a message of a bot and send it as soon as the limits allow."""
+        key = bot.get_account()
+        account = self.get_account(key)
+        if (bot, text) in account['waiting']:
+            self.collapsed += 1
+            return
+
+        rate = 'mod' if bot.is_moderator() else 'normal'
+        lanes = account['lanes'][rate]
+        # make room by dropping the oldest message of the same or a lower priority, or this one.
+        if account['depth'][bot] >= SAY_MAX_QUEUE:
+            for lane in reversed(lanes[priority:]):
+                entry = next((entry for entry in lane if entry[0] is bot), None)
+                if entry is not None:
+                    lane.remove(entry)
+                    self.forget(account, entry)
+                    break
+            else:
+                self.dropped += 1
+                return
+
+        lanes[priority].append((bot, text, monotonic()))
+        account['waiting'].add((bot, text))
+        account['depth'][bot] += 1
+        if rate not in account['blocked']:
+            self.drain(key)
+
+    def remove(self, bot):
+        """Drop all waiting messages of a bot."""
+        for account in self.accounts.values():
+            if not account['depth'].pop(bot, 0):
+                continue
+            for lanes in account['lanes'].values():
+                for priority, lane in enumerate(lanes):
+                    lanes[priority] = deque(entry for entry in lane if entry[0] is not bot)
+            account['waiting'] = set((other, text) for other, text in account['waiting'] if other is not bot)
+
+    def forget(self, account, entry, dropped=True):
+        """Remove the bookkeeping of a message that left the queue."""
+        bot, text, _ = entry
+        account['waiting'].discard((bot, text))
+        account['depth'][bot] -= 1
+        if dropped:
+            self.dropped += 1
+
+    def drain(self, key):
+        """Send waiting messages of an account, highest priority first, until the limits are hit
+        for both rate classes, then try again when the first of them allows more."""
+        account = self.accounts[key]
+        if account['pointer'] is not None:
+            cancel(account['pointer'])
+            account['pointer'] = None
+        now = monotonic()
+        waits = {}
+        for priority in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW):
+            for rate in self.rates:
+                lane = account['lanes'][rate][priority]
+                while lane and rate not in waits:
+                    bot, text, queued = lane[0]
+                    if now - queued > SAY_MAX_AGE:
+                        self.forget(account, lane.popleft())
+                        continue
+
+                    if bot.is_moderator():
+                        buckets = (account['mod'],)
+                    else:
+                        buckets = (account['mod'], account['normal'])
+                    wait = max(bucket.wait_time(now) for bucket in buckets)
+                    if wait > 0:
+                        waits[rate] = wait
+                        break
+
+                    for bucket in buckets:
+                        bucket.take()
+                    self.forget(account, lane.popleft(), dropped=False)
+                    self.sent += 1
+                    self.waited += now - queued
+                    bot.irc_say(text)
+
+        account['blocked'] = set(waits)
+        if waits:
+            account['pointer'] = call_later(min(waits.values()), partial(self.drain, key))
+
+    def stats(self):
+        """Return a short description of the queue."""
+        depth = sum(len(lane) for account in self.accounts.values()
+                    for lanes in account['lanes'].values() for lane in lanes)
+        return 'Queue: {} waiting, {} sent ({:.1f} s average wait), {} dropped, {} collapsed.'.format(
+            depth,
+            self.sent,
+            self.waited / max(self.sent, 1),
+            self.dropped,
+            self.collapsed,
+        )
+
+
+outbound_queue = OutboundQueue()
 
 
 # =====================================
@@ -123,6 +1150,14 @@ TWITTER_ACCESS_SECRET = 'XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX'
 
 
 class TwitterTimeline(object):
+    """Access to twitter timelines. All bots share one instance and its connection."""
+
+    def __init__(self):
+        self.client = None
+        self.lock = thread.allocate_lock()
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+
     def get(self, handle=None, previous_id=None, length=1):
         """Get twitter timeline for the user."""
         if handle is None:
@@ -145,14 +1180,142 @@ class TwitterTimeline(object):
         else:
             return False
 
+    def get_client(self):
+        """Return the signing client, create it on first use."""
+        if self.client is None:
+            consumer = oauth2.Consumer(key=TWITTER_CONSUMER_KEY, secret=TWITTER_CONSUMER_SECRET)
+            token = oauth2.Token(key=TWITTER_ACCESS_TOKEN, secret=TWITTER_ACCESS_SECRET)
+            self.client = oauth2.Client(consumer, token, timeout=TWITTER_API_TIMEOUT)
+        return self.client
+
     def request(self, url, http_method='GET', get_params=None, post_body='', http_headers=None):
         """Make the actual request."""
-        consumer = oauth2.Consumer(key=TWITTER_CONSUMER_KEY, secret=TWITTER_CONSUMER_SECRET)
-        token = oauth2.Token(key=TWITTER_ACCESS_TOKEN, secret=TWITTER_ACCESS_SECRET)
-        client = oauth2.Client(consumer, token)
         if get_params is not None:
             url += '?' + '&'.join(k+'='+str(v) for k, v in get_params.iteritems())
-        return client.request(url, method=http_method, body=post_body, headers=http_headers)
+        # the client keeps its connection alive between requests, but must not be shared by threads.
+        with self.lock:
+            response, content = self.get_client().request(
+                url,
+                method=http_method,
+                body=post_body,
+                headers=http_headers
+            )
+            if 'x-rate-limit-remaining' in response:
+                self.rate_limit_remaining = int(response['x-rate-limit-remaining'])
+                self.rate_limit_reset = int(response['x-rate-limit-reset'])
+        return response, content
+
+
+twitter_timeline = TwitterTimeline()
+
+
+class TwitterPoller(object):
+    """Poll the timelines of the twitter handles of all bots and pass new tweets on to the bots.
+
+    Every handle is polled once, no matter how many bots follow it. The poll interval of a handle
+    starts at TWITTER_POLL_MIN, grows by TWITTER_POLL_BACKOFF while the handle is quiet or polls
+    fail and drops back to the minimum after a new tweet."""
+
+    def __init__(self, timeline):
+        self.timeline = timeline
+        self.subscribers = {}
+        self.handles = {}
+
+    def subscribe(self, bot, handle):
+        """Pass new tweets of the handle on to the bot's new_tweet() method."""
+        name, handle = handle, handle.lower()
+        self.subscribers.setdefault(handle, set()).add(bot)
+        since_id = (bot.latest_tweet or {}).get('id')
+        if handle in self.handles:
+            state = self.handles[handle]
+            state['since_id'] = max(state['since_id'], since_id)
+            return
+
+        self.handles[handle] = {
+            'name': name,
+            'since_id': since_id,
+            'interval': TWITTER_POLL_MIN,
+            'polls': 0,
+            'errors': 0,
+            'tweets': 0,
+            'latency': 0.0,
+        }
+        # spread the first polls of handles subscribed at startup like the later ones.
+        job = call_later(1, partial(self.poll, handle), jitter=TWITTER_POLL_MIN * SCHEDULE_JITTER)
+        self.handles[handle]['next_poll'] = job.due
+
+    def unsubscribe(self, bot, handle):
+        """Stop passing tweets of the handle on to the bot."""
+        self.subscribers.get(handle.lower(), set()).discard(bot)
+
+    def poll(self, handle):
+        """Fetch new tweets of a handle in the background, unless nobody is interested anymore."""
+        if not self.subscribers.get(handle):
+            self.subscribers.pop(handle, None)
+            self.handles.pop(handle, None)
+            return
+
+        state = self.handles[handle]
+        worker.submit(self.fetch, (handle, state['since_id']), partial(self.fetched, handle))
+
+    def fetch(self, handle, since_id):
+        """Get new tweets of a handle and measure how long that took. Runs in a worker thread."""
+        start = time.time()
+        timeline = self.timeline.get(handle=handle, previous_id=since_id)
+        return timeline, time.time() - start
+
+    def fetched(self, handle, result):
+        """Hand a new tweet to the subscribed bots and schedule the next poll."""
+        state = self.handles[handle]
+        timeline, latency = result or (False, 0.0)
+        state['polls'] += 1
+        state['latency'] += latency
+
+        if timeline:
+            tweet = timeline[0]
+            tweet = {
+                'handle': state['name'],
+                'id': tweet['id'],
+                'text': ' '.join(HTMLParser.HTMLParser().unescape(tweet['text']).split()),
+            }
+            state['since_id'] = tweet['id']
+            state['tweets'] += 1
+            state['interval'] = TWITTER_POLL_MIN
+            for bot in list(self.subscribers.get(handle, ())):
+                bot.new_tweet(tweet)
+        else:
+            if timeline is False:
+                state['errors'] += 1
+            state['interval'] = min(state['interval'] * TWITTER_POLL_BACKOFF, TWITTER_POLL_MAX)
+
+        interval = max(state['interval'], self.rate_limit_interval())
+        job = call_later(interval, partial(self.poll, handle), jitter=interval * SCHEDULE_JITTER)
+        state['next_poll'] = job.due
+
+    def rate_limit_interval(self):
+        """Return the shortest interval at which all handles can be polled until the rate limit resets."""
+        remaining = self.timeline.rate_limit_remaining
+        reset = self.timeline.rate_limit_reset
+        if remaining is None or reset is None or reset <= time.time():
+            return 0
+        return (reset - time.time()) * len(self.handles) / max(remaining, 1)
+
+    def stats(self, handle):
+        """Return a short description of the polls of a handle."""
+        state = self.handles.get(handle.lower())
+        if state is None:
+            return '@{} is not being polled.'.format(handle)
+        return '@{}: {} polls, {} errors, {} tweets, {:.0f} ms average latency, next poll in {:.0f} s.'.format(
+            handle,
+            state['polls'],
+            state['errors'],
+            state['tweets'],
+            1000 * state['latency'] / max(state['polls'], 1),
+            max(state['next_poll'] - time.time(), 0),
+        )
+
+
+twitter_poller = TwitterPoller(twitter_timeline)
 
 
 # =====================================
@@ -164,16 +1327,22 @@ TWITCH_ACCESS_TOKEN = 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
 
 
 class TwitchAPI(object):
+    """Access to the Twitch API. All bots share one instance, its connections and its cache."""
     api_url = 'https://api.twitch.tv/kraken'
 
     def __init__(self):
-        # set up some authentication
-        pass
-
-    def channel(self, name=None):
+        self.session = None
+        self.cache = {}
+        self.in_flight = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_stale = 0
+        self.coalesced = 0
+
+    def channel(self, name=None, callback=None):
         """Return the channel object (name, followers, subscribers, ...)."""
         endpoint = '/channels/{}'.format(name)
-        return self.get(endpoint=endpoint)
+        return self.get(endpoint=endpoint, callback=callback)
 
     def channel_followers(self, name=None):
         """Return the list of followers of a channel."""
@@ -205,42 +1374,846 @@ class TwitchAPI(object):
         endpoint = '/users/{}/subscriptions/{}/'.format(user, channel)
         return self.get(endpoint=endpoint)
 
-    def stream(self, name=None):
+    def stream(self, name=None, callback=None):
         """Return the stream object (current game, title, viewers, ...)"""
         endpoint = '/streams/{}'.format(name)
-        return self.get(endpoint=endpoint)
+        return self.get(endpoint=endpoint, callback=callback)
+
+    def streams(self, names=None, callback=None):
+        """Return the list of live streams among the given channels."""
+        endpoint = '/streams?channel={}&limit={}'.format(','.join(names), len(names))
+        return self.get(endpoint=endpoint, callback=callback)
 
-    def get(self, endpoint=None):
-        """Perform a get request."""
+    def get(self, endpoint=None, callback=None):
+        """Perform a get request.
+
+        With a callback the request is made by the background worker and the callback is called
+        with the result from the main loop, otherwise the request blocks and returns the result.
+        Background requests use the cache (see TWITCH_API_CACHE_TTL) and a request for a URL that
+        is already being fetched waits for that answer instead of making another request."""
         url = self.api_url + endpoint
-        response, content = self.request(url)
-        if response is 200:
+        if callback is None:
+            return self.fetch(url)
+
+        if url in self.cache:
+            expires, content = self.cache[url]
+            if expires > time.time():
+                self.cache_hits += 1
+                return callback(content)
+            self.cache_stale += 1
+        else:
+            self.cache_misses += 1
+
+        if url in self.in_flight:
+            self.coalesced += 1
+            self.in_flight[url].append(callback)
+            return
+
+        self.in_flight[url] = [callback]
+        worker.submit(self.fetch, (url,), partial(self.fetched, url, endpoint))
+
+    def fetched(self, url, endpoint, content):
+        """Cache the answer of a background request and pass it to everyone waiting for it."""
+        ttl = TWITCH_API_CACHE_TTL.get(endpoint.split('/')[1].partition('?')[0], 0)
+        if content and ttl > 0:
+            self.cache[url] = (time.time() + ttl, content)
+
+        for callback in self.in_flight.pop(url, []):
+            callback(content)
+
+    def stats(self):
+        """Return a short description of the cache of background requests."""
+        return 'Twitch API: {} cache hits, {} misses, {} expired, {} requests coalesced.'.format(
+            self.cache_hits,
+            self.cache_misses,
+            self.cache_stale,
+            self.coalesced,
+        )
+
+    def fetch(self, url):
+        """Return the content of a successful request or False."""
+        try:
+            response, content = self.request(url)
+        except (requests.RequestException, ValueError) as e:
+            debug('Request to {} failed: {}'.format(url, e))
+            return False
+
+        if response == 200:
             return content
         else:
             return False
 
+    def get_session(self):
+        """Return the session with pooled keep-alive connections, create it on first use."""
+        if self.session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            # set up some authentication
+            session.headers.update({
+                'Authorization': 'OAuth {}'.format(TWITCH_ACCESS_TOKEN),
+            })
+            self.session = session
+        return self.session
+
     def request(self, url=None, headers=None, params=None, body=None):
         """Perform the actual request (handle authentication etc.)"""
-        headers = {
-            'Authorization': 'OAuth {}'.format(TWITCH_ACCESS_TOKEN),
-        }
-        response = requests.get(url, headers=headers)
+        response = self.get_session().get(url, headers=headers, timeout=TWITCH_API_TIMEOUT)
         return response.status_code, response.json()
 
 
+twitch_api = TwitchAPI()
+
+
+class StreamPoller(object):
+    """Poll the stream status of all channels with as few requests as possible.
+
+    Channels are queried in batches of STREAM_BATCH_SIZE every STREAM_POLL_INTERVAL seconds and
+    the results are published in streams, where offline channels map to None. Channels are kept
+    in lower case, as Twitch names them, whatever their case in CHANNELS."""
+
+    def __init__(self, api):
+        self.api = api
+        self.channels = []
+        self.streams = {}
+        self.updated = {}
+        self.requests = 0
+        self.pointer = None
+
+    def add(self, channel):
+        """Include a channel in the next poll."""
+        channel = channel.lower()
+        if channel in self.updated or channel in self.channels:
+            return
+        self.channels.append(channel)
+        # start polling shortly, so that all channels added at startup are polled together.
+        if self.pointer is None:
+            self.pointer = call_every(
+                STREAM_POLL_INTERVAL, self.poll, jitter=STREAM_POLL_INTERVAL * SCHEDULE_JITTER, first=1)
+
+    def poll(self):
+        """Request the status of all channels, runs every STREAM_POLL_INTERVAL seconds."""
+        for i in range(0, len(self.channels), STREAM_BATCH_SIZE):
+            batch = self.channels[i:i + STREAM_BATCH_SIZE]
+            self.api.streams(names=batch, callback=partial(self.publish, batch))
+            self.requests += 1
+
+    def publish(self, batch, content):
+        """Update the status of a batch of channels."""
+        if not content:
+            return
+
+        now = time.time()
+        live = dict((stream['channel']['name'].lower(), stream) for stream in content['streams'])
+        for channel in batch:
+            channel = channel.lower()
+            self.streams[channel] = live.get(channel)
+            self.updated[channel] = now
+
+    def remove(self, channel):
+        """Stop polling a channel."""
+        channel = channel.lower()
+        if channel in self.channels:
+            self.channels.remove(channel)
+        self.streams.pop(channel, None)
+        self.updated.pop(channel, None)
+        if not self.channels and self.pointer is not None:
+            cancel(self.pointer)
+            self.pointer = None
+
+    def get(self, channel):
+        """Return a stream answer ({'stream': ...}) from the latest poll, or False if it is outdated."""
+        channel = channel.lower()
+        if time.time() - self.updated.get(channel, 0) > 2 * STREAM_POLL_INTERVAL:
+            return False
+        return {'stream': self.streams[channel]}
+
+
+stream_poller = StreamPoller(twitch_api)
+
+
+# =====================================
+# State stores
+# =====================================
+class Renamed(namedtuple('Renamed', ['old', 'new'])):
+    """Key of a change that renamed an entry of a dict attribute, stores keep its place."""
+
+
+def rename_key(mapping, old, new):
+    """Rename a key of a dict, in the same place if the dict is ordered."""
+    if isinstance(mapping, OrderedDict):
+        items = [(new if key == old else key, value) for key, value in mapping.iteritems() if key != new]
+        mapping.clear()
+        mapping.update(items)
+    elif old in mapping:
+        mapping[new] = mapping.pop(old)
+
+
+def get_change(state, attribute, key=None):
+    """Return a record (attribute, key, present, value) describing the current value of a change.
+
+    Without a key the record describes the whole attribute, with a key it describes a single
+    entry of a dict attribute or the membership of key in a list attribute. With a Renamed key it
+    describes the entry under its new name."""
+    if attribute not in state:
+        return attribute, key, False, None
+
+    value = state[attribute]
+    if key is None:
+        return attribute, key, True, value
+
+    if isinstance(value, dict):
+        if isinstance(key, Renamed):
+            if key.new in value:
+                return attribute, key, True, value[key.new]
+            return attribute, key, False, None
+        if key in value:
+            return attribute, key, True, value[key]
+        return attribute, key, False, None
+
+    return attribute, key, key in value, None
+
+
+def apply_change(state, record):
+    """Apply a record created by get_change() to a state dict."""
+    attribute, key, present, value = record
+    if key is None:
+        if present:
+            state[attribute] = value
+        else:
+            state.pop(attribute, None)
+        return
+
+    container = state.get(attribute)
+    if container is None:
+        return
+
+    if isinstance(container, dict) and isinstance(key, Renamed):
+        if present:
+            rename_key(container, key.old, key.new)
+            container[key.new] = value
+        else:
+            container.pop(key.old, None)
+            container.pop(key.new, None)
+    elif isinstance(container, dict):
+        if present:
+            container[key] = value
+        else:
+            container.pop(key, None)
+    elif isinstance(container, set):
+        if present:
+            container.add(key)
+        else:
+            container.discard(key)
+    elif present:
+        if key not in container:
+            container.append(key)
+    elif key in container:
+        container.remove(key)
+
+
+class PickleStore(object):
+    """Keep the state in a single pickle file that is rewritten on every write."""
+
+    def __init__(self, name):
+        self.path = name
+
+    def load(self):
+        """Return the stored state or None, if there is none."""
+        try:
+            with open(self.path, 'r+') as f:
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def write(self, state, changes):
+        """Write the state. changes is the set of (attribute, key) pairs changed since the last write."""
+        with open(self.path, 'w') as f:
+            pickle.dump(state, f)
+
+
+class JournalStore(PickleStore):
+    """Append changes to a journal and only occasionally rewrite the whole state.
+
+    The state file is a snapshot, the journal next to it holds one pickled get_change() record per
+    change made after the snapshot. Loading replays the journal on top of the snapshot. A truncated
+    or corrupt record at the end of the journal (e.g. after a crash) is cut off, so that later
+    records are appended right after the last good one."""
+
+    def __init__(self, name):
+        super(JournalStore, self).__init__(name)
+        self.journal_path = name + '.journal'
+
+    def load(self):
+        state = super(JournalStore, self).load()
+        try:
+            journal = open(self.journal_path, 'r+b')
+        except IOError:
+            return state
+
+        if state is None:
+            state = {}
+
+        with journal:
+            end = 0
+            while True:
+                try:
+                    attribute, key, present, value = pickle.load(journal)
+                    apply_change(state, (attribute, key, present, value))
+                except Exception:
+                    break
+                end = journal.tell()
+
+            journal.seek(0, os.SEEK_END)
+            if journal.tell() > end:
+                debug('Cutting off a truncated journal of {} after {} bytes.'.format(self.path, end))
+                journal.truncate(end)
+
+        return state or None
+
+    def write(self, state, changes):
+        if (None, None) in changes or not os.path.exists(self.path):
+            return self.compact(state)
+
+        with open(self.journal_path, 'ab') as journal:
+            for attribute, key in changes:
+                pickle.dump(get_change(state, attribute, key), journal, 2)
+            size = journal.tell()
+
+        if size > JOURNAL_MAX_SIZE:
+            self.compact(state)
+
+    def compact(self, state):
+        """Write a new snapshot and start over with an empty journal."""
+        # the old snapshot is only replaced once the new one is complete.
+        with open(self.path + '.tmp', 'wb') as f:
+            pickle.dump(state, f, 2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.path + '.tmp', self.path)
+
+        # replaying records on top of the new snapshot is harmless, should we fail before this.
+        open(self.journal_path, 'wb').close()
+
+
+class SQLiteStore(object):
+    """Keep the state of all bots in one SQLite database and write changes as single rows.
+
+    Roles, counters, custom replies, timers and their run histories and archived runs have tables
+    of their own, every other instance variable is pickled into the attributes table. All bots
+    share one connection."""
+
+    connection = None
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS bots (bot TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS attributes (
+            bot TEXT, name TEXT, value BLOB, PRIMARY KEY (bot, name));
+        CREATE TABLE IF NOT EXISTS ops (bot TEXT, nick TEXT, PRIMARY KEY (bot, nick));
+        CREATE TABLE IF NOT EXISTS regulars (bot TEXT, nick TEXT, PRIMARY KEY (bot, nick));
+        CREATE TABLE IF NOT EXISTS blacklist (bot TEXT, nick TEXT, PRIMARY KEY (bot, nick));
+        CREATE TABLE IF NOT EXISTS counters (
+            bot TEXT, name TEXT, value INTEGER, reply TEXT, PRIMARY KEY (bot, name));
+        CREATE TABLE IF NOT EXISTS custom_replies (
+            bot TEXT, name TEXT, reply TEXT, PRIMARY KEY (bot, name));
+        CREATE TABLE IF NOT EXISTS timers (
+            bot TEXT, name TEXT, position INTEGER, timer BLOB, PRIMARY KEY (bot, name));
+        CREATE INDEX IF NOT EXISTS timers_position ON timers (bot, position);
+        CREATE TABLE IF NOT EXISTS run_history (
+            bot TEXT, name TEXT, history BLOB, PRIMARY KEY (bot, name));
+        CREATE TABLE IF NOT EXISTS runs (
+            bot TEXT, name TEXT, attempt INTEGER, run BLOB, PRIMARY KEY (bot, name, attempt));
+    """
+    role_tables = ('ops', 'regulars', 'blacklist')
+    tables = role_tables + ('counters', 'custom_replies', 'timers', 'run_history', 'runs')
+
+    def __init__(self, name):
+        self.name = name
+        self.db = self.connect()
+
+    @classmethod
+    def connect(cls):
+        """Return the connection shared by all bots, open it on first use."""
+        if cls.connection is None:
+            db = sqlite3.connect(SQLITE_DATABASE)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(cls.schema)
+            cls.connection = db
+        return cls.connection
+
+    def load(self):
+        """Return the stored state, or the state of an old state file which is then imported."""
+        if self.db.execute('SELECT 1 FROM bots WHERE bot = ?', (self.name,)).fetchone() is None:
+            return self.migrate()
+
+        bot = (self.name,)
+        state = dict(
+            (name, pickle.loads(str(value)))
+            for name, value in self.db.execute('SELECT name, value FROM attributes WHERE bot = ?', bot)
+        )
+        for table in self.role_tables:
+            state[table] = set(nick for nick, in self.db.execute('SELECT nick FROM {} WHERE bot = ?'.format(table), bot))
+        state['counters'] = dict(
+            (name, {'value': value, 'reply': reply})
+            for name, value, reply in self.db.execute('SELECT name, value, reply FROM counters WHERE bot = ?', bot)
+        )
+        state['custom_replies'] = dict(
+            self.db.execute('SELECT name, reply FROM custom_replies WHERE bot = ?', bot)
+        )
+        state['timers'] = OrderedDict(
+            (name, pickle.loads(str(timer)))
+            for name, timer in self.db.execute('SELECT name, timer FROM timers WHERE bot = ? ORDER BY position', bot)
+        )
+        state['run_history'] = dict(
+            (name, pickle.loads(str(history)))
+            for name, history in self.db.execute('SELECT name, history FROM run_history WHERE bot = ?', bot)
+        )
+        state['runs'] = dict(
+            ((name, attempt), pickle.loads(str(run)))
+            for name, attempt, run in self.db.execute('SELECT name, attempt, run FROM runs WHERE bot = ?', bot)
+        )
+        return state
+
+    def migrate(self):
+        """Import the state of a bot from its pickle and journal files, if there are any."""
+        state = JournalStore(self.name).load()
+        if state is not None:
+            self.write(state, set([(None, None)]))
+            debug('Imported state of {} into {}.'.format(self.name, SQLITE_DATABASE))
+        return state
+
+    def write(self, state, changes):
+        with self.db:
+            # a bot without rows gets all of its state written, not just what changed.
+            new = self.db.execute('INSERT OR IGNORE INTO bots (bot) VALUES (?)', (self.name,)).rowcount
+            if new or (None, None) in changes:
+                return self.write_all(state)
+            for attribute, key in changes:
+                self.write_change(get_change(state, attribute, key), state)
+
+    def write_all(self, state):
+        """Replace all rows of the bot with the given state."""
+        bot = (self.name,)
+        self.db.execute('DELETE FROM attributes WHERE bot = ?', bot)
+        for table in self.tables:
+            self.db.execute('DELETE FROM {} WHERE bot = ?'.format(table), bot)
+
+        for attribute, value in state.iteritems():
+            if attribute not in self.tables:
+                self.write_attribute(attribute, value)
+                continue
+            keys = value.keys() if isinstance(value, dict) else value
+            for key in keys:
+                self.write_change(get_change(state, attribute, key), state)
+
+    def write_change(self, record, state):
+        """Write a single record created by get_change()."""
+        attribute, key, present, value = record
+        if attribute not in self.tables:
+            return self.write_attribute(attribute, state.get(attribute))
+        if key is None:
+            # a whole table changed, e.g. a list of roles has been replaced.
+            self.db.execute('DELETE FROM {} WHERE bot = ?'.format(attribute), (self.name,))
+            keys = value.keys() if isinstance(value, dict) else value or []
+            for key in keys:
+                self.write_change(get_change(state, attribute, key), state)
+            return
+        if isinstance(key, Renamed):
+            # a renamed timer keeps its position, other rows are written under the new name.
+            if present and attribute == 'timers':
+                self.db.execute('DELETE FROM timers WHERE bot = ? AND name = ?', (self.name, key.new))
+                updated = self.db.execute(
+                    'UPDATE timers SET name = ?, timer = ? WHERE bot = ? AND name = ?',
+                    (key.new, sqlite3.Binary(pickle.dumps(value, 2)), self.name, key.old)
+                )
+                if updated.rowcount:
+                    return
+            self.write_change(get_change(state, attribute, key.old), state)
+            return self.write_change(get_change(state, attribute, key.new), state)
+
+        if not present and attribute == 'runs':
+            self.db.execute('DELETE FROM runs WHERE bot = ? AND name = ? AND attempt = ?', (self.name,) + key)
+        elif not present:
+            column = 'nick' if attribute in self.role_tables else 'name'
+            self.db.execute('DELETE FROM {} WHERE bot = ? AND {} = ?'.format(attribute, column), (self.name, key))
+        elif attribute in self.role_tables:
+            self.db.execute('INSERT OR IGNORE INTO {} (bot, nick) VALUES (?, ?)'.format(attribute), (self.name, key))
+        elif attribute == 'counters':
+            self.db.execute(
+                'INSERT OR REPLACE INTO counters (bot, name, value, reply) VALUES (?, ?, ?, ?)',
+                (self.name, key, value['value'], value['reply'])
+            )
+        elif attribute == 'custom_replies':
+            self.db.execute(
+                'INSERT OR REPLACE INTO custom_replies (bot, name, reply) VALUES (?, ?, ?)',
+                (self.name, key, value)
+            )
+        elif attribute == 'timers':
+            timer = sqlite3.Binary(pickle.dumps(value, 2))
+            updated = self.db.execute(
+                'UPDATE timers SET timer = ? WHERE bot = ? AND name = ?',
+                (timer, self.name, key)
+            )
+            if not updated.rowcount:
+                self.db.execute(
+                    'INSERT INTO timers (bot, name, position, timer) '
+                    'SELECT ?, ?, COALESCE(MAX(position), 0) + 1, ? FROM timers WHERE bot = ?',
+                    (self.name, key, timer, self.name)
+                )
+        elif attribute == 'run_history':
+            self.db.execute(
+                'INSERT OR REPLACE INTO run_history (bot, name, history) VALUES (?, ?, ?)',
+                (self.name, key, sqlite3.Binary(pickle.dumps(value, 2)))
+            )
+        elif attribute == 'runs':
+            self.db.execute(
+                'INSERT OR REPLACE INTO runs (bot, name, attempt, run) VALUES (?, ?, ?, ?)',
+                (self.name,) + key + (sqlite3.Binary(pickle.dumps(value, 2)),)
+            )
+
+    def write_attribute(self, attribute, value):
+        """Pickle an instance variable into the attributes table."""
+        self.db.execute(
+            'INSERT OR REPLACE INTO attributes (bot, name, value) VALUES (?, ?, ?)',
+            (self.name, attribute, sqlite3.Binary(pickle.dumps(value, 2)))
+        )
+
+
+STATE_STORES = {
+    'pickle': PickleStore,
+    'journal': JournalStore,
+    'sqlite': SQLiteStore,
+}
+
+
+# =====================================
+# Rate limiting
+# =====================================
+class RateLimiter(object):
+    """Limit events per key within a sliding window of period seconds.
+
+    The window is approximated from the counts of the current and the previous fixed window, so
+    every key takes constant time and memory. At most max_keys keys are kept, the least recently
+    used are forgotten first and keys without events in the last two windows expire. Windows are
+    on the monotonic() clock, so setting the system time doesn't reset or extend them."""
+
+    def __init__(self, period, max_keys):
+        self.period = float(period)
+        self.max_keys = max_keys
+        self.windows = OrderedDict()
+
+    def allow(self, key, rate, count=True):
+        """Count an event for the key and return True, or return False if the rate is exceeded.
+        With count False the event is only checked, not counted."""
+        now = monotonic() / self.period
+        window = int(now)
+        previous = current = 0
+        entry = self.windows.pop(key, None)
+        if entry is not None:
+            if entry[0] == window:
+                previous, current = entry[1], entry[2]
+            elif entry[0] == window - 1:
+                previous = entry[2]
+
+        allowed = previous * (1 - (now - window)) + current < rate
+        if allowed and count:
+            current += 1
+        self.windows[key] = (window, previous, current)
+
+        # the oldest keys are at the front, drop them if they are too many or expired.
+        while len(self.windows) > self.max_keys or self.windows[next(iter(self.windows))][0] < window - 1:
+            self.windows.popitem(last=False)
+        return allowed
+
+    def __len__(self):
+        return len(self.windows)
+
+
+# =====================================
+# Instrumentation
+# =====================================
+class Metrics(object):
+    """Call counts, error counts and latency histograms of operations, per channel.
+
+    Operations are recorded from the main loop and the worker threads, hence the lock."""
+
+    def __init__(self, buckets=STATS_BUCKETS):
+        self.buckets = buckets
+        self.series = {}
+        self.lock = thread.allocate_lock()
+
+    def record(self, channel, operation, seconds, error=False):
+        """Count a call of an operation that took the given seconds."""
+        with self.lock:
+            series = self.series.get((channel, operation))
+            if series is None:
+                series = self.series[(channel, operation)] = [0, 0, 0.0, [0] * (len(self.buckets) + 1)]
+            series[0] += 1
+            series[1] += error
+            series[2] += seconds
+            series[3][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def quantile(self, histogram, q):
+        """Return the upper bound of the bucket the q-quantile of a histogram falls in."""
+        rank = q * sum(histogram)
+        seen = 0
+        for bound, observations in zip(self.buckets + (float('inf'),), histogram):
+            seen += observations
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self, channel, limit=5):
+        """Return a line about the operations of a channel (or the API clients, channel '') that
+        took the most time."""
+        with self.lock:
+            series = sorted(((key[1], value[:3] + [list(value[3])]) for key, value in self.series.items()
+                             if key[0] == channel), key=lambda item: -item[1][2])
+        if not series:
+            return 'Nothing recorded yet.'
+        return ' | '.join('{}: {} calls, {} errors, avg {:.2f} ms, p99 < {:g} ms'.format(
+            operation,
+            calls,
+            errors,
+            total / calls * 1000,
+            self.quantile(histogram, 0.99) * 1000,
+        ) for operation, (calls, errors, total, histogram) in series[:limit])
+
+    def prometheus(self):
+        """Return all series in the Prometheus text format."""
+        with self.lock:
+            series = sorted((key, value[:3] + [list(value[3])]) for key, value in self.series.items())
+        series = [('channel="{}",operation="{}"'.format(*key), value) for key, value in series]
+
+        lines = [
+            '# HELP twitchbot_calls_total Calls of an operation.',
+            '# TYPE twitchbot_calls_total counter',
+        ]
+        lines.extend('twitchbot_calls_total{{{}}} {}'.format(labels, calls) for labels, (calls, _, _, _) in series)
+        lines.extend([
+            '# HELP twitchbot_errors_total Calls of an operation that raised an exception.',
+            '# TYPE twitchbot_errors_total counter',
+        ])
+        lines.extend('twitchbot_errors_total{{{}}} {}'.format(labels, errors) for labels, (_, errors, _, _) in series)
+        lines.extend([
+            '# HELP twitchbot_latency_seconds Time an operation took.',
+            '# TYPE twitchbot_latency_seconds histogram',
+        ])
+        for labels, (calls, errors, total, histogram) in series:
+            cumulative = 0
+            for bound, observations in zip(self.buckets + ('+Inf',), histogram):
+                cumulative += observations
+                lines.append('twitchbot_latency_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+            lines.append('twitchbot_latency_seconds_sum{{{}}} {!r}'.format(labels, total))
+            lines.append('twitchbot_latency_seconds_count{{{}}} {}'.format(labels, calls))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the Prometheus text to a file, replacing it atomically so it is never read half-written."""
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.rename(path + '.tmp', path)
+
+
+metrics = Metrics()
+
+
+def timed(operation, func):
+    """Wrap a method so its calls are recorded in metrics, for the channel (name) of the instance."""
+    @wraps(func)
+    def wrap(self, *args, **kwargs):
+        start = time.time()
+        error = True
+        try:
+            result = func(self, *args, **kwargs)
+            error = False
+            return result
+        finally:
+            metrics.record(getattr(self, 'name', ''), operation, time.time() - start, error)
+    wrap.operation = operation
+    return wrap
+
+
+class Profiler(object):
+    """Sample the stack of the main loop for a bounded window and keep the slowest dispatches.
+
+    A background thread looks at the stack of the main thread every interval seconds (with
+    sys._current_frames()) and counts the stacks it sees. The main thread is neither traced nor
+    interrupted, so profiling costs it about as much as a thread switch per sample. dispatch() of
+    the bot classes is only wrapped while profiling, otherwise nothing is timed."""
+
+    def __init__(self, top=PROFILE_TOP, interval=PROFILE_INTERVAL):
+        self.top = top
+        self.interval = interval
+        self.stacks = None
+        self.samples = 0
+        self.lock = thread.allocate_lock()
+        self.thread = None
+        self.stopped = None
+        self.classes = {}
+        self.slowest = []
+        self.started = None
+        self.elapsed = 0
+        self.job = None
+
+    @property
+    def running(self):
+        return self.started is not None
+
+    def start(self, classes, seconds):
+        """Profile for seconds and time the dispatches of the bot classes. Return False if already running."""
+        if self.running:
+            return False
+
+        self.slowest = []
+        for cls in classes:
+            self.classes[cls] = cls.__dict__.get('dispatch')
+            cls.dispatch = self.timed_dispatch(cls.dispatch.im_func)
+        self.job = call_later(seconds, self.stop)
+        self.started = time.time()
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample, args=(threading.current_thread().ident, self.stopped))
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """Stop profiling and unwrap dispatch(). Return False if not running."""
+        if not self.running:
+            return False
+
+        self.stopped.set()
+        self.thread.join()
+        cancel(self.job)
+        for cls, dispatch in self.classes.items():
+            if dispatch is None:
+                del cls.dispatch
+            else:
+                cls.dispatch = dispatch
+        self.classes = {}
+        self.elapsed = time.time() - self.started
+        self.started = None
+        return True
+
+    def sample(self, thread_id, stopped):
+        """Count the stack of the main thread every interval seconds until stopped, in the sampling thread.
+
+        Stacks are kept as tuples of code objects, outermost first. There is no stack while the
+        main thread is outside of Python (e.g. in WeeChat), those samples are left out. This thread
+        gets the GIL more often where the main thread releases it, so calls into C that do that
+        (I/O, ctypes) show up more than their share."""
+        while not stopped.is_set():
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            with self.lock:
+                self.stacks[tuple(stack)] += 1
+                self.samples += 1
+
+    def timed_dispatch(self, dispatch):
+        """Wrap dispatch() to keep the top slowest calls in a heap."""
+        @wraps(dispatch)
+        def wrap(bot, sender, message):
+            start = time.time()
+            try:
+                return dispatch(bot, sender, message)
+            finally:
+                entry = (time.time() - start, bot.name, sender.nick, message)
+                if len(self.slowest) < self.top:
+                    heapq.heappush(self.slowest, entry)
+                else:
+                    heapq.heappushpop(self.slowest, entry)
+        return wrap
+
+    def dump(self, path):
+        """Write the sampled stacks in the folded format. Return False if nothing was profiled yet."""
+        if self.stacks is None:
+            return False
+        with self.lock:
+            stacks = self.stacks.items()
+        lines = sorted('{} {}\n'.format(';'.join(
+            '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            for code in stack), samples) for stack, samples in stacks)
+        with open(path, 'w') as f:
+            f.writelines(lines)
+        return True
+
+    def summary(self, limit=5):
+        """Return a line about the slowest dispatches, short enough for chat."""
+        if not self.slowest:
+            return 'No dispatches timed.'
+        return ' | '.join('{:.2f} ms {} {}: {}'.format(seconds * 1000, channel, nick, message[:40])
+                          for seconds, channel, nick, message in sorted(self.slowest, reverse=True)[:limit])
+
+
+profiler = Profiler()
+
+
 # =====================================
 # Timer object
 # =====================================
 class Timer(object):
-    """Simple Timer object, to measure times and keep split times."""
+    """Simple Timer object, to measure times and keep split times.
+
+    Times are seconds on the monotonic() clock, so changes of the system time don't affect running
+    timers. Splits are kept in lists in the order they were made, with their positions indexed by
+    name. Removed splits leave a gap until more than half are gaps, so every split operation is
+    O(1) (amortised). Pickles store the start of running timers in wall-clock time, since monotonic
+    time doesn't survive a restart."""
+
+    __slots__ = ('name', 'running', 'origin', 'final', 'names', 'times', 'index', 'removed')
 
     def __init__(self, name="timer"):
         """Initialise the timer."""
         self.name = name
         self.running = False
-        self.splits = OrderedDict()
-        self.start_time = None
-        self.stop_time = None
+        self.origin = None  # monotonic() when the elapsed time was 0, while running
+        self.final = None  # the elapsed seconds, once stopped
+        self.clear_splits()
+
+    def __getstate__(self):
+        if self.running:
+            when = time.time() - self.elapsed_seconds
+        else:
+            when = self.final
+        names, times = zip(*self.iter_split_seconds()) or ((), ())
+        return (self.name, self.running, when, names, times)
+
+    def __setstate__(self, state):
+        self.clear_splits()
+        if isinstance(state, dict):
+            self.load_datetimes(state)
+            return
+
+        self.name, self.running, when, names, times = state
+        self.origin = monotonic() - (time.time() - when) if self.running else None
+        self.final = None if self.running else when
+        for name, seconds in zip(names, times):
+            self.add_split(name, seconds)
+
+    def load_datetimes(self, state):
+        """Take over the state of a Timer pickled before timers had slots, which kept datetimes."""
+        self.name = state.get('name', 'timer')
+        self.running = state.get('running', False)
+        start_time, stop_time = state.get('start_time'), state.get('stop_time')
+        self.origin = self.final = None
+        if self.running:
+            self.origin = monotonic() - (datetime.utcnow() - start_time).total_seconds()
+        elif start_time is not None and stop_time is not None:
+            self.final = (stop_time - start_time).total_seconds()
+        for name, delta in state.get('splits', {}).items():
+            self.add_split(name, delta.total_seconds())
 
     # =====================================
     # Logic
@@ -248,38 +2221,46 @@ class Timer(object):
     def add(self, seconds=0):
         """Add seconds to the timer by shifting the start time."""
         if seconds != 0:
-            delta = timedelta(seconds=seconds)
-            self.start_time = self.start_time - delta
+            if self.running:
+                self.origin -= seconds
+            elif self.stopped:
+                self.final += seconds
+            else:
+                return False
             return True
 
     def adjustsplit(self, name, seconds=0):
         """Make slight adjustments to existing splits."""
-        if name not in self.splits.keys():
+        if name not in self.index:
             return False
 
         if seconds != 0:
-            delta = timedelta(seconds=seconds)
-            self.splits[name] += delta
+            self.times[self.index[name]] += seconds
 
         return True
 
     def set(self, seconds=0):
         """Set timer to a specific elapsed time (in seconds)."""
         if seconds != 0:
-            delta = timedelta(seconds=seconds)
-            self.start_time = datetime.utcnow() - delta
+            if self.running:
+                self.origin = monotonic() - seconds
+            elif self.stopped:
+                self.final = seconds
+            else:
+                return False
             return True
 
     def start(self):
         """Start the timer."""
-        self.start_time = datetime.utcnow()
-        self.stop_time = None
+        self.origin = monotonic()
+        self.final = None
         self.running = True
         return True
 
     def stop(self):
         """Stop the timer."""
-        self.stop_time = datetime.utcnow()
+        self.final = self.elapsed_seconds
+        self.origin = None
         self.running = False
         return True
 
@@ -288,80 +2269,298 @@ class Timer(object):
         if not self.running:
             return False
 
-        self.splits[name] = self.elapsed
+        if name in self.index:
+            self.times[self.index[name]] = self.elapsed_seconds
+        else:
+            self.add_split(name, self.elapsed_seconds)
         return True
 
+    def add_split(self, name, seconds):
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self.times.append(seconds)
+
+    def clear_splits(self):
+        self.names = []
+        self.times = []
+        self.index = {}
+        self.removed = 0
+
     def removesplit(self, name):
         """Remove a split from the timer."""
-        if name not in self.splits.keys():
+        if name not in self.index:
             return False
 
-        self.splits.pop(name)
+        position = self.index.pop(name)
+        self.names[position] = self.times[position] = None
+        self.removed += 1
+        if self.removed > len(self.index):
+            splits = list(self.iter_split_seconds())
+            self.clear_splits()
+            for name, seconds in splits:
+                self.add_split(name, seconds)
         return True
 
     def renamesplit(self, oldname, newname):
         """Rename a split."""
-        if oldname not in self.splits.keys():
+        if oldname not in self.index or newname in self.index:
             return False
 
-        self.splits = OrderedDict((newname if k == oldname else k, v) for k, v in self.splits.items())
+        position = self.index[newname] = self.index.pop(oldname)
+        self.names[position] = newname
+        return True
 
     def restart(self):
         """Restart the timer."""
-        self.start_time = datetime.utcnow()
-        self.splits = OrderedDict()
-        self.stop_time = None
-        self.running = True
-        return True
+        self.clear_splits()
+        return self.start()
 
     def resplit(self, name):
         """Recreate a split."""
         if not self.running:
             return False
 
-        if name not in self.splits.keys():
+        if name not in self.index:
             return False
 
-        self.splits[name] = self.elapsed
+        self.times[self.index[name]] = self.elapsed_seconds
         return True
 
     # =====================================
     # Information
     # =====================================
     def has_split(self, name):
-        return name in self.splits.keys()
+        return name in self.index
 
     def get_split(self, name):
-        return self.splits[name]
+        return timedelta(seconds=self.times[self.index[name]])
+
+    def iter_split_seconds(self):
+        """Yield the (name, seconds) of the splits in the order they were made."""
+        for name, seconds in zip(self.names, self.times):
+            if name is not None:
+                yield name, seconds
+
+    @property
+    def last_split(self):
+        """Return the (name, seconds) of the latest split, or None."""
+        position = len(self.names) - 1
+        while position >= 0 and self.names[position] is None:
+            position -= 1
+        if position < 0:
+            return None
+        return self.names[position], self.times[position]
+
+    @property
+    def elapsed_seconds(self):
+        """Return the elapsed seconds on the timer, or None if it wasn't started."""
+        if self.running:
+            return monotonic() - self.origin
+        return self.final
 
     @property
     def elapsed(self):
         """Return the elapsed time on the timer."""
-        if self.running:
-            return datetime.utcnow() - self.start_time
-        elif self.stopped:
-            return self.stop_time - self.start_time
+        if self.running or self.stopped:
+            return timedelta(seconds=self.elapsed_seconds)
         else:
             return False
 
     @property
     def has_splits(self):
         """Return if there are splits."""
-        return len(self.splits) > 0
+        return len(self.index) > 0
 
     @property
     def stopped(self):
         """Return if the timer has been stopped."""
-        return self.stop_time is not None
+        return self.final is not None
 
     @property
     def splits_string(self):
         if self.has_splits:
-            return ", ".join(['{}: {}'.format(n, t) for n, t in self.splits.items()])
+            return ", ".join(['{}: {}'.format(n, timedelta(seconds=t)) for n, t in self.iter_split_seconds()])
         else:
             return False
 
 
+NAN = float('nan')
+
+
+class RunHistory(object):
+    """Past runs of a timer, with the personal best and the best segments of all of them.
+
+    Split times are kept in one array per split name (a column, NaN where a run didn't have that
+    split) and the final times in another, for the latest RUN_HISTORY_SIZE runs. Older runs are
+    dropped a tenth of that at a time, together with the splits none of the kept runs has. The
+    personal best and the best segments are updated as runs are added, so queries never go through
+    the runs."""
+
+    __slots__ = ('route', 'positions', 'columns', 'finals', 'attempts', 'best', 'best_finish', 'pb', 'pb_splits',
+                 'pb_attempt', 'saved')
+
+    def __init__(self):
+        self.route = []  # split names in the order of their columns
+        self.positions = {}
+        self.columns = []
+        self.finals = array('d')
+        self.attempts = 0
+        self.best = {}  # best segment seconds, by split name
+        self.best_finish = None  # best segment from the last split to the end
+        self.pb = None
+        self.pb_splits = {}
+        self.pb_attempt = None
+        self.saved = 0  # attempts when the history was last written as a whole
+
+    def __getstate__(self):
+        return (self.route, [column.tostring() for column in self.columns], self.finals.tostring(),
+                self.attempts, self.best, self.best_finish, self.pb, self.pb_splits, self.pb_attempt, self.saved)
+
+    def __setstate__(self, state):
+        if len(state) == 9:
+            state += (state[3],)
+        (self.route, columns, finals, self.attempts, self.best, self.best_finish,
+         self.pb, self.pb_splits, self.pb_attempt, self.saved) = state
+        self.columns = [array('d', column) for column in columns]
+        self.finals = array('d', finals)
+        self.positions = dict((name, position) for position, name in enumerate(self.route))
+
+    def add(self, splits, final=None):
+        """Archive a run, given its (name, seconds) splits in order and its final time (None for
+        a run that was reset), and update the personal best and best segments."""
+        times = dict(splits)
+        for name, _ in splits:
+            if name not in self.positions:
+                self.positions[name] = len(self.route)
+                self.route.append(name)
+                self.columns.append(array('d', [NAN]) * len(self.finals))
+        for name, column in zip(self.route, self.columns):
+            column.append(times.get(name, NAN))
+        self.finals.append(NAN if final is None else final)
+        self.attempts += 1
+
+        # a segment counts if the split before it in the run is also the one before it in the route.
+        previous, position = 0.0, 0
+        for name, seconds in splits:
+            if self.positions[name] == position and seconds >= previous:
+                segment = seconds - previous
+                if segment < self.best.get(name, float('inf')):
+                    self.best[name] = segment
+            previous, position = seconds, self.positions[name] + 1
+        if final is not None and position == len(self.route) and final >= previous:
+            if self.best_finish is None or final - previous < self.best_finish:
+                self.best_finish = final - previous
+
+        if final is not None and (self.pb is None or final < self.pb):
+            self.pb = final
+            self.pb_splits = times
+            self.pb_attempt = self.attempts
+
+        if len(self.finals) > RUN_HISTORY_SIZE + RUN_HISTORY_SIZE // 10:
+            self.trim()
+
+    def trim(self):
+        """Drop the oldest runs beyond RUN_HISTORY_SIZE and the splits that none of the rest has."""
+        excess = len(self.finals) - RUN_HISTORY_SIZE
+        del self.finals[:excess]
+        kept = []
+        for name, column in zip(self.route, self.columns):
+            del column[:excess]
+            if any(seconds == seconds for seconds in column):  # NaN != NaN
+                kept.append((name, column))
+            else:
+                self.best.pop(name, None)
+        self.route = [name for name, _ in kept]
+        self.columns = [column for _, column in kept]
+        self.positions = dict((name, position) for position, name in enumerate(self.route))
+
+    @property
+    def sum_of_best(self):
+        """Return the sum of the best segments, or None unless every segment has a best time."""
+        if self.best_finish is None or any(name not in self.best for name in self.route):
+            return None
+        return sum(self.best[name] for name in self.route) + self.best_finish
+
+    def delta(self, name, seconds):
+        """Return how far ahead (negative) or behind the personal best a split time is, or None."""
+        if name not in self.pb_splits:
+            return None
+        return seconds - self.pb_splits[name]
+
+
+def signed_time(seconds):
+    """Format seconds as a time with a sign, e.g. -0:00:12.500000."""
+    return '{}{}'.format('-' if seconds < 0 else '+', timedelta(seconds=abs(seconds)))
+
+
+# =====================================
+# Reply templates
+# =====================================
+class Template(object):
+    """A reply with variables, parsed once when it is defined.
+
+    $user, $count, $channel, $uptime, $game and $random(a|b|c) are replaced when the reply is said,
+    $$ is a dollar sign and unknown variables are kept as they are. In counter replies {} is the
+    count as well, as counter replies were str.format() strings before."""
+
+    __slots__ = ('text', 'parts', 'slots', 'needs_stream')
+
+    variables = frozenset(['user', 'count', 'channel', 'uptime', 'game'])
+    pattern = re.compile(r'\$(?:random\(([^)]*)\)|(\w+)|(\$))')
+    counter_pattern = re.compile(r'\$(?:random\(([^)]*)\)|(\w+)|(\$))|(\{\{|\}\}|\{0?\})')
+
+    def __init__(self, text, counter=False):
+        self.text = text
+        self.parts = []  # literal text, None where a variable goes
+        self.slots = []  # (index in parts, variable, random choices)
+        literal = []
+        position = 0
+        for match in (self.counter_pattern if counter else self.pattern).finditer(text):
+            choices, variable, dollar = match.group(1, 2, 3)
+            braces = match.group(4) if counter else None
+            literal.append(text[position:match.start()])
+            position = match.end()
+            if dollar:
+                literal.append('$')
+            elif braces in ('{{', '}}'):
+                literal.append(braces[0])
+            elif braces or variable in self.variables or choices is not None:
+                self.parts.append(''.join(literal))
+                literal = []
+                if choices is not None:
+                    choices = tuple(choices.split('|'))
+                self.slots.append((len(self.parts), variable or 'count', choices))
+                self.parts.append(None)
+            else:
+                literal.append(match.group(0))
+        literal.append(text[position:])
+        self.parts.append(''.join(literal))
+        self.needs_stream = any(variable in ('uptime', 'game') for _, variable, _ in self.slots)
+
+    def render(self, values):
+        """Return the text with the variables replaced by values (a dict of strings)."""
+        if not self.slots:
+            return self.parts[0]
+        text = self.parts[:]
+        for index, variable, choices in self.slots:
+            if choices is not None:
+                text[index] = random.choice(choices)
+            else:
+                text[index] = values.get(variable, '$' + variable)
+        return ''.join(text)
+
+
+def stream_values(stream):
+    """Return the $uptime and $game of a stream answer, like the one get_stream() passes on."""
+    if not stream:
+        return {'uptime': 'unknown', 'game': 'unknown'}
+    if stream['stream'] is None:
+        return {'uptime': 'offline', 'game': 'offline'}
+    created = datetime.strptime(stream['stream']['created_at'], '%Y-%m-%dT%H:%M:%SZ')
+    uptime = timedelta(seconds=int((datetime.utcnow() - created).total_seconds()))
+    return {'uptime': str(uptime), 'game': (stream['stream']['game'] or 'nothing').encode('utf-8')}
+
+
 # =====================================
 # Decorators
 # =====================================
@@ -372,6 +2571,7 @@ def require_owner(func):
         if not self.can_use_owner(kwargs['sender']):
             return
         return func(self, *args, **kwargs)
+    wrap.permission = 'owner'
     return wrap
 
 
@@ -382,6 +2582,7 @@ def require_op(func):
         if not self.can_use_op(kwargs['sender']):
             return False
         return func(self, *args, **kwargs)
+    wrap.permission = 'op'
     return wrap
 
 
@@ -392,68 +2593,266 @@ def require_regular(func):
         if not self.can_use_regular(kwargs['sender']):
             return False
         return func(self, *args, **kwargs)
+    wrap.permission = 'regular'
     return wrap
 
 
+# =====================================
+# Command registry
+# =====================================
+Command = namedtuple('Command', ['method', 'permission'])
+
+
+class CommandRegistry(type):
+    """Metaclass that collects the commands of a bot class once, when the class is created.
+
+    Every command_<name> method is a command, <name>_<action> methods are the actions of
+    that command (e.g. timer_new for "timer new") and help_<name> methods provide help
+    for a command. The registry is rebuilt for every subclass, so mixins added to Bot are
+    picked up automatically."""
+
+    def __init__(cls, name, bases, namespace):
+        super(CommandRegistry, cls).__init__(name, bases, namespace)
+        attributes = dir(cls)
+
+        cls._commands = {}
+        cls._helps = {}
+        for attribute in attributes:
+            if attribute.startswith('command_'):
+                cls._commands[attribute[len('command_'):]] = cls.make_command(attribute)
+            elif attribute.startswith('help_'):
+                cls._helps[attribute[len('help_'):]] = cls.make_command(attribute)
+        cls._command_names = sorted(cls._commands)
+
+        # help_<name> methods are help texts, not actions of the help command.
+        cls._actions = {}
+        for command in cls._command_names:
+            if command == 'help':
+                continue
+            prefix = command + '_'
+            actions = dict(
+                (attribute[len(prefix):], cls.make_command(attribute))
+                for attribute in attributes
+                if attribute.startswith(prefix)
+            )
+            if actions:
+                cls._actions[command] = actions
+
+    def __call__(cls, *args, **kwargs):
+        """Create a bot, then let it write what changed while it was loading its state."""
+        bot = super(CommandRegistry, cls).__call__(*args, **kwargs)
+        bot.setup_done()
+        return bot
+
+    def make_command(cls, attribute):
+        """Return the registry entry for a method, including the permission required to use it."""
+        return Command(method=attribute, permission=getattr(getattr(cls, attribute), 'permission', None))
+
+
 # =====================================
 # Bot objects
 # =====================================
 class BaseBot(object):
     """Bot functionality."""
+    __metaclass__ = CommandRegistry
 
     # Stuff needed for initialisation:
     # --------------------------------
     def __init__(self, *args, **kwargs):
         self.name = kwargs.pop('name')
+        self.store = STATE_STORES[STATE_BACKEND](self.name)
+        self.changes = set()
+        self.pending_saves = 0
+        self.saves_requested = 0
+        self.saves_written = 0
+        self.cooldowns = RateLimiter(COOLDOWN_PERIOD, COOLDOWN_MAX_USERS)
+        self.op_cooldowns = RateLimiter(COOLDOWN_PERIOD, COOLDOWN_MAX_USERS)
+        self.cooldown_rejections = 0
+        self.reply_priority = PRIORITY_NORMAL
+        self.roles = {}
         if not self.load():
-            self.owner = []
-            self.ops = []
-            self.regulars = []
-            self.blacklist = []
+            self.owner = set()
+            self.ops = set()
+            self.regulars = set()
+            self.blacklist = set()
             self.muted = False
             self.previous_response = ''
             self.previous_response_time = None
             self.previous_response_time = datetime.utcnow()
+            self.template_replies = True
+        self.setup_routes()
+
+    def setup_routes(self):
+        """Build the routing table that maps every command name to the callable handling it.
+
+        Built-in commands come from the class registry, mixins extend this method to add their
+        own commands (custom replies, counters, ...) after calling super()."""
+        self.routes = dict((name, self.get_command(name)) for name in self._command_names)
+
+    def add_route(self, name, handler):
+        """Route a command name to a handler. Return False if the name is already taken."""
+        if name in self.routes:
+            return False
+        self.routes[name] = handler
+        return True
+
+    def remove_route(self, name):
+        """Remove a command name from the routing table."""
+        self.routes.pop(name, None)
+
+    def save(self, attribute=None, key=None):
+        """Mark the state as changed and schedule writing it to disk.
+
+        attribute names the instance variable that changed and key the changed entry (of a dict) or
+        member (of a list) of it, so stores can write just that. Without arguments everything is
+        written."""
+        self.mark_changed(attribute, key)
+        if SAVE_DELAY <= 0 or self.pending_saves >= SAVE_MAX_CHANGES:
+            return self.flush()
+        self.schedule_flush(SAVE_DELAY)
+
+    def mark_changed(self, attribute=None, key=None):
+        """Mark the state as changed without scheduling a write, like save() does.
+
+        Used while loading, the bot isn't set up far enough to be written yet. The changes are written
+        by setup_done(), or with the next save()."""
+        self.changes.add((attribute, key))
+        self.saves_requested += 1
+        self.pending_saves += 1
+
+    def setup_done(self):
+        """Write the changes made while loading, called once the bot is fully set up."""
+        self.flush()
+
+    def schedule_flush(self, delay):
+        """Call flush() after delay seconds. Without an event loop to schedule on, flush right away."""
+        self.flush()
+
+    def flush(self):
+        """Write instance variables to the state store, if there are pending changes."""
+        if not self.pending_saves:
+            return False
 
-    def save(self):
-        """Pickle instance variables dict and save it to a file."""
         state = self.__dict__.copy()
         state = self.clean_state(state)
-        with open(self.name, 'w') as f:
-            pickle.dump(state, f)
+        self.store.write(state, self.changes)
+
+        debug('Saved state of {} ({} changes).'.format(self.name, self.pending_saves))
+        self.changes = set()
+        self.pending_saves = 0
+        self.saves_written += 1
+        return True
+
+    def rename_entry(self, attribute, old, new):
+        """Rename an entry of a dict attribute, in the same place if the dict is ordered.
+
+        The rename is written on its own, so that stores apply it after the changes before it and
+        before those after it."""
+        self.flush()
+        rename_key(getattr(self, attribute), old, new)
+        self.save(attribute, Renamed(old, new))
+        self.flush()
+
+    @property
+    def saves_coalesced(self):
+        """Return the number of changes that did not need a write of their own."""
+        return self.saves_requested - self.saves_written
 
     def load(self):
-        """Load state from a file and unpickle instance variables."""
-        try:
-            with open(self.name, 'r+') as f:
-                state = pickle.load(f)
-                self.__dict__.update(state)
-            debug('Successfully loaded state.')
-            return True
-        except:
+        """Load instance variables from the state store."""
+        state = self.store.load()
+        if state is None:
             return False
 
+        self.__dict__.update(state)
+        # roles used to be stored as lists.
+        for attribute in ('owner', 'ops', 'regulars', 'blacklist'):
+            if isinstance(getattr(self, attribute, None), list):
+                setattr(self, attribute, set(getattr(self, attribute)))
+        # replies saved before they were templates say a $ as it is.
+        if 'template_replies' not in state:
+            self.escape_replies()
+            self.template_replies = True
+            self.mark_changed('template_replies')
+        debug('Successfully loaded state.')
+        return True
+
+    def reload(self):
+        """Load the state again, e.g. after another process changed it."""
+        self.flush()
+        self.load()
+        self.forget_role()
+        self.setup_routes()
+        self.setup_done()
+
+    def close(self):
+        """Stop the bot. Mixins extend this to let go of what they subscribed to."""
+        self.flush()
+
+    def escape_replies(self):
+        """Escape the $ in replies from before they were templates. Mixins with replies extend this.
+
+        This is called while loading, changes are marked with mark_changed()."""
+        pass
+
     def clean_state(self, state):
         """Remove some instance variables from state that would not survive loading (if any)."""
+        state.pop('routes', None)
+        state.pop('store', None)
+        state.pop('changes', None)
+        state.pop('pending_saves', None)
+        state.pop('saves_requested', None)
+        state.pop('saves_written', None)
+        state.pop('cooldowns', None)
+        state.pop('op_cooldowns', None)
+        state.pop('cooldown_rejections', None)
+        state.pop('reply_priority', None)
+        state.pop('roles', None)
         return state
 
     # Authentication methods
     # --------------------------------
     def get_owner(self):
-        """Return the list of owners for the current channel."""
-        return getattr(self, 'owner', [])
+        """Return the set of owners for the current channel."""
+        return getattr(self, 'owner', set())
 
     def get_ops(self):
-        """Return a list of ops for the current channel."""
-        return getattr(self, 'ops', [])
+        """Return a set of ops for the current channel."""
+        return getattr(self, 'ops', set())
 
     def get_regulars(self):
-        """Return a list of regulars for the current channel."""
-        return getattr(self, 'regulars', [])
+        """Return a set of regulars for the current channel."""
+        return getattr(self, 'regulars', set())
 
     def get_blacklist(self):
-        """Return a list of blacklisted users for the current channel."""
-        return getattr(self, 'blacklist', [])
+        """Return a set of blacklisted users for the current channel."""
+        return getattr(self, 'blacklist', set())
+
+    def get_role(self, nick):
+        """Return the role of a nick (one of ROLE_*), it is only looked up when it is not cached."""
+        role = self.roles.get(nick)
+        if role is None:
+            if len(self.roles) >= ROLE_CACHE_SIZE:
+                self.roles.clear()
+            role = self.roles[nick] = self.resolve_role(nick)
+        return role
+
+    def resolve_role(self, nick):
+        """Look up the role of a nick in the owner, ops and regulars sets."""
+        if nick in self.get_owner():
+            return ROLE_OWNER
+        if nick in self.get_ops():
+            return ROLE_OP
+        if nick in self.get_regulars():
+            return ROLE_REGULAR
+        return ROLE_NONE
+
+    def forget_role(self, nick=None):
+        """Remove the cached role of a nick (or of all nicks), after it may have changed."""
+        if nick is None:
+            self.roles.clear()
+        else:
+            self.roles.pop(nick, None)
 
     def can_use_owner(self, user):
         """Return whether or not the user can use owner commands."""
@@ -462,7 +2861,7 @@ class BaseBot(object):
         else:
             nick = user
 
-        return nick in self.get_owner()
+        return self.get_role(nick) >= ROLE_OWNER
 
     def can_use_op(self, user):
         """Return whether or not the user can use op commands."""
@@ -471,7 +2870,7 @@ class BaseBot(object):
         else:
             nick = user
 
-        return nick in self.get_ops() or self.can_use_owner(user)
+        return self.get_role(nick) >= ROLE_OP or self.can_use_owner(user)
 
     def can_use_regular(self, user):
         """Return whether or not the user can use regular commands."""
@@ -480,7 +2879,13 @@ class BaseBot(object):
         else:
             nick = user
 
-        return nick in self.get_regulars() or self.can_use_op(user)
+        return self.get_role(nick) >= ROLE_REGULAR or self.can_use_op(user)
+
+    def can_use(self, user, permission):
+        """Return whether the user has a permission ('owner', 'op' or 'regular'), None is everyone's."""
+        if permission is None:
+            return True
+        return getattr(self, 'can_use_' + permission)(user)
 
     def is_blacklisted(self, user):
         """Return whether or not the user is blacklisted and ignored by the bot."""
@@ -492,59 +2897,269 @@ class BaseBot(object):
 
     # Helper methods
     # --------------------------------
-    def listcommands(self):
-        """Return a list of known commands."""
-        d = dir(self)
-        return [m.replace('command_', '') for m in d if m.startswith('command_')]
+    def listcommands(self, user=None):
+        """Return a list of known commands, including custom ones. If a user is given, only those
+        the user may use, by the permissions in the command registry."""
+        if user is None:
+            return sorted(self.routes)
+        return sorted(name for name in self.routes if self.can_use(user, self.get_permission(name)))
+
+    def get_command(self, command):
+        """Return the method implementing a command, or None if there is no such command."""
+        entry = self._commands.get(command)
+        if entry is None:
+            return None
+        return getattr(self, entry.method)
+
+    def get_action(self, command, action):
+        """Return the method implementing an action of a command (e.g. timer new), or None."""
+        entry = self._actions.get(command, {}).get(action)
+        if entry is None:
+            return None
+        return getattr(self, entry.method)
+
+    def get_permission(self, command, message=''):
+        """Return the permission needed for a command, or for its action (the first word of message)
+        if the command itself needs none. None if everyone may use it, as custom replies and counters."""
+        entry = self._commands.get(command)
+        if entry is None:
+            return None
+        if entry.permission is None and command in self._actions:
+            action = self._actions[command].get(message.partition(' ')[0])
+            if action is not None:
+                return action.permission
+        return entry.permission
+
+    def get_help(self, command):
+        """Return the help method for a command, or None if the command has no help method."""
+        entry = self._helps.get(command)
+        if entry is None:
+            return None
+        return getattr(self, entry.method)
+
+    def get_nicklist(self):
+        """Return the list of users in chat. Needs to be implemented by subclasses!"""
+        raise NotImplemented
+
+    def count_chatters(self):
+        """Return the number of people in chat."""
+        return len(self.get_nicklist())
+
+    def nick_in_chat(self, nick):
+        """Return whether or not the given nick is currently in chat."""
+        return nick in [user.nick for user in self.get_nicklist()]
+
+    def get_own_nick(self):
+        """Return the username of the bot. Needs to be implemented by subclasses."""
+        raise NotImplemented
+
+    def get_stream(self, callback):
+        """Call callback with the stream answer ({'stream': ...}), False where there is no stream."""
+        callback(False)
+
+    # Dispatching
+    # --------------------------------
+    def dispatch(self, sender, message):
+        """Make the bot do something with the message."""
+
+        # ignore blacklisted users.
+        if self.is_blacklisted(sender):
+            debug('User {} is blacklisted: {}'.format(sender.nick, message))
+            return True
+
+        # Split command and arguments
+        command, _, message = message.partition(' ')
+
+        # look up the command in the routing table and call it with given arguments.
+        handler = self.routes.get(command)
+        if handler is None:
+            debug('Command "{}" does not exist.'.format(command))
+            return False
+
+        # commands the user may not use are ignored, so they don't use up the cooldowns of others.
+        permission = self.get_permission(command, message)
+        if not self.can_use(sender, permission):
+            debug('User {} may not use "{}".'.format(sender.nick, command))
+            return True
+
+        # don't do any work for commands that are used too often.
+        op = self.can_use_op(sender)
+        if not self.check_cooldown(sender, command, op):
+            self.cooldown_rejections += 1
+            debug('Command "{}" of {} is cooling down.'.format(command, sender.nick))
+            return True
+
+        # replies to ops go out first.
+        self.reply_priority = PRIORITY_HIGH if op else PRIORITY_NORMAL
+        try:
+            handler(sender=sender, message=message)
+        finally:
+            self.reply_priority = PRIORITY_NORMAL
+        return True
+
+    def check_cooldown(self, sender, command, op=False):
+        """Return whether the user (an op or not) may use the command now, and count the use if so."""
+        if op:
+            return self.op_cooldowns.allow(command, COOLDOWN_OP_RATE)
+
+        channel_rate, user_rate = COOLDOWNS.get(command, (COOLDOWN_RATE, COOLDOWN_USER_RATE))
+        # the use of the user only counts if the channel limit allows it too.
+        user = (sender.nick, command)
+        if not self.cooldowns.allow(user, user_rate, count=False) or not self.cooldowns.allow(command, channel_rate):
+            return False
+        return self.cooldowns.allow(user, user_rate)
+
+    def say(self, sender=None, text=None, force=False, priority=None):
+        """Make the bot say something.
+
+        Messages that are forced have a high priority, others the priority of the reply to the
+        message being dispatched (high for ops), unless the priority is given."""
+        if (not self.muted and text != self.previous_response) or force:
+            self.previous_response = text
+            if priority is None:
+                priority = PRIORITY_HIGH if force else self.reply_priority
+            self.send(text, priority)
+            return True
+
+    def keep_priority(self, callback):
+        """Return a callback for an answer that arrives after dispatch() returned. Replies it says
+        get the priority of replies to the message dispatched now."""
+        return partial(self.call_with_priority, self.reply_priority, callback)
+
+    def call_with_priority(self, priority, callback, *args):
+        previous, self.reply_priority = self.reply_priority, priority
+        try:
+            return callback(*args)
+        finally:
+            self.reply_priority = previous
+
+    def say_template(self, template, sender=None, priority=None, **values):
+        """Say a Template with the given values, the stream is only asked for if the template needs it."""
+        if template.needs_stream:
+            return self.get_stream(self.keep_priority(partial(self.say_rendered, template, sender, priority, values)))
+        return self.say_rendered(template, sender, priority, values)
+
+    def say_rendered(self, template, sender, priority, values, stream=None):
+        values['user'] = sender.nick if sender is not None else ''
+        values['channel'] = getattr(self, 'channel', '')
+        if template.needs_stream:
+            values.update(stream_values(stream))
+        return self.say(sender=sender, text=template.render(values), priority=priority)
+
+    def send(self, text, priority):
+        """Send a text to the channel. Without a queue to pace messages, send it right away."""
+        self.irc_say(text)
+
+    def irc_say(self, text):
+        """This method is a stub and should be implemented by some IRC layer subclass."""
+        raise NotImplemented
+
+
+class IRCBot(BaseBot):
+    """Subclass of BaseBot.
+
+    What the IRC layers have in common: an index of the nicklist, message tags, pacing of
+    messages and the permissions of people in chat. The layers (WeechatBot, AsyncoreBot) connect
+    this to an actual IRC client."""
+
+    # IRCv3 capabilities to request from the server, the tags of messages are kept in user_tags.
+    capabilities = ()
+
+    def index_nicklist(self, users):
+        """Index the nicklist once, the IRC layer keeps the index up to date with nick_changed()."""
+        self.nicks = dict((user.nick, user.prefix) for user in users)
+        self.ops_in_chat = set(nick for nick, prefix in self.nicks.iteritems() if '@' in prefix)
+
+    def nick_changed(self, nick, prefix):
+        """Update the nicklist index after a nick joined or got a new prefix, or left (prefix is None)."""
+        self.forget_role(nick)
+        if prefix is None:
+            self.nicks.pop(nick, None)
+            self.ops_in_chat.discard(nick)
+            return
+
+        self.nicks[nick] = prefix
+        if '@' in prefix:
+            self.ops_in_chat.add(nick)
+        else:
+            self.ops_in_chat.discard(nick)
+
+    def tags_received(self, nick, tags):
+        """Remember the tags of the message a user is sending, it is dispatched right after this."""
+        if len(self.user_tags) >= ROLE_CACHE_SIZE:
+            self.user_tags.clear()
+        self.user_tags[nick] = tags
 
-    def get_nicklist(self):
-        """Return the list of users in chat. Needs to be implemented by subclasses!"""
-        raise NotImplemented
+    def make_user(self, prefix, nick):
+        """Return the User sending a message, given the prefix and nick it was printed with."""
+        return User(prefix=prefix, nick=nick)
 
-    def nick_in_chat(self, nick):
-        """Return whether or not the given nick is currently in chat."""
-        return nick in self.get_nicklist()
+    def close(self):
+        """Drop the messages still waiting to be sent, the channel is gone when they would be."""
+        super(IRCBot, self).close()
+        outbound_queue.remove(self)
 
-    def get_own_nick(self):
-        """Return the username of the bot. Needs to be implemented by subclasses."""
-        raise NotImplemented
+    def clean_state(self, state):
+        """Remove some instance variables from state, that may not survive loading."""
+        state.pop('_flush_pointer', None)
+        state.pop('nicks', None)
+        state.pop('ops_in_chat', None)
+        state.pop('user_tags', None)
+        return super(IRCBot, self).clean_state(state)
+
+    def schedule_flush(self, delay):
+        """Flush the state from a timer, changes made until then are written together."""
+        if self._flush_pointer is None:
+            self._flush_pointer = call_later(delay, self.delayed_flush)
+
+    def delayed_flush(self):
+        """Write pending changes when the flush timer fires."""
+        self._flush_pointer = None
+        self.flush()
 
     # Dispatching
     # --------------------------------
-    def dispatch(self, sender, message):
-        """Make the bot do something with the message."""
+    def send(self, text, priority):
+        """Queue a text, it is sent to the channel when the message limits allow."""
+        outbound_queue.put(self, text, priority)
 
-        # ignore blacklisted users.
-        if self.is_blacklisted(sender):
-            debug('User {} is blacklisted: {}'.format(sender.nick, message))
-            return True
+    def get_account(self):
+        """Return the account the bot sends its messages with."""
+        return self.network, self.get_own_nick()
 
-        # Split command and arguments
-        command, _, message = message.partition(' ')
+    def is_moderator(self):
+        """Return whether the bot is an op in the channel, which allows it to send more messages."""
+        prefix = self.nicks.get(self.get_own_nick(), '')
+        return '@' in prefix or '~' in prefix
 
-        # derive method name and call it with given arguments.
-        try:
-            method = getattr(self, 'command_{}'.format(command))
-            method(sender=sender, message=message)
-            return True
-        # or maybe the command does not exist.
-        except AttributeError:
-            debug('Command "{}" does not exist.'.format(command))
-            return False
+    # Authentication methods
+    # --------------------------------
+    def get_owner(self):
+        """Return the set of owners."""
+        super_owner = super(IRCBot, self).get_owner()
+        return super_owner | set([self.get_own_nick()])
 
-    def say(self, sender=None, text=None, force=False):
-        """Make the bot say something."""
-        if (not self.muted and text != self.previous_response) or force:
-            self.previous_response = text
-            self.irc_say(text)
-            return True
+    def get_ops(self):
+        """Get a set of channel members who are ops."""
+        super_nicklist = super(IRCBot, self).get_ops()
+        return super_nicklist | self.ops_in_chat
 
-    def irc_say(self, text):
-        """This method is a stub and should be implemented by some IRC layer subclass."""
-        raise NotImplemented
+    # Helper methods
+    # --------------------------------
+    def get_nicklist(self):
+        """Get a list of people in chat."""
+        return [User(prefix=prefix, nick=nick) for nick, prefix in self.nicks.iteritems()]
+
+    def count_chatters(self):
+        """Return the number of people in chat."""
+        return len(self.nicks)
+
+    def nick_in_chat(self, nick):
+        """Return whether or not the given nick is currently in chat."""
+        return nick in self.nicks
 
 
-class WeechatBot(BaseBot):
+class WeechatBot(IRCBot):
     """Subclass of BaseBot.
 
     This is the "IRC" layer that works as an adapter for BaseBot. Some other IRC
@@ -557,8 +3172,11 @@ class WeechatBot(BaseBot):
         self.network = kwargs.pop('network', '')
         self.channel = kwargs.pop('channel', '')
         self.buffer = weechat.info_get('irc_buffer', '{},#{}'.format(self.network, self.channel))
+        self._flush_pointer = None
 
         self.setup_callback()
+        self.setup_nicklist()
+        self.setup_tags()
 
         super(WeechatBot, self).__init__(*args, **kwargs)
 
@@ -568,24 +3186,51 @@ class WeechatBot(BaseBot):
         self._callback = callback(self.callback)
         self._pointer = weechat.hook_print(self.buffer, 'irc_privmsg', '', 1, self._callback, '')
 
+    def setup_tags(self):
+        """Request the capabilities of the bot and keep the latest message tags of every user."""
+        self.user_tags = {}
+        if self.capabilities:
+            request_capabilities(self.network, self.capabilities)
+            watch_message_tags(self.network, '#' + self.channel, self.tags_received)
+
+    def setup_nicklist(self):
+        """Index the nicklist of the buffer once, WeeChat's nicklist signals keep the index up to date."""
+        self.index_nicklist(BufferNicklist(self.buffer))
+        watch_nicklist(self.buffer, self.nicklist_changed)
+
+    def nicklist_changed(self, nick, present):
+        """Update the nicklist index after a nick joined, left or got a new prefix."""
+        if not present:
+            return self.nick_changed(nick, None)
+
+        pointer = weechat.nicklist_search_nick(self.buffer, '', nick)
+        self.nick_changed(nick, weechat.nicklist_nick_get_string(self.buffer, pointer, 'prefix').strip())
+
     def callback(self, data, buffer, date, tags, displayed, highlight, prefix, message):
         """Receive a message from the IRC client and turn it over to the bot."""
         if not message.startswith(COMMAND_SYMBOL):
             return weechat.WEECHAT_RC_OK
 
         sender_data = re.match(r'([~@%]?)(.*)', prefix)
-        sender = User(
+        sender = self.make_user(
             prefix=sender_data.group(1).strip(),
             nick=sender_data.group(2).strip(),
         )
         self.dispatch(sender, message.strip()[1:])
         return weechat.WEECHAT_RC_OK
 
+    def close(self):
+        """Stop watching the buffer."""
+        super(WeechatBot, self).close()
+        weechat.unhook(self._pointer)
+        _nicklist_watchers.pop(self.buffer, None)
+        _tag_watchers.pop((self.network, '#' + self.channel.lower()), None)
+
     def clean_state(self, state):
         """Remove some instance variables from state, that may not survive loading."""
-        state.pop('_callback')
-        state.pop('_pointer')
-        state.pop('buffer')
+        state.pop('_callback', None)
+        state.pop('_pointer', None)
+        state.pop('buffer', None)
         return super(WeechatBot, self).clean_state(state)
 
     # Dispatching
@@ -594,35 +3239,64 @@ class WeechatBot(BaseBot):
         """Send a text to the channel."""
         weechat.command(self.buffer, text)
 
-    # Authentication methods
+    # Helper methods
     # --------------------------------
-    def get_owner(self):
-        """Return the list of owners."""
-        owner = [self.get_own_nick()]
-        super_owner = super(WeechatBot, self).get_owner()
-        return list(set(owner) | set(super_owner))
+    def get_own_nick(self):
+        """Return the username of the bot."""
+        return weechat.buffer_get_string(self.buffer, "localvar_nick")
 
-    def get_ops(self):
-        """Get a list of channel members who are ops."""
-        super_nicklist = super(WeechatBot, self).get_ops()
-        nicklist = [n.nick for n in self.get_nicklist() if '@' in n.prefix]
-        nicklist = list(set(super_nicklist) | set(nicklist))
 
-        return nicklist
+class AsyncoreBot(IRCBot):
+    """Subclass of BaseBot.
+
+    The IRC layer for running without WeeChat: the bot is one channel of an IRCConnection,
+    which talks to the server over a socket."""
 
-    # Helper methods
+    # Initialisation stuff
     # --------------------------------
-    def get_nicklist(self):
-        """Get a list of people in chat."""
-        return BufferNicklist(self.buffer)
+    def __init__(self, *args, **kwargs):
+        """Connect this bot instance to a channel on the network."""
+        self.network = kwargs.pop('network', '')
+        self.channel = kwargs.pop('channel', '')
+        self.connection = get_connection(self.network)
+        self._flush_pointer = None
+        self.user_tags = {}
+        self.index_nicklist([])
+
+        super(AsyncoreBot, self).__init__(*args, **kwargs)
+        self.connection.add_bot('#' + self.channel, self)
+
+    def message_received(self, nick, message, tags=None):
+        """Receive a message from the connection and turn it over to the bot."""
+        if tags is not None:
+            self.tags_received(nick, parse_tags(tags))
+        if not message.startswith(COMMAND_SYMBOL):
+            return
 
-    def nick_in_chat(self, nick):
-        """Return whether or not the given nick is currently in chat."""
-        return weechat.nicklist_search_nick(self.buffer, "", nick)
+        sender = self.make_user(prefix=self.nicks.get(nick, ''), nick=nick)
+        self.dispatch(sender, message.strip()[1:])
+
+    def close(self):
+        """Leave the channel."""
+        super(AsyncoreBot, self).close()
+        self.connection.remove_bot('#' + self.channel)
+
+    def clean_state(self, state):
+        """Remove some instance variables from state, that may not survive loading."""
+        state.pop('connection', None)
+        return super(AsyncoreBot, self).clean_state(state)
 
+    # Dispatching
+    # --------------------------------
+    def irc_say(self, text):
+        """Send a text to the channel."""
+        self.connection.send_line('PRIVMSG #{} :{}'.format(self.channel, text))
+
+    # Helper methods
+    # --------------------------------
     def get_own_nick(self):
         """Return the username of the bot."""
-        return weechat.buffer_get_string(self.buffer, "localvar_nick")
+        return self.connection.nick
 
 
 class BaseCommandsBot(object):
@@ -633,7 +3307,7 @@ class BaseCommandsBot(object):
         """Mute the bot, it will stop talking but still execute things. Ops only."""
         self.muted = True
         self.say(sender=sender, text="I'll shut up.", force=True)
-        self.save()
+        self.save('muted')
         return True
 
     @require_op
@@ -641,12 +3315,12 @@ class BaseCommandsBot(object):
         """Unmute the bot. Ops only."""
         self.muted = False
         self.say(sender=sender, text="I can speak!")
-        self.save()
+        self.save('muted')
         return True
 
     def command_ops(self, sender=None, message=''):
         """Return a list of nicks that can use op commands."""
-        return self.say(sender=sender, text=str(self.get_ops()))
+        return self.say(sender=sender, text=str(sorted(self.get_ops())))
 
     @require_owner
     def command_op(self, sender=None, message=''):
@@ -657,9 +3331,10 @@ class BaseCommandsBot(object):
         if message in self.ops:
             return self.say(sender=sender, text='{} is already op.')
 
-        self.ops.append(message)
+        self.ops.add(message)
+        self.forget_role(message)
         self.say(sender=sender, text="Ok, {} is now op.".format(message))
-        self.save()
+        self.save('ops', message)
 
     @require_owner
     def command_deop(self, sender=None, message=''):
@@ -669,8 +3344,9 @@ class BaseCommandsBot(object):
 
         if message in self.ops:
             self.ops.remove(message)
+            self.forget_role(message)
             self.say(sender=sender, text="Ok, {} is no longer op.".format(message))
-            self.save()
+            self.save('ops', message)
 
     def command_amiop(self, sender=None, message=''):
         """Tells you if you are an op."""
@@ -684,7 +3360,7 @@ class BaseCommandsBot(object):
         if not self.can_use_regular(sender.nick):
             return
 
-        self.say(sender=sender, text=str(self.get_regulars()))
+        self.say(sender=sender, text=str(sorted(self.get_regulars())))
 
     @require_op
     def command_regular(self, sender=None, message=''):
@@ -693,9 +3369,10 @@ class BaseCommandsBot(object):
             self.say(sender=sender, text='That is not a valid nick.')
 
         if message not in self.regulars:
-            self.regulars.append(message)
+            self.regulars.add(message)
+            self.forget_role(message)
             self.say(sender=sender, text='OK, {} is a regular.'.format(message))
-            self.save()
+            self.save('regulars', message)
 
     @require_op
     def command_deregular(self, sender=None, message=''):
@@ -705,8 +3382,9 @@ class BaseCommandsBot(object):
 
         if message in self.regulars:
             self.regulars.remove(message)
+            self.forget_role(message)
             self.say(sender=sender, text='OK, {} is no longer a regular.'.format(message))
-            self.save()
+            self.save('regulars', message)
 
     def command_amiregular(self, sender=None, message=''):
         """Tells you if you are regulars."""
@@ -731,9 +3409,9 @@ class BaseCommandsBot(object):
         if self.can_use_regular(message):
             return self.say(sender=sender, text='{} is a regular.'.format(message))
 
-        if self.is_blacklisted(message):
-            self.blacklist.append(message)
-            self.save()
+        if not self.is_blacklisted(message):
+            self.blacklist.add(message)
+            self.save('blacklist', message)
             return self.say(sender=sender, text='Ok, I\'ll ignore {}.'.format(message))
         else:
             return self.say(sender=sender, text='{} is already blacklisted.'.format(message))
@@ -747,14 +3425,127 @@ class BaseCommandsBot(object):
 
         if message in self.blacklist:
             self.blacklist.remove(message)
-            self.save()
+            self.save('blacklist', message)
             return self.say(sender=sender, text='Ok, I\'ll no longer ignore {}.'.format(message))
         else:
             return self.say(sender=sender, text='{} is not blacklisted.'.format(message))
 
+    @require_owner
+    def command_globalignore(self, sender=None, message=''):
+        """Add a nick to the blacklist of every channel. Owner only.
+        Syntax: {symbol}globalignore <nick>"""
+        if not is_valid_nick(message):
+            return self.say(sender=sender, text='That is not a valid nick.')
+
+        broadcast(('ignore', message))
+        return self.say(sender=sender, text='Ok, I\'ll ignore {} everywhere.'.format(message))
+
+    @require_owner
+    def command_globalunignore(self, sender=None, message=''):
+        """Remove a nick from the blacklist of every channel. Owner only.
+        Syntax: {symbol}globalunignore <nick>"""
+        if not is_valid_nick(message):
+            return self.say(sender=sender, text='That is not a valid nick.')
+
+        broadcast(('unignore', message))
+        return self.say(sender=sender, text='Ok, I\'ll no longer ignore {} anywhere.'.format(message))
+
+    @require_owner
+    def command_reload(self, sender=None, message=''):
+        """Make the bots of all channels load their state again. Owner only."""
+        broadcast(('reload',))
+        return self.say(sender=sender, text='Reloading.', force=True)
+
+    @require_owner
+    def command_stats(self, sender=None, message=''):
+        """Show how often the operations that took most time in this channel ran and how long they
+        took, how the Twitch API cache did and how long the API clients took, or how late the
+        scheduled jobs ran. Owner only.
+        Syntax: {symbol}stats [api|scheduler]"""
+        if message == 'scheduler':
+            return self.say(sender=sender, text=scheduler.summary(), force=True)
+        if message == 'api':
+            text = twitch_api.stats()
+            if INSTRUMENTATION:
+                text = '{} | {}'.format(text, metrics.summary(''))
+            return self.say(sender=sender, text=text, force=True)
+        if not INSTRUMENTATION:
+            return self.say(sender=sender, text='Instrumentation is disabled.', force=True)
+        return self.say(sender=sender, text=metrics.summary(self.name), force=True)
+
+    @require_owner
+    def command_profile(self, sender=None, message=''):
+        """Profile what the bots do. Owner only. Syntax: {symbol}profile <action>; where possible actions are:
+        start, stop, dump. See {symbol}help profile <action>"""
+        action, _, message = message.partition(' ')
+        method = self.get_action('profile', action)
+        if method is None:
+            return self.say(
+                sender=sender,
+                text='Invalid syntax: {symbol}profile start|stop|dump'.format(symbol=COMMAND_SYMBOL),
+                force=True,
+            )
+
+        return method(sender=sender, message=message)
+
+    def help_profile(self, sender=None, message=''):
+        """Determine the action being used and display the corresponding method's docstring."""
+        action, _, _ = message.partition(' ')
+        method = self.get_action('profile', action) if action is not '' else self.get_command('profile')
+
+        if method is not None:
+            helptext = method.__doc__.format(symbol=COMMAND_SYMBOL)
+            helptext = " ".join(helptext.split())
+            return self.say(sender=sender, text=helptext)
+
+        return self.say(sender=sender, text='{} is not a valid action.'.format(action))
+
+    @require_owner
+    def profile_start(self, sender=None, message=''):
+        """Profile the bots of all channels for some seconds, 60 if not given. Owner only.
+        Syntax: {symbol}profile start [seconds]"""
+        seconds = int(message) if message.isdigit() else PROFILE_WINDOW
+        seconds = min(seconds, PROFILE_MAX_WINDOW)
+        classes = set(type(bot) for bot in bots.values()) | set([type(self)])
+        if not profiler.start(classes, seconds):
+            return self.say(sender=sender, text='Already profiling.', force=True)
+        return self.say(sender=sender, text='Profiling for {} seconds.'.format(seconds), force=True)
+
+    @require_owner
+    def profile_stop(self, sender=None, message=''):
+        """Stop profiling before the time is up. Owner only.
+        Syntax: {symbol}profile stop"""
+        if not profiler.stop():
+            return self.say(sender=sender, text='Not profiling.', force=True)
+        return self.say(sender=sender, text='Stopped profiling after {:.0f} seconds.'.format(profiler.elapsed),
+                        force=True)
+
+    @require_owner
+    def profile_dump(self, sender=None, message=''):
+        """Write the profile to a file and show the slowest commands. Owner only.
+        Syntax: {symbol}profile dump"""
+        path = shard_path(PROFILE_FILE)
+        if not profiler.dump(path):
+            return self.say(sender=sender, text='Nothing profiled yet.', force=True)
+        return self.say(sender=sender, text='Profile of {} samples written to {}. Slowest: {}'.format(
+            profiler.samples, path, profiler.summary()), force=True)
+
+    @require_owner
+    def command_queue(self, sender=None, message=''):
+        """Show the state of the outgoing message queue. Owner only."""
+        self.say(sender=sender, text=outbound_queue.stats(), force=True)
+
+    @require_owner
+    def command_cooldowns(self, sender=None, message=''):
+        """Show how many commands have been rejected because they were used too often. Owner only."""
+        self.say(sender=sender, text='{} commands rejected, {} users and commands tracked.'.format(
+            self.cooldown_rejections,
+            len(self.cooldowns),
+        ))
+
     def command_commands(self, sender=None, message=''):
-        """Show a list of known commands."""
-        commands = ', '.join(self.listcommands())
+        """Show a list of the commands you can use."""
+        commands = ', '.join(self.listcommands(sender))
         self.say(sender=sender, text='Known commands: {}'.format(commands))
 
     def command_help(self, sender=None, message=''):
@@ -763,14 +3554,15 @@ class BaseCommandsBot(object):
         if command is '':
             command = 'help'
 
-        funcname = 'help_'+command
-        if not hasattr(self, funcname):
-            funcname = 'command_'+command
+        method = self.get_help(command)
+        if method is not None:
+            return method(sender=sender, message=message)
 
-        if not hasattr(self, funcname):
+        method = self.get_command(command)
+        if method is None:
             return self.say(sender=sender, text='Not a valid command or no help available.')
 
-        helptext = getattr(self, funcname).__doc__.format(symbol=COMMAND_SYMBOL)
+        helptext = method.__doc__.format(symbol=COMMAND_SYMBOL)
         helptext = " ".join(helptext.split())
         return self.say(sender=sender, text=helptext)
 
@@ -778,12 +3570,26 @@ class BaseCommandsBot(object):
 class BotTwitchMixin(object):
     """Add twitch specific functionality."""
 
+    # with tags, every message tells the badges of its sender.
+    capabilities = ('twitch.tv/tags',)
+    badge_prefixes = (
+        ('broadcaster', '~'),
+        ('moderator', '@'),
+        ('vip', '%'),
+        ('subscriber', '+'),
+    )
+
     def __init__(self, *args, **kwargs):
         super(BotTwitchMixin, self).__init__(*args, **kwargs)
-        self.twitch_api = TwitchAPI()
+        self.twitch_api = twitch_api
+        stream_poller.add(self.channel)
+
+    def close(self):
+        stream_poller.remove(self.channel)
+        super(BotTwitchMixin, self).close()
 
     def clean_state(self, state):
-        state.pop('twitch_api')
+        state.pop('twitch_api', None)
         return super(BotTwitchMixin, self).clean_state(state)
 
     def can_use_owner(self, user):
@@ -810,6 +3616,16 @@ class BotTwitchMixin(object):
 
         return super(BotTwitchMixin, self).can_use_regular(user)
 
+    def make_user(self, prefix, nick):
+        """Derive the prefix from the badges of the message, when Twitch sent them."""
+        tags = self.user_tags.get(nick)
+        if tags is not None:
+            badges = tags.get('badges', '')
+            prefix = ''.join(symbol for badge, symbol in self.badge_prefixes if badge + '/' in badges)
+            if tags.get('mod') == '1' and '@' not in prefix:
+                prefix += '@'
+        return super(BotTwitchMixin, self).make_user(prefix, nick)
+
     def get_streamer(self):
         """Return name of the streamer (which is the same as the channel)."""
         return self.channel
@@ -817,15 +3633,27 @@ class BotTwitchMixin(object):
     def get_owner(self):
         """Streamer is automatically also an owner."""
         super_list = super(BotTwitchMixin, self).get_owner()
-        return list(set(super_list) | set([self.get_streamer()]))
+        return super_list | set([self.get_streamer()])
 
     def command_chatters(self, sender=None, message=''):
         """Return the number of viewers in chat."""
-        self.say(sender=sender, text='There are {} chatters.'.format(len(self.get_nicklist())))
+        self.say(sender=sender, text='There are {} chatters.'.format(self.count_chatters()))
 
+    def get_stream(self, callback):
+        """Call callback with the stream answer, from the stream poller or from the Twitch API."""
+        stream = stream_poller.get(self.channel)
+        if stream:
+            return callback(stream)
+        self.twitch_api.stream(name=self.channel, callback=callback)
+
+    # The Twitch API is queried in the background, the replies are sent when the answer arrives.
     def command_uptime(self, sender=None, message=''):
         """Report the current stream uptime."""
-        stream = self.twitch_api.stream(name=self.channel)
+        self.get_stream(self.keep_priority(partial(self.reply_uptime, sender)))
+
+    def reply_uptime(self, sender, stream):
+        if not stream:
+            return self.say(sender=sender, text='Twitch did not answer, try again later.')
         if stream['stream'] is None:
             return self.say(sender=sender, text='Stream is currently offline.')
         created = datetime.strptime(stream['stream']['created_at'], '%Y-%m-%dT%H:%M:%SZ')
@@ -834,7 +3662,11 @@ class BotTwitchMixin(object):
 
     def command_game(self, sender=None, message=''):
         """Return the game being streamed."""
-        stream = self.twitch_api.stream(name=self.channel)
+        self.get_stream(self.keep_priority(partial(self.reply_game, sender)))
+
+    def reply_game(self, sender, stream):
+        if not stream:
+            return self.say(sender=sender, text='Twitch did not answer, try again later.')
         if stream['stream'] is None:
             return self.say(sender=sender, text='Stream is currently offline.')
         game = stream['stream']['game']
@@ -842,7 +3674,11 @@ class BotTwitchMixin(object):
 
     def command_viewers(self, sender=None, message=''):
         """Return the current number of viewers."""
-        stream = self.twitch_api.stream(name=self.channel)
+        self.get_stream(self.keep_priority(partial(self.reply_viewers, sender)))
+
+    def reply_viewers(self, sender, stream):
+        if not stream:
+            return self.say(sender=sender, text='Twitch did not answer, try again later.')
         if stream['stream'] is None:
             return self.say(sender=sender, text='Stream is currently offline.')
         viewers = stream['stream']['viewers']
@@ -850,7 +3686,15 @@ class BotTwitchMixin(object):
 
     def command_title(self, sender=None, message=''):
         """Return the current title of the stream."""
-        channel = self.twitch_api.channel(name=self.channel)
+        # live streams include the channel object.
+        stream = stream_poller.get(self.channel)
+        if stream and stream['stream'] is not None:
+            return self.reply_title(sender, stream['stream']['channel'])
+        self.twitch_api.channel(name=self.channel, callback=self.keep_priority(partial(self.reply_title, sender)))
+
+    def reply_title(self, sender, channel):
+        if not channel:
+            return self.say(sender=sender, text='Twitch did not answer, try again later.')
         self.say(sender=sender, text='Current title: "{}"'.format(channel['status']))
 
 
@@ -883,20 +3727,79 @@ class BotTimerMixin(object):
     def __init__(self, *args, **kwargs):
         self.active_timer = None
         self.timers = OrderedDict()
+        self.run_history = {}
+        self.runs = {}  # (timer name, attempt): run archived after the history was last written
         super(BotTimerMixin, self).__init__(*args, **kwargs)
 
+    def load(self):
+        """Load the state, then add the runs archived after their history was last written."""
+        self.runs = None
+        if not super(BotTimerMixin, self).load():
+            self.runs = {}
+            return False
+        if self.runs is None:
+            # state from before runs were written one at a time, journals need the whole dict first.
+            self.runs = {}
+            if self.run_history:
+                self.mark_changed('runs')
+        for (name, attempt), (names, seconds, final) in sorted(self.runs.items()):
+            history = self.run_history.get(name)
+            if history is not None and attempt > history.attempts:
+                history.add(zip(names.split('\n') if names else [], array('d', seconds)), final)
+        return True
+
+    def archive_run(self, name, final=None):
+        """Add the splits of the current run of a timer to its history, final is None for a reset.
+
+        Only the run is written, the whole history every RUN_HISTORY_CHECKPOINT runs."""
+        splits = list(self.timers[name].iter_split_seconds())
+        if final is None and not splits:
+            return
+
+        history = self.run_history.get(name)
+        if history is None:
+            history = self.run_history[name] = RunHistory()
+            if len(self.run_history) == 1:
+                # saved as a whole, journals can't add keys to state from before run histories existed.
+                self.save('run_history')
+                self.save('runs')
+        history.add(splits, final)
+
+        if history.attempts - history.saved >= RUN_HISTORY_CHECKPOINT or history.attempts == 1:
+            return self.checkpoint_runs(name)
+        # split names and times as two strings, much quicker to pickle than (name, seconds) pairs.
+        self.runs[(name, history.attempts)] = (
+            '\n'.join(splitname for splitname, _ in splits),
+            array('d', (seconds for _, seconds in splits)).tostring(),
+            final
+        )
+        self.save('runs', (name, history.attempts))
+
+    def checkpoint_runs(self, name, oldname=None):
+        """Write the whole history of a timer, then forget the runs archived one at a time since it
+        was last written (under oldname, if the timer has just been renamed)."""
+        history = self.run_history[name]
+        self.save('run_history', name)
+        self.drop_runs(oldname or name, history)
+        history.saved = history.attempts
+
+    def drop_runs(self, name, history):
+        """Forget the runs of a timer archived one at a time since its history was last written."""
+        for attempt in range(history.saved + 1, history.attempts + 1):
+            if self.runs.pop((name, attempt), None) is not None:
+                self.save('runs', (name, attempt))
+
     def command_timer(self, sender=None, message=''):
         """Performs timer related actions: new, del, start, stop, restart, split, resplit, delsplit,
-        status, report, list, active, rename, adjust, adjustsplit. Syntax: {symbol}timer [action] ;
+        status, report, list, active, rename, adjust, adjustsplit, pb, sob, delta. Syntax: {symbol}timer [action] ;
         {symbol}timer without an action is equivalent to {symbol}timer status"""
         if message is '':
             message = 'status'
 
         command, _, message = message.partition(' ')
 
-        try:
-            method = getattr(self, 'timer_{}'.format(command))
-        except AttributeError:
+        method = self.get_action('timer', command)
+        if method is None:
             return
 
         return method(sender=sender, message=message)
@@ -904,10 +3807,10 @@ class BotTimerMixin(object):
     def help_timer(self, sender=None, message=''):
         """Determine which action is being used and display the docstring for the corresponding method."""
         action, _, message = message.partition(' ')
-        funcname = 'timer_'+action if action is not '' else 'command_timer'
+        method = self.get_action('timer', action) if action is not '' else self.get_command('timer')
 
-        if hasattr(self, funcname):
-            helptext = getattr(self, funcname).__doc__.format(symbol=COMMAND_SYMBOL)
+        if method is not None:
+            helptext = method.__doc__.format(symbol=COMMAND_SYMBOL)
             helptext = " ".join(helptext.split())
             return self.say(sender=sender, text=helptext)
 
@@ -921,13 +3824,14 @@ class BotTimerMixin(object):
         if name is '':
             name = datetime.utcnow().strftime('%Y%m%d%H%M')
 
-        if name in self.timers.keys():
+        if name in self.timers:
             return self.say(sender=sender, text='Timer "{}" already exists.')
 
         self.active_timer = name
         self.timers[name] = Timer(name=name)
         self.say(sender=sender, text='Timer "{}" has been created.'.format(name))
-        self.save()
+        self.save('timers', name)
+        self.save('active_timer')
 
     @require_op
     def timer_del(self, sender=None, message=''):
@@ -940,14 +3844,19 @@ class BotTimerMixin(object):
                 text='Invalid syntax: {symbol}timer del <name>'.format(symbol=COMMAND_SYMBOL)
             )
 
-        if name not in self.timers.keys():
+        if name not in self.timers:
             return self.say(sender=sender, text='There is no timer with the name "{}"'.format(name))
 
         if name == self.active_timer:
             self.active_timer = None
         self.timers.pop(name, None)
+        history = self.run_history.pop(name, None)
         self.say(sender=sender, text='Timer "{}" has been removed.'.format(name))
-        self.save()
+        self.save('timers', name)
+        self.save('run_history', name)
+        self.save('active_timer')
+        if history is not None:
+            self.drop_runs(name, history)
 
     @require_regular
     def timer_start(self, sender=None, message=''):
@@ -957,15 +3866,19 @@ class BotTimerMixin(object):
         if name is '':
             name = self.active_timer
 
-        if name not in self.timers.keys():
+        if name not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(name))
 
         if self.timers[name].running:
             return self.say(sender=sender, text='Timer "{}" is already running.'.format(name))
 
-        self.timers[name].start()
+        # the splits of a stopped timer are in its run history, a new run starts without them.
+        if self.timers[name].stopped:
+            self.timers[name].restart()
+        else:
+            self.timers[name].start()
         self.say(sender=sender, text='Timer "{}" has been started.'.format(name))
-        self.save()
+        self.save('timers', name)
 
     @require_regular
     def timer_stop(self, sender=None, message=''):
@@ -974,15 +3887,16 @@ class BotTimerMixin(object):
         if name is '':
             name = self.active_timer
 
-        if name not in self.timers.keys():
+        if name not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(name))
 
         if not self.timers[name].running:
             return self.say(sender=sender, text='Timer "{}" is not running.'.format(name))
 
         self.timers[name].stop()
+        self.archive_run(name, self.timers[name].elapsed_seconds)
         self.say(sender=sender, text='Timer "{}" has been stopped: {}'.format(name, self.timers[name].elapsed))
-        self.save()
+        self.save('timers', name)
 
     @require_regular
     def timer_restart(self, sender=None, message=''):
@@ -991,15 +3905,16 @@ class BotTimerMixin(object):
         if name is '':
             name = self.active_timer
 
-        if name not in self.timers.keys():
+        if name not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(name))
 
         if not self.timers[name].running:
             return self.say(sender=sender, text='Timer "{}" is not running.'.format(name))
 
+        self.archive_run(name)
         self.timers[name].restart()
         self.say(sender=sender, text='Timer "{}" has been restarted.'.format(name))
-        self.save()
+        self.save('timers', name)
 
     @require_regular
     def timer_split(self, sender=None, message=''):
@@ -1015,20 +3930,20 @@ class BotTimerMixin(object):
         if timername is '':
             timername = self.active_timer
 
-        if timername not in self.timers.keys():
+        if timername not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(timername))
 
         timer = self.timers[timername]
         if not timer.running:
             return self.say(sender=sender, text='Timer "{}" is not running.'.format(timername))
 
-        if splitname in timer.splits.keys():
+        if timer.has_split(splitname):
             return self.say(sender=sender, text='Split "{}" already exists.'.format(splitname))
 
         timer.split(splitname)
-        splittime = timer.splits[splitname]
+        splittime = timer.get_split(splitname)
         self.say(sender=sender, text='Split "{split}" has been created: {time}'.format(split=splitname, time=splittime))
-        self.save()
+        self.save('timers', timername)
 
     @require_regular
     def timer_resplit(self, sender=None, message=''):
@@ -1045,7 +3960,7 @@ class BotTimerMixin(object):
         if timername is '':
             timername = self.active_timer
 
-        if timername not in self.timers.keys():
+        if timername not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(timername))
 
         timer = self.timers[timername]
@@ -1058,7 +3973,7 @@ class BotTimerMixin(object):
         self.say(sender=sender, text='Split "{name}" has been updated: {time}'.format(
             name=splitname,
             time=splittime))
-        self.save()
+        self.save('timers', timername)
 
     @require_op
     def timer_delsplit(self, sender=None, message=''):
@@ -1074,7 +3989,7 @@ class BotTimerMixin(object):
         if timername is '':
             timername = self.active_timer
 
-        if timername not in self.timers.keys():
+        if timername not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(timername))
 
         if not self.timers[timername].has_split(splitname):
@@ -1082,7 +3997,7 @@ class BotTimerMixin(object):
 
         self.timers[timername].removesplit(splitname)
         self.say(sender=sender, text='Split "{}" has been removed from timer "{}".'.format(splitname, timername))
-        self.save()
+        self.save('timers', timername)
 
     def timer_status(self, sender=None, message=''):
         """Give the status of named or active timer. Syntax: {symbol}timer status [name]"""
@@ -1095,7 +4010,7 @@ class BotTimerMixin(object):
         if name is None:
             return self.say(sender=sender, text='No timer is active and no timer name given.')
 
-        if name not in self.timers.keys():
+        if name not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(name))
 
         timer = self.timers[name]
@@ -1115,7 +4030,7 @@ class BotTimerMixin(object):
         if name is '':
             name = self.active_timer
 
-        if name not in self.timers.keys():
+        if name not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(name))
 
         timer = self.timers[name]
@@ -1168,12 +4083,12 @@ class BotTimerMixin(object):
         if name is '':
             name = self.active_timer
 
-        if name not in self.timers.keys():
+        if name not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(name))
 
         self.active_timer = name
         self.say(sender=sender, text='Timer "{}" is now active.'.format(name))
-        self.save()
+        self.save('active_timer')
 
     @require_op
     def timer_rename(self, sender=None, message=''):
@@ -1186,17 +4101,20 @@ class BotTimerMixin(object):
                 text='Invalid syntax: {symbol}timer rename <oldname> <newname>'.format(symbol=COMMAND_SYMBOL)
             )
 
-        if oldname not in self.timers.keys():
+        if oldname not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(oldname))
-        if newname in self.timers.keys():
+        if newname in self.timers:
             return self.say(sender=sender, text='Timer "{}" already exists.'.format(newname))
 
-        timer = self.timers.pop(oldname)
-        self.timers[newname] = timer
+        self.rename_entry('timers', oldname, newname)
         if oldname == self.active_timer:
             self.active_timer = newname
         self.say(sender=sender, text='Timer "{}" has been renamed to "{}"'.format(oldname, newname))
-        self.save()
+        self.save('active_timer')
+        if oldname in self.run_history:
+            self.run_history[newname] = self.run_history.pop(oldname)
+            self.save('run_history', oldname)
+            self.checkpoint_runs(newname, oldname)
 
     @require_op
     def timer_adjust(self, sender=None, message=''):
@@ -1220,7 +4138,7 @@ class BotTimerMixin(object):
         if timername is '':
             timername = self.active_timer
 
-        if timername not in self.timers.keys():
+        if timername not in self.timers:
             return self.say(sender=sender, text='Timer "{}" does not exist.'.format(timername))
 
         self.timers[timername].add(seconds)
@@ -1229,7 +4147,7 @@ class BotTimerMixin(object):
             seconds,
             self.timers[timername].elapsed
         ))
-        self.save()
+        self.save('timers', timername)
 
     @require_op
     def timer_adjustsplit(self, sender=None, message=''):
@@ -1255,14 +4173,94 @@ class BotTimerMixin(object):
         if timername is '':
             timername = self.active_timer
 
+        if timername not in self.timers:
+            return self.say(sender=sender, text='Timer "{}" does not exist.'.format(timername))
+
         timer = self.timers[timername]
 
-        if timer.has_split(splitname):
+        if not timer.has_split(splitname):
             return self.say(sender=sender, text='Split "{}" does not exist in timer "{}".'.format(splitname, timername))
 
         timer.adjustsplit(splitname, seconds)
         self.say(sender=sender, text='Split "{}" has been updated: {}'.format(splitname, timer.get_split(splitname)))
-        self.save()
+        self.save('timers', timername)
+
+    def timer_pb(self, sender=None, message=''):
+        """Show the personal best of the named or active timer. Syntax: {symbol}timer pb [name]"""
+        name, _, _ = message.partition(' ')
+
+        if name is '':
+            name = self.active_timer
+
+        if name not in self.timers:
+            return self.say(sender=sender, text='Timer "{}" does not exist.'.format(name))
+
+        history = self.run_history.get(name)
+        if history is None or history.pb is None:
+            return self.say(sender=sender, text='Timer "{}" has no finished runs yet.'.format(name))
+
+        return self.say(sender=sender, text='Personal best of timer "{}": {} (run {} of {}).'.format(
+            name,
+            timedelta(seconds=history.pb),
+            history.pb_attempt,
+            history.attempts
+        ))
+
+    def timer_sob(self, sender=None, message=''):
+        """Show the sum of the best segments of the named or active timer. Syntax: {symbol}timer sob [name]"""
+        name, _, _ = message.partition(' ')
+
+        if name is '':
+            name = self.active_timer
+
+        if name not in self.timers:
+            return self.say(sender=sender, text='Timer "{}" does not exist.'.format(name))
+
+        history = self.run_history.get(name)
+        sum_of_best = history.sum_of_best if history is not None else None
+        if sum_of_best is None:
+            return self.say(sender=sender, text='Timer "{}" has no best segment for every split yet.'.format(name))
+
+        if history.pb is None:
+            return self.say(sender=sender, text='Sum of best segments of timer "{}": {}'.format(
+                name,
+                timedelta(seconds=sum_of_best)
+            ))
+        return self.say(sender=sender, text='Sum of best segments of timer "{}": {} ({} against the PB).'.format(
+            name,
+            timedelta(seconds=sum_of_best),
+            signed_time(sum_of_best - history.pb)
+        ))
+
+    def timer_delta(self, sender=None, message=''):
+        """Compare the latest split of the named or active timer with the personal best.
+        Syntax: {symbol}timer delta [name]"""
+        name, _, _ = message.partition(' ')
+
+        if name is '':
+            name = self.active_timer
+
+        if name not in self.timers:
+            return self.say(sender=sender, text='Timer "{}" does not exist.'.format(name))
+
+        split = self.timers[name].last_split
+        if split is None:
+            return self.say(sender=sender, text='Timer "{}" has no splits.'.format(name))
+
+        splitname, seconds = split
+        history = self.run_history.get(name)
+        delta = history.delta(splitname, seconds) if history is not None else None
+        if delta is None:
+            return self.say(sender=sender, text='The personal best of timer "{}" has no split "{}".'.format(
+                name,
+                splitname
+            ))
+
+        return self.say(sender=sender, text='Split "{}": {}, {} against the personal best.'.format(
+            splitname,
+            timedelta(seconds=seconds),
+            signed_time(delta)
+        ))
 
 
 class BotCustomizableReplyMixin(object):
@@ -1270,28 +4268,37 @@ class BotCustomizableReplyMixin(object):
 
     def __init__(self, *args, **kwargs):
         self.custom_replies = {}
+        self.reply_templates = {}
         super(BotCustomizableReplyMixin, self).__init__(*args, **kwargs)
 
-    def listcommands(self):
-        super_list = super(BotCustomizableReplyMixin, self).listcommands()
-        commands = self.custom_replies.keys()
-        return super_list + commands
-
-    def dispatch(self, sender=None, message=''):
-        # we extend the dispatch method of BaseBot and do nothing if a command has already been executed.
-        if super(BotCustomizableReplyMixin, self).dispatch(sender, message):
-            return True
-
-        if message in self.custom_replies.keys():
-            reply = self.custom_replies[message]
-            self.say(sender=sender, text=reply)
-            return True
+    def setup_routes(self):
+        # built-in commands take precedence over custom replies loaded from an old state.
+        super(BotCustomizableReplyMixin, self).setup_routes()
+        self.reply_templates = {}
+        for name, text in self.custom_replies.items():
+            self.reply_templates[name] = Template(text)
+            self.add_route(name, partial(self.custom_reply, name))
 
-        return False
+    def clean_state(self, state):
+        state.pop('reply_templates', None)
+        return super(BotCustomizableReplyMixin, self).clean_state(state)
+
+    def escape_replies(self):
+        for name, text in self.custom_replies.items():
+            if '$' in text:
+                self.custom_replies[name] = text.replace('$', '$$')
+                self.mark_changed('custom_replies', name)
+        super(BotCustomizableReplyMixin, self).escape_replies()
+
+    def custom_reply(self, name, sender=None, message=''):
+        """Say the custom reply stored under the given name."""
+        self.say_template(self.reply_templates[name], sender=sender)
+        return True
 
     @require_op
     def command_set(self, sender=None, message=''):
-        """Define a custom reply message. Ops only. Syntax: {symbol}set <name> <reply>"""
+        """Define a custom reply message, which can include $user, $channel, $uptime, $game and
+        $random(a|b|c), $$ is a dollar sign. Ops only. Syntax: {symbol}set <name> <reply>"""
         name, _, text = message.partition(' ')
         if name is '' or text is '':
             return self.say(
@@ -1299,12 +4306,13 @@ class BotCustomizableReplyMixin(object):
                 text='Invalid syntax: {symbol}set <name> <text>'.format(symbol=COMMAND_SYMBOL)
             )
 
-        if name in self.listcommands() and name not in self.custom_replies.keys():
+        if name not in self.custom_replies and not self.add_route(name, partial(self.custom_reply, name)):
             return self.say(sender=sender, text='That command already exists.')
 
         self.custom_replies[name] = text
+        self.reply_templates[name] = Template(text)
         self.say(sender=sender, text='Command "{}" has been set to "{}".'.format(name, text))
-        self.save()
+        self.save('custom_replies', name)
         return True
 
     @require_op
@@ -1313,15 +4321,17 @@ class BotCustomizableReplyMixin(object):
         if ' ' in message or message == '':
             return self.say(sender=sender, text='Invalid syntax {symbol}unset <name>'.format(symbol=COMMAND_SYMBOL))
 
-        if message not in self.custom_replies.keys():
+        if message not in self.custom_replies:
             return self.say(
                 sender=sender,
                 text='Command "{}" does not exist or is not a custom command.'.format(message)
             )
 
         self.custom_replies.pop(message)
+        self.reply_templates.pop(message)
+        self.remove_route(message)
         self.say(sender=sender, text='Command "{}" has been removed.'.format(message))
-        self.save()
+        self.save('custom_replies', message)
         return True
 
 
@@ -1330,27 +4340,36 @@ class BotCountersMixin(object):
 
     def __init__(self, *args, **kwargs):
         self.counters = {}
+        self.counter_templates = {}
         super(BotCountersMixin, self).__init__(*args, **kwargs)
 
-    def listcommands(self):
-        super_list = super(BotCountersMixin, self).listcommands()
-        commands = self.counters.keys()
-        return super_list + commands
-
-    def dispatch(self, sender=None, message=''):
-        # extend dispatch() method
-        if super(BotCountersMixin, self).dispatch(sender, message):
-            return True
-
-        if message in self.counters.keys():
-            self.counters[message]['value'] += 1
-            value = self.counters[message]['value']
-            reply = self.counters[message]['reply']
-            self.say(sender=sender, text=reply.format(value))
-            self.save()
-            return True
+    def setup_routes(self):
+        # built-in commands and custom replies take precedence over counters loaded from an old state.
+        super(BotCountersMixin, self).setup_routes()
+        self.counter_templates = {}
+        for name, counter in self.counters.items():
+            self.counter_templates[name] = Template(counter['reply'], counter=True)
+            self.add_route(name, partial(self.count, name))
 
-        return False
+    def clean_state(self, state):
+        state.pop('counter_templates', None)
+        return super(BotCountersMixin, self).clean_state(state)
+
+    def escape_replies(self):
+        for name, counter in self.counters.items():
+            if '$' in counter['reply']:
+                counter['reply'] = counter['reply'].replace('$', '$$')
+                self.mark_changed('counters', name)
+        super(BotCountersMixin, self).escape_replies()
+
+    def count(self, name, sender=None, message=''):
+        """Increment the named counter and report the new value."""
+        counter = self.counters[name]
+        counter['value'] += 1
+        template = self.counter_templates[name]
+        self.say_template(template, sender=sender, priority=PRIORITY_LOW, count=str(counter['value']))
+        self.save('counters', name)
+        return True
 
     def command_counter(self, sender=None, message=''):
         """Performs counter related actions. Syntax: {symbol}counter <action> <name>; where possible actions are:
@@ -1363,9 +4382,8 @@ class BotCountersMixin(object):
                 text='Invalid syntax: {symbol}counter <action>'.format(symbol=COMMAND_SYMBOL)
             )
 
-        try:
-            method = getattr(self, 'counter_'+action)
-        except AttributeError:
+        method = self.get_action('counter', action)
+        if method is None:
             return self.say(sender=sender, text='{} is not a valid action.'.format(action))
 
         return method(sender=sender, message=message)
@@ -1373,10 +4391,10 @@ class BotCountersMixin(object):
     def help_counter(self, sender=None, message=''):
         """Determine the action being used and display the corresponding method's docstring."""
         action, _, _ = message.partition(' ')
-        funcname = 'counter_'+action if action is not '' else 'command_counter'
+        method = self.get_action('counter', action) if action is not '' else self.get_command('counter')
 
-        if hasattr(self, funcname):
-            helptext = getattr(self, funcname).__doc__.format(symbol=COMMAND_SYMBOL)
+        if method is not None:
+            helptext = method.__doc__.format(symbol=COMMAND_SYMBOL)
             helptext = " ".join(helptext.split())
             return self.say(sender=sender, text=helptext)
 
@@ -1384,7 +4402,8 @@ class BotCountersMixin(object):
 
     @require_op
     def counter_new(self, sender=None, message=''):
-        """Create a new counter. Ops only. Syntax: {symbol}counter new <name> [reply]"""
+        """Create a new counter. The reply can include $count, $user, $channel, $uptime, $game and
+        $random(a|b|c), $$ is a dollar sign. Ops only. Syntax: {symbol}counter new <name> [reply]"""
         name, _, reply = message.partition(' ')
         if name is '':
             return self.say(
@@ -1392,18 +4411,19 @@ class BotCountersMixin(object):
                 text='Invalid syntax: {symbol}counter new <name> [reply]'.format(symbol=COMMAND_SYMBOL)
             )
 
-        if name in self.listcommands():
+        if not self.add_route(name, partial(self.count, name)):
             return self.say(sender=sender, text='This command already exists.')
 
         if reply is '':
-            reply = 'Counter {}: {}'.format(name, '{}')
+            reply = 'Counter {}: $count'.format(name)
 
         self.counters[name] = {
             'value': 0,
             'reply': reply,
         }
+        self.counter_templates[name] = Template(reply, counter=True)
         self.say(sender=sender, text='Counter "{}" has been created.'.format(name))
-        self.save()
+        self.save('counters', name)
 
     @require_op
     def counter_del(self, sender=None, message=''):
@@ -1415,12 +4435,14 @@ class BotCountersMixin(object):
                 text='Invalid syntax: {symbol}counter del <name>'.format(symbol=COMMAND_SYMBOL)
             )
 
-        if name not in self.counters.keys():
+        if name not in self.counters:
             return self.say(sender=sender, text='Counter "{}" does not exist.'.format(name))
 
         self.counters.pop(name)
+        self.counter_templates.pop(name)
+        self.remove_route(name)
         self.say(sender=sender, text='Counter "{}" has been removed.'.format(name))
-        self.save()
+        self.save('counters', name)
 
     def counter_list(self, sender=None, message=''):
         """Show a list of counters. Syntax: {symbol}counter list"""
@@ -1443,7 +4465,7 @@ class BotCountersMixin(object):
 
         self.counters[name]['value'] = max(0, value)
         self.say(sender=sender, text='Counter "{}" is now: {}'.format(name, value))
-        self.save()
+        self.save('counters', name)
 
     @require_op
     def counter_add(self, sender=None, message=''):
@@ -1462,11 +4484,12 @@ class BotCountersMixin(object):
 
         self.counters[name]['value'] = max(0, self.counters[name]['value'] + value)
         self.say(sender=sender, text='Counter "{}" is now: {}'.format(name, self.counters[name]['value']))
-        self.save()
+        self.save('counters', name)
 
     @require_op
     def counter_reply(self, sender=None, message=''):
-        """Change the reply of a counter without changing the value. Ops only.
+        """Change the reply of a counter without changing the value. The reply can include $count,
+        $user, $channel, $uptime, $game and $random(a|b|c), $$ is a dollar sign. Ops only.
         Syntax: {symbol}counter reply <name> <text>"""
         name, _, reply = message.partition(' ')
 
@@ -1480,8 +4503,9 @@ class BotCountersMixin(object):
             return self.say(sender=sender, text='Counter "{}" does not exist.'.format(name))
 
         self.counters[name]['reply'] = reply
+        self.counter_templates[name] = Template(reply, counter=True)
         self.say(sender=sender, text='Counter "{}" has been updated.'.format(name))
-        self.save()
+        self.save('counters', name)
 
 
 class BotTwitterMixin(object):
@@ -1491,48 +4515,24 @@ class BotTwitterMixin(object):
         self.twitter_handle = None
         self.latest_tweet = {}
         super(BotTwitterMixin, self).__init__(*args, **kwargs)
-        self.twitter_timeline = TwitterTimeline()
-        self.setup_twitter_callback()
+        if self.twitter_handle:
+            twitter_poller.subscribe(self, self.twitter_handle)
 
-    def setup_twitter_callback(self):
-        """Setup the callback for the timer."""
-        self._twitter_callback = callback(self.twitter_callback)
-        self._twitter_pointer = weechat.hook_timer(60*1000, 60, 0, self._twitter_callback, '')
-
-    def clean_state(self, state):
-        """Remove some instance variables from state that would not survive loading."""
-        state.pop('twitter_timeline')
-        state.pop('_twitter_callback')
-        state.pop('_twitter_pointer')
-        return super(BotTwitterMixin, self).clean_state(state)
-
-    def twitter_callback(self, data, remaining_calls):
-        """This method is called by the automatic hook_timer and ."""
-        latest_tweet = self.get_latest_tweet()
-        if latest_tweet:
-            self.latest_tweet = latest_tweet
-            self.save()
-            text = ('Twitter update from @{handle}: "{text}" – '
-                    'https://twitter.com/{handle}/status/{id}/').format(**latest_tweet)
-            self.say(sender=User(prefix='', nick=''), text=text)
-        return weechat.WEECHAT_RC_OK
+    def close(self):
+        if self.twitter_handle:
+            twitter_poller.unsubscribe(self, self.twitter_handle)
+        super(BotTwitterMixin, self).close()
 
-    def get_latest_tweet(self):
-        """Get the latest tweet."""
-        previous_id = self.latest_tweet.get('id', None)
-        timeline = self.twitter_timeline.get(handle=self.twitter_handle, previous_id=previous_id)
+    def new_tweet(self, tweet):
+        """This method is called by the twitter poller when the handle tweeted."""
+        if tweet['id'] == (self.latest_tweet or {}).get('id'):
+            return
 
-        if timeline:
-            # do some cleaning up.
-            tweet = timeline[0]
-            tweet = {
-                'handle': self.twitter_handle,
-                'id': tweet['id'],
-                'text': ' '.join(HTMLParser().unescape(tweet['text']).split()),
-            }
-            return tweet
-        else:
-            return False
+        self.latest_tweet = tweet
+        self.save('latest_tweet')
+        text = ('Twitter update from @{handle}: "{text}" – '
+                'https://twitter.com/{handle}/status/{id}/').format(**tweet)
+        self.say(sender=User(prefix='', nick=''), text=text)
 
     @require_regular
     def command_latest(self, sender=None, message=''):
@@ -1549,12 +4549,23 @@ class BotTwitterMixin(object):
         """Set the twitter handle for this channel or show currently set handle. Ops only.
         Syntax: {symbol}handle [twitch username]"""
         if is_valid_nick(message) and message != self.twitter_handle:
+            if self.twitter_handle:
+                twitter_poller.unsubscribe(self, self.twitter_handle)
             self.twitter_handle = message
             self.latest_tweet = False
-            self.save()
+            twitter_poller.subscribe(self, self.twitter_handle)
+            self.save('twitter_handle')
+            self.save('latest_tweet')
         self.say(sender=sender, text='Listening for twitter updates from @{}'.format(self.twitter_handle))
         return True
 
+    @require_owner
+    def command_twitterstats(self, sender=None, message=''):
+        """Show how the twitter handle of this channel is being polled. Owner only."""
+        if not self.twitter_handle:
+            return self.say(sender=sender, text='No twitter handle has been set.')
+        return self.say(sender=sender, text=twitter_poller.stats(self.twitter_handle))
+
 
 class Bot(BotTwitterMixin,
           BotCountersMixin,
@@ -1568,6 +4579,17 @@ class Bot(BotTwitterMixin,
         super(self.__class__, self).__init__(*args, **kwargs)
 
 
+class HeadlessBot(BotTwitterMixin,
+                  BotCountersMixin,
+                  BotCustomizableReplyMixin,
+                  BotTimerMixin,
+                  BotFunMixin,
+                  BotTwitchMixin,
+                  BaseCommandsBot,
+                  AsyncoreBot):
+    """The same bot as Bot, talking to the IRC server itself instead of through WeeChat."""
+
+
 # =====================================
 # Initialisation stuff.
 # =====================================
@@ -1598,20 +4620,470 @@ def callback(method):
     return name
 
 
-if __name__ == '__main__' and import_ok:
+bots = {}
+
+
+def start_instrumentation(classes):
+    """Wrap the instrumented methods of the bot classes and the API clients, and write the stats
+    periodically. Nothing is wrapped unless this is called."""
+    for cls in classes:
+        # flush and irc_say do the I/O, save() and say() only mark changes and queue messages.
+        methods = ['dispatch', 'flush', 'irc_say']
+        methods.extend(entry.method for entry in cls._commands.values())
+        for actions in cls._actions.values():
+            methods.extend(entry.method for entry in actions.values())
+        for method in set(methods):
+            setattr(cls, method, timed(method, getattr(cls, method).im_func))
+    TwitchAPI.fetch = timed('twitch_api', TwitchAPI.fetch.im_func)
+    TwitterTimeline.request = timed('twitter_api', TwitterTimeline.request.im_func)
+    call_every(STATS_INTERVAL, write_stats)
+
+
+def shard_path(path):
+    """Return the path of a file written by every process, with the shard in its name in worker processes."""
+    if shard_id is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}-{}{}'.format(root, shard_id, ext)
+
+
+def write_stats():
+    """Write the stats file, runs every STATS_INTERVAL seconds."""
+    if STATS_FILE:
+        metrics.write(shard_path(STATS_FILE))
+
+
+def stats_info_callback(data, info_name, arguments):
+    """Return the stats of a channel (name of its bot, e.g. twitch_frustbox), or all stats in the
+    Prometheus text format without arguments."""
+    if arguments:
+        return metrics.summary(arguments)
+    return metrics.prometheus()
+
+
+def shutdown():
+    """Write pending state changes of all bots to disk before the script is unloaded."""
+    requested = written = coalesced = 0
+    for bot in bots.values():
+        bot.flush()
+        requested += bot.saves_requested
+        written += bot.saves_written
+        coalesced += bot.saves_coalesced
+
+    worker.stop()
+    if INSTRUMENTATION and STATS_FILE:
+        metrics.write(shard_path(STATS_FILE))
+    prnt('{}: {} state changes written in {} saves ({} coalesced).'.format(
+        SCRIPT_NAME,
+        requested,
+        written,
+        coalesced,
+    ))
+
+
+def shutdown_callback():
+    """Shut down when WeeChat unloads the script."""
+    shutdown()
+    return weechat.WEECHAT_RC_OK
+
+
+def start_bot(network, channel):
+    """Create the bot of a channel, unless the channel is not in CHANNELS or has a bot already.
+
+    Channels are looked up in CHANNELS regardless of case, the bot is named after the channel as it
+    is spelled there (which names its state)."""
+    channel = dict((name.lower(), name) for name in CHANNELS.get(network, ())).get(channel.lower())
+    key = '{network}_{channel}'.format(network=network, channel=channel)
+    if channel is None or key in bots:
+        return None
+    bots[key] = Bot(name=key, network=network, channel=channel)
+    return bots[key]
+
+
+def channel_opened_callback(data, signal, signal_data):
+    """Start the bot of a channel when WeeChat opened its buffer (the channel was joined)."""
+    localvars = BufferLocalvars(signal_data)
+    start_bot(localvars['server'], localvars['channel'].lstrip('#'))
+    return weechat.WEECHAT_RC_OK
+
+
+def buffer_closing_callback(data, signal, signal_data):
+    """Stop the bot of a channel when its buffer is closed."""
+    for key, bot in bots.items():
+        if bot.buffer == signal_data:
+            bots.pop(key).close()
+    return weechat.WEECHAT_RC_OK
+
+
+def run_weechat():
+    """Register the script and start the bots of the channels that are open, the bots of the other
+    channels in CHANNELS start when WeeChat opens their buffers."""
     weechat.register(
         SCRIPT_NAME,
         SCRIPT_AUTHOR,
         SCRIPT_VERSION,
         SCRIPT_LICENSE,
         SCRIPT_DESCRIPTION,
-        "",
+        "shutdown_callback",
         "")
 
-    bots = {}
-
+    if INSTRUMENTATION:
+        start_instrumentation([Bot])
+        weechat.hook_info(
+            'twitchbot_stats',
+            'stats of the twitchbot (Prometheus text format)',
+            'name of a bot for a summary of its channel (optional)',
+            'stats_info_callback',
+            '')
+
+    weechat.hook_signal('irc_channel_opened', 'channel_opened_callback', '')
+    weechat.hook_signal('buffer_closing', 'buffer_closing_callback', '')
     #  have the bot listen in whitelisted networks and channels.
     for network, channels in CHANNELS.items():
         for channel in channels:
-            key = '{network}_{channel}'.format(network=network, channel=channel)
-            bots[key] = Bot(name=key, network=network, channel=channel)
+            if weechat.info_get('irc_buffer', '{},#{}'.format(network, channel)):
+                start_bot(network, channel)
+
+
+def run_headless(channels=None, control_connection=None):
+    """Run the bots of the given (network, channel) pairs (all CHANNELS) without WeeChat, until
+    interrupted or stopped by a control message."""
+    global loop, shard_control
+    loop = HeadlessLoop()
+    if INSTRUMENTATION:
+        start_instrumentation([HeadlessBot])
+    if control_connection is not None:
+        shard_control = control_connection
+        watch_fd(shard_control.fileno(), control_received)
+    if channels is None:
+        channels = [(network, channel) for network in CHANNELS for channel in CHANNELS[network]]
+    set_channels(channels)
+
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown()
+
+
+def set_channels(channels):
+    """Run bots for exactly the given (network, channel) pairs, closing the bots of other channels.
+    Return the (network, channel) pairs of the closed bots, their state is written by then."""
+    wanted = dict(('{}_{}'.format(network, channel), (network, channel)) for network, channel in channels)
+    closed = []
+    for key in set(bots) - set(wanted):
+        bot = bots.pop(key)
+        bot.close()
+        closed.append((bot.network, bot.channel))
+    for key in sorted(set(wanted) - set(bots)):
+        network, channel = wanted[key]
+        bots[key] = HeadlessBot(name=key, network=network, channel=channel)
+    return closed
+
+
+# =====================================
+# Sharding
+# =====================================
+
+# connection to the supervisor and number of the shard, in worker processes.
+shard_control = None
+shard_id = None
+
+
+def broadcast(message):
+    """Have every process apply a control message: through the supervisor when the bots are
+    sharded, right here otherwise."""
+    if shard_control is not None:
+        shard_control.send(('broadcast', message))
+    else:
+        control(message)
+
+
+def control(message):
+    """Apply a control message to the bots of this process.
+
+    Messages are tuples: ('ignore', nick), ('unignore', nick), ('reload',), ('channels', channels)
+    and ('stop',). A worker answers ('channels', channels) with ('released', channels) once the
+    bots of the channels it no longer runs are closed."""
+    action, args = message[0], message[1:]
+    if action == 'ignore':
+        for bot in bots.values():
+            if not bot.is_blacklisted(args[0]) and not bot.can_use_regular(args[0]):
+                bot.blacklist.add(args[0])
+                bot.save('blacklist', args[0])
+    elif action == 'unignore':
+        for bot in bots.values():
+            if args[0] in bot.blacklist:
+                bot.blacklist.remove(args[0])
+                bot.save('blacklist', args[0])
+    elif action == 'reload':
+        for bot in bots.values():
+            bot.reload()
+    elif action == 'channels':
+        released = set_channels(args[0])
+        if shard_control is not None:
+            shard_control.send(('released', released))
+    elif action == 'stop':
+        loop.stop()
+
+
+def control_received():
+    """Apply the control messages sent by the supervisor, stop if the supervisor is gone."""
+    try:
+        while shard_control.poll():
+            control(shard_control.recv())
+    except EOFError:
+        loop.stop()
+
+
+def run_shard(shard, channels, connection):
+    """Main function of a worker process, the signals handled by the supervisor are not its business."""
+    global shard_id
+    shard_id = shard
+    for signum in (signal.SIGUSR1, signal.SIGUSR2, signal.SIGHUP, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_DFL)
+    run_headless(channels, connection)
+
+
+class HashRing(object):
+    """Consistent hashing: every node owns the keys up to its points on a ring, so adding or
+    removing a node only moves the keys next to its points."""
+
+    def __init__(self, nodes=(), replicas=SHARD_REPLICAS):
+        self.replicas = replicas
+        self.points = []
+        self.nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def hash(self, key):
+        return int(hashlib.md5(str(key)).hexdigest()[:8], 16)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = self.hash('{}-{}'.format(node, i))
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.nodes.insert(index, node)
+
+    def remove(self, node):
+        points = [(point, other) for point, other in zip(self.points, self.nodes) if other != node]
+        self.points = [point for point, _ in points]
+        self.nodes = [other for _, other in points]
+
+    def get(self, key):
+        """Return the node owning a key."""
+        if not self.points:
+            return None
+        return self.nodes[bisect.bisect(self.points, self.hash(key)) % len(self.points)]
+
+
+def read_channels(path):
+    """Return CHANNELS as the script at path defines it now."""
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(getattr(target, 'id', None) == 'CHANNELS' for target in node.targets):
+            return ast.literal_eval(node.value)
+    return CHANNELS
+
+
+class ShardSupervisor(object):
+    """Run the headless bots in worker processes, restart workers that die and move channels
+    between workers when workers are added or removed. Messages workers broadcast are passed on
+    to all workers.
+
+    A channel only moves once the worker running it closed its bot (which writes its state) and
+    released it, so two workers never run the bot of a channel at the same time."""
+
+    def __init__(self, shards=HEADLESS_SHARDS):
+        self.ring = HashRing()
+        self.workers = {}
+        self.restarts = {}
+        self.stopping = {}
+        # shard running the bot of each (network, channel) pair, the pairs it has to release and
+        # the channels last sent to each worker.
+        self.holders = {}
+        self.releasing = set()
+        self.sent = {}
+        self.running = False
+        for shard in range(shards):
+            self.ring.add(shard)
+
+    def channels(self):
+        """Return the (network, channel) pairs of all CHANNELS."""
+        return [(network, channel) for network in CHANNELS for channel in CHANNELS[network]]
+
+    def assigned(self, shard):
+        """Return the (network, channel) pairs a shard runs."""
+        return sorted(channel for channel, holder in self.holders.items()
+                      if holder == shard and channel not in self.releasing)
+
+    def start_worker(self, shard):
+        """Start the process of a shard."""
+        connection, worker_connection = multiprocessing.Pipe()
+        self.sent[shard] = self.assigned(shard)
+        process = multiprocessing.Process(target=run_shard, args=(shard, self.sent[shard], worker_connection))
+        process.daemon = True
+        process.start()
+        self.workers[shard] = (process, connection)
+        debug('Started shard {} (pid {}).'.format(shard, process.pid))
+
+    def add_shard(self):
+        """Start another worker, it gets its channels as the other workers release them."""
+        shard = max(self.ring.nodes or [-1]) + 1
+        self.ring.add(shard)
+        self.rebalance()
+        self.start_worker(shard)
+
+    def remove_shard(self):
+        """Stop the last worker, its channels go to the other workers once it exited."""
+        if len(self.workers) < 2:
+            return
+        shard = max(self.workers)
+        self.ring.remove(shard)
+        self.send(shard, ('stop',))
+        self.stopping[shard] = self.workers.pop(shard)[0]
+        self.sent.pop(shard, None)
+        self.restarts.pop(shard, None)
+        self.rebalance()
+
+    def rebalance(self):
+        """Tell every worker which channels it runs now.
+
+        Channels without a worker go to the shard owning them on the ring. Channels running on
+        another shard (or no longer in CHANNELS) are taken from their worker first, they go to
+        their new shard when released()."""
+        channels = self.channels()
+        for channel in channels:
+            owner = self.ring.get('{}_{}'.format(*channel))
+            holder = self.holders.setdefault(channel, owner)
+            if holder != owner:
+                self.releasing.add(channel)
+        self.releasing.update(set(self.holders) - set(channels))
+
+        for shard in self.workers:
+            assigned = self.assigned(shard)
+            if assigned != self.sent.get(shard):
+                self.sent[shard] = assigned
+                self.send(shard, ('channels', assigned))
+
+    def released(self, shard, channels):
+        """Hand the channels a worker closed (or that died with it) on to their new shards."""
+        for channel in channels:
+            if self.holders.get(channel) == shard:
+                del self.holders[channel]
+                self.releasing.discard(channel)
+        self.rebalance()
+
+    def reload_config(self):
+        """Read CHANNELS from the script again, move channels accordingly and make all workers
+        reload their state."""
+        global CHANNELS
+        try:
+            CHANNELS = read_channels(os.path.realpath(__file__))
+        except (IOError, SyntaxError, ValueError) as e:
+            prnt('Could not read CHANNELS, keeping them as they are: {}'.format(e))
+        self.rebalance()
+        self.broadcast(('reload',))
+
+    def broadcast(self, message):
+        for shard in self.workers:
+            self.send(shard, message)
+
+    def send(self, shard, message):
+        """Send a control message to a worker, unless it died (it gets its channels when restarted)."""
+        try:
+            self.workers[shard][1].send(message)
+        except (IOError, OSError):
+            pass
+
+    def run(self):
+        """Start the workers and supervise them until interrupted."""
+        self.running = True
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.add_shard())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.remove_shard())
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_config())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        self.rebalance()
+        for shard in sorted(set(self.ring.nodes)):
+            self.start_worker(shard)
+
+        try:
+            while self.running:
+                self.run_once()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def run_once(self, timeout=1.0):
+        """Pass on the messages of workers, reap stopped workers and restart the workers that died."""
+        connections = dict((connection.fileno(), shard)
+                           for shard, (process, connection) in self.workers.items() if process.is_alive())
+        try:
+            readable = select.select(list(connections), [], [], timeout)[0]
+        except select.error:
+            readable = []
+        for fd in readable:
+            shard = connections[fd]
+            if shard not in self.workers:
+                continue
+            try:
+                action, message = self.workers[shard][1].recv()
+            except EOFError:
+                continue
+            if action == 'broadcast':
+                self.broadcast(message)
+            elif action == 'released':
+                self.released(shard, message)
+
+        for shard, process in self.stopping.items():
+            if not process.is_alive():
+                process.join()
+                del self.stopping[shard]
+                self.released(shard, [channel for channel, holder in self.holders.items() if holder == shard])
+
+        now = time.time()
+        for shard, (process, connection) in self.workers.items():
+            if process.is_alive():
+                continue
+            if shard not in self.restarts:
+                process.join()
+                prnt('Shard {} died (exit code {}), restarting it in {} seconds.'.format(
+                    shard, process.exitcode, SHARD_RESTART_DELAY))
+                self.restarts[shard] = now + SHARD_RESTART_DELAY
+                # nothing runs there until the restart, channels it was releasing can move on.
+                self.released(shard, [channel for channel in self.releasing if self.holders[channel] == shard])
+            elif self.restarts[shard] <= now:
+                del self.restarts[shard]
+                self.start_worker(shard)
+
+    def stop(self):
+        """Stop all workers, they write their state before exiting."""
+        self.running = False
+        self.broadcast(('stop',))
+        for process, connection in self.workers.values():
+            process.join(10)
+        for process in self.stopping.values():
+            process.join(10)
+        self.workers = {}
+        self.stopping = {}
+
+
+if __name__ == '__main__' and not import_ok:
+    if '--headless' in sys.argv:
+        shards = HEADLESS_SHARDS
+        if '--shards' in sys.argv:
+            shards = int(sys.argv[sys.argv.index('--shards') + 1])
+        if shards > 1:
+            ShardSupervisor(shards).run()
+        else:
+            run_headless()
+    else:
+        print('This script must be run under WeeChat, or with --headless.')
+        print('Get WeeChat now at: http://www.weechat.org/')
+
+if __name__ == '__main__' and import_ok:
+    run_weechat()